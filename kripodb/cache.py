@@ -0,0 +1,111 @@
+# Copyright 2016 Netherlands eScience Center
+#
+# Licensed under the Apache License, Version 2.0 (the 'License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Cache of rows read from similarity matrices"""
+from __future__ import absolute_import
+from collections import OrderedDict
+import threading
+
+
+class RowCache(object):
+    """Thread-safe least recently used cache bounded by a byte budget.
+
+    Args:
+        max_bytes (int): Maximum number of bytes of all cached values together, 0 disables the cache
+
+    Attributes:
+        max_bytes (int): Maximum number of bytes of all cached values together
+        nbytes (int): Number of bytes of all cached values together
+        hits (int): Number of lookups which were found in cache
+        misses (int): Number of lookups which were not found in cache
+        evictions (int): Number of values removed from cache to stay within byte budget
+    """
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key):
+        """Get value from cache and mark it as most recently used
+
+        Args:
+            key: Key of value
+
+        Returns:
+            Value or None when key is not in cache
+        """
+        with self._lock:
+            try:
+                value, nbytes = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self._entries[key] = (value, nbytes)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, nbytes):
+        """Store value in cache, evicting least recently used values when byte budget is exceeded
+
+        Values larger than the byte budget are not stored.
+
+        Args:
+            key: Key of value
+            value: Value to store
+            nbytes (int): Size of value in bytes
+        """
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            while self.nbytes + nbytes > self.max_bytes:
+                _, (_, evicted_nbytes) = self._entries.popitem(last=False)
+                self.nbytes -= evicted_nbytes
+                self.evictions += 1
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+
+    def clear(self):
+        """Remove all values from cache, statistics are kept"""
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """Statistics of cache
+
+        Returns:
+            dict: With hits, misses, evictions, number of entries, bytes used and byte budget
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'nbytes': self.nbytes,
+                'max_bytes': self.max_bytes,
+            }
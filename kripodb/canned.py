@@ -23,7 +23,7 @@ import pandas as pd
 from requests import HTTPError
 
 from .db import FragmentsDb
-from .pairs import similar, open_similarity_matrix
+from .pairs import open_similarity_matrix
 from .pharmacophores import PharmacophoresDb, as_phar
 from .webservice.client import WebserviceClient, IncompleteFragments, IncompletePharmacophores
 
@@ -89,16 +89,20 @@ def similarities(queries, similarity_matrix_filename_or_url, cutoff, limit=1000)
                     absent_identifiers.append(query)
     else:
         similarity_matrix = open_similarity_matrix(similarity_matrix_filename_or_url)
+        present_queries = []
         for query in queries:
-            try:
-                for query_id, hit_id, score in similar(query, similarity_matrix, cutoff, limit):
-                    hit = {'query_frag_id': query_id,
-                           'hit_frag_id': hit_id,
-                           'score': score,
-                           }
-                    hits.append(hit)
-            except KeyError:
+            if query in similarity_matrix.cache_l2i:
+                present_queries.append(query)
+            else:
                 absent_identifiers.append(query)
+        # read rows of all queries together instead of one query at a time
+        for query, query_hits in zip(present_queries, similarity_matrix.find_many(present_queries, cutoff, limit)):
+            for hit_id, score in query_hits:
+                hit = {'query_frag_id': query,
+                       'hit_frag_id': hit_id,
+                       'score': score,
+                       }
+                hits.append(hit)
 
         similarity_matrix.close()
 
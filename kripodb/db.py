@@ -17,18 +17,23 @@ Registers `BitMap` and `molblockgz` data types in sqlite.
 """
 
 from __future__ import absolute_import
-from collections import MutableMapping
+from collections import Mapping, MutableMapping
+from itertools import chain, islice
 import sqlite3
 import logging
+import time
 import zlib
 import re
 
 import blosc
+import numpy as np
 from pyroaring import BitMap
 from rdkit.Chem import MolToMolBlock, MolFromMolBlock, MolToSmiles
 from rdkit.Chem.rdchem import Mol
 import six
 
+from .modifiedtanimoto import modified_tanimoto
+
 ATTR_NUMBER_OF_BITS = 'number_of_bits'
 
 
@@ -512,6 +517,25 @@ class FingerprintsDb(SqliteDb):
         """
         return IntbitsetDict(self, number_of_bits)
 
+    def build_index(self):
+        """Build inverted index of fingerprints, replacing any previous index.
+
+        Returns:
+            FingerprintsIndex
+        """
+        return FingerprintsIndex.build(self.connection)
+
+    def index(self):
+        """Inverted index of fingerprints
+
+        Raises:
+            LookupError: When fingerprints db has no index
+
+        Returns:
+            FingerprintsIndex
+        """
+        return FingerprintsIndex(self.connection)
+
 
 class SqliteDict(MutableMapping):
     """Dict-like object of 2 columns of a sqlite table.
@@ -645,24 +669,74 @@ class IntbitsetDict(SqliteDict):
     Args:
         db (FingerprintsDb): Fingerprints db
         number_of_bits (int): Number of bits
+        batch_size (Optional[int]): Number of rows inserted between commits by :meth:`update`,
+            None to insert all rows in a single transaction
 
     Attributes:
         number_of_bits (int): Number of bits the bitsets consist of
+        batch_size (int): Number of rows inserted between commits by :meth:`update`
 
     """
 
-    def __init__(self, db, number_of_bits=None):
+    def __init__(self, db, number_of_bits=None, batch_size=100000):
         super(IntbitsetDict, self).__init__(db.connection, 'bitsets', 'frag_id', 'bitset')
         if number_of_bits is not None:
             self.number_of_bits = number_of_bits
+        self.batch_size = batch_size
 
     def update(*args, **kwds):
+        """Insert or replace fingerprints in bulk.
+
+        Same as :meth:`dict.update`, but rows are inserted with executemany in batches of `batch_size` rows
+        with a commit after each batch.
+        The inverted index is dropped and the db is vacuumed once at the end.
+        """
         self = args[0]
+        if len(args) > 2:
+            raise TypeError('update expected at most 1 arguments, got {0}'.format(len(args) - 1))
+        items = ()
+        if len(args) == 2:
+            other = args[1]
+            if isinstance(other, Mapping):
+                items = six.iteritems(other)
+            elif hasattr(other, 'keys'):
+                items = ((key, other[key]) for key in other.keys())
+            else:
+                items = other
+        self._upsert(chain(items, six.iteritems(kwds)))
+
+    def update_serialized(self, items):
+        """Insert or replace fingerprints which have already been serialized.
+
+        Same result as :meth:`update` with the unserialized fingerprints.
+
+        Args:
+            items (Iterable[Tuple[str, bytes]]): Fingerprint identifier and BitMap serialized by :func:`adapt_BitMap`
 
+        """
+        self._upsert(items)
+
+    def _upsert(self, items):
+        sql = self.sqls['setitem']
+        items = iter(items)
+        nr_rows = 0
+        start = time.time()
         with FastInserter(self.cursor):
-            MutableMapping.update(*args, **kwds)
+            while True:
+                batch = list(islice(items, self.batch_size))
+                if not batch:
+                    break
+                self.cursor.executemany(sql, batch)
+                self.connection.commit()
+                nr_rows += len(batch)
+            # inverted index is out of date
+            FingerprintsIndex.drop(self.cursor)
             # make table and index stored contiguously
             self.cursor.execute('VACUUM')
+        duration = time.time() - start
+        logging.warning('Inserted {0} fingerprints in {1:.1f}s ({2:.0f} rows/s)'.format(nr_rows,
+                                                                                       duration,
+                                                                                       nr_rows / max(duration, 1e-9)))
 
     @property
     def number_of_bits(self):
@@ -683,3 +757,214 @@ class IntbitsetDict(SqliteDict):
         sql = 'DELETE FROM attributes WHERE key=?'
         self.cursor.execute(sql, (ATTR_NUMBER_OF_BITS,))
         self.connection.commit()
+
+
+def adapt_posting(frag_idxs):
+    """Convert array of fragment index identifiers to it's serialized format
+
+    Args:
+        frag_idxs (np.ndarray): Fragment index identifiers
+
+    Returns:
+        str: serialized array
+    """
+    data = np.ascontiguousarray(frag_idxs, dtype=np.uint32).tobytes()
+    return sqlite3.Binary(blosc.compress(data, typesize=4, cname='zstd'))
+
+
+def convert_posting(s):
+    """Convert serialized array of fragment index identifiers to array
+
+    Args:
+        s (str): serialized array
+
+    Returns:
+        np.ndarray: Fragment index identifiers
+    """
+    return np.frombuffer(blosc.decompress(s), dtype=np.uint32)
+
+
+class FingerprintsIndex(object):
+    """Inverted index of fingerprints db, maps each bit to the fingerprints which have that bit on.
+
+    Stored in the `index_fragments` and `index_postings` tables of the fingerprints db.
+    The index is dropped when fingerprints are added with :meth:`IntbitsetDict.update`,
+    after other changes of the fingerprints the index must be rebuilt with :meth:`FingerprintsDb.build_index`.
+
+    Searching only counts the bits in common with fragments which share bits with the query,
+    instead of comparing the query with every fingerprint.
+
+    Args:
+        connection (sqlite3.Connection): Sqlite connection of fingerprints db
+
+    Attributes:
+        labels (list[str]): Fingerprint labels, the position in the list is the fragment index identifier
+        popcounts (np.ndarray): Number of on bits of each fingerprint
+
+    Raises:
+        LookupError: When fingerprints db has no index
+    """
+    select_postings_sql = 'SELECT frag_idxs FROM index_postings WHERE bit IN ({0})'
+    # stay below maximum number of host parameters of sqlite
+    max_bits_per_select = 500
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.cursor = connection.cursor()
+        if not self.exists(self.cursor):
+            raise LookupError('Fingerprints db has no index')
+        rows = self.cursor.execute('SELECT frag_id, popcount FROM index_fragments ORDER BY frag_idx').fetchall()
+        self.labels = [r[0] for r in rows]
+        self.labels_array = np.array(self.labels)
+        self.popcounts = np.array([r[1] for r in rows], dtype=np.int64)
+
+    @staticmethod
+    def exists(cursor):
+        cursor.execute("SELECT count(*) FROM sqlite_master WHERE type='table' AND name='index_postings'")
+        return cursor.fetchone()[0] == 1
+
+    @staticmethod
+    def drop(cursor):
+        cursor.execute('DROP TABLE IF EXISTS index_fragments')
+        cursor.execute('DROP TABLE IF EXISTS index_postings')
+
+    @classmethod
+    def build(cls, connection):
+        """Build index from fingerprints in bitsets table.
+
+        Requires 16 bytes of memory for each on bit of all fingerprints.
+
+        Args:
+            connection (sqlite3.Connection): Sqlite connection of fingerprints db
+
+        Returns:
+            FingerprintsIndex
+        """
+        cursor = connection.cursor()
+        cls.drop(cursor)
+        cursor.execute('''CREATE TABLE index_fragments (
+            frag_idx INTEGER PRIMARY KEY,
+            frag_id TEXT,
+            popcount INT
+        )''')
+        cursor.execute('''CREATE TABLE index_postings (
+            bit INTEGER PRIMARY KEY,
+            frag_idxs BLOB
+        )''')
+
+        fragments = []
+        bits = []
+        for frag_idx, (frag_id, bitset) in enumerate(cursor.execute('SELECT frag_id, bitset FROM bitsets ORDER BY rowid')):
+            fragments.append((frag_idx, frag_id, len(bitset)))
+            bits.append(np.fromiter(bitset, dtype=np.uint32, count=len(bitset)))
+
+        if bits:
+            all_bits = np.concatenate(bits)
+        else:
+            all_bits = np.zeros(0, dtype=np.uint32)
+        all_frag_idxs = np.repeat(np.arange(len(fragments), dtype=np.uint32), [f[2] for f in fragments])
+        # stable sort, so fragments stay in order within each posting
+        order = np.argsort(all_bits, kind='mergesort')
+        all_bits = all_bits[order]
+        all_frag_idxs = all_frag_idxs[order]
+        del order
+        unique_bits, starts = np.unique(all_bits, return_index=True)
+        stops = np.append(starts[1:], len(all_bits))
+        postings = ((int(bit), adapt_posting(all_frag_idxs[start:stop]))
+                    for bit, start, stop in six.moves.zip(unique_bits, starts, stops))
+
+        with FastInserter(cursor):
+            cursor.executemany('INSERT INTO index_fragments (frag_idx, frag_id, popcount) VALUES (?, ?, ?)', fragments)
+            cursor.executemany('INSERT INTO index_postings (bit, frag_idxs) VALUES (?, ?)', postings)
+
+        return cls(connection)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def intersection_cardinalities(self, bitset):
+        """Count bits query has in common with each fingerprint
+
+        Args:
+            bitset (pyroaring.BitMap): Query fingerprint
+
+        Returns:
+            np.ndarray: Number of common bits for each fragment index identifier
+        """
+        counts = np.zeros(len(self.labels), dtype=np.int64)
+        bits = list(bitset)
+        for start in six.moves.range(0, len(bits), self.max_bits_per_select):
+            chunk = bits[start:start + self.max_bits_per_select]
+            sql = self.select_postings_sql.format(','.join('?' * len(chunk)))
+            for row in self.cursor.execute(sql, chunk):
+                # fragment occurs only once in a posting, so no need for np.add.at
+                counts[convert_posting(row[0])] += 1
+        return counts
+
+    def similar(self, bitset, number_of_bits, corr_st, corr_sto, cutoff):
+        """Find fingerprints similar to query fingerprint
+
+        Args:
+            bitset (pyroaring.BitMap): Query fingerprint
+            number_of_bits (int): Number of bits for all fingerprints
+            corr_st (float): St correction
+            corr_sto (float): Sto correction
+            cutoff (float): Cutoff, similarity scores below cutoff are discarded.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Fragment index identifiers and similarity scores of hits
+        """
+        if not len(self.labels):
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        a = len(bitset)
+        c = self.intersection_cardinalities(bitset)
+        # fragments without common bits can only reach cutoff with S_T0, which is highest for the smallest fingerprint
+        if modified_tanimoto(a, self.popcounts.min(), 0, number_of_bits, corr_st, corr_sto) >= cutoff:
+            candidates = np.arange(len(self.labels))
+        else:
+            candidates = c.nonzero()[0]
+        scores = modified_tanimoto(a, self.popcounts[candidates], c[candidates], number_of_bits, corr_st, corr_sto)
+        mask = scores >= cutoff
+        return candidates[mask], scores[mask]
+
+    def similarities(self, bitsets1, number_of_bits, corr_st, corr_sto, cutoff, ignore_upper_triangle=False,
+                     top=None):
+        """Calculate modified tanimoto similarity between fingerprints and the indexed fingerprints
+
+        Same as :func:`kripodb.modifiedtanimoto.similarities` with the indexed fingerprints as second collection.
+
+        Args:
+            bitsets1 (Dict{str, pyroaring.BitMap}): Dict of fingerprints
+                with fingerprint label as key and pyroaring.BitMap as value
+            number_of_bits (int): Number of bits for all fingerprints
+            corr_st (float): St correction
+            corr_sto (float): Sto correction
+            cutoff (float): Cutoff, similarity scores below cutoff are discarded.
+            ignore_upper_triangle (Optional[bool]): When true returns similarity where label1 > label2,
+                when false returns all similarities
+            top (Optional[int]): Maximum number of hits for each fingerprint of bitsets1,
+                hits are then sorted on similarity score with highest score first. Default is None for no limit.
+
+        Yields:
+            (fingerprint label 1, fingerprint label2, similarity score)
+
+        Raises:
+            ValueError: When top is below 1
+        """
+        if top is not None and top < 1:
+            raise ValueError('Top must be at least 1, got {0}'.format(top))
+        for label1, bitset in six.iteritems(bitsets1):
+            hits, scores = self.similar(bitset, number_of_bits, corr_st, corr_sto, cutoff)
+            hit_labels = self.labels_array[hits]
+            # always skip self
+            mask = hit_labels != label1
+            if ignore_upper_triangle:
+                mask &= hit_labels >= label1
+            hits = hits[mask]
+            scores = scores[mask]
+            if top is not None:
+                best = np.argsort(-scores, kind='mergesort')[:top]
+                hits = hits[best]
+                scores = scores[best]
+            for frag_idx, score in six.moves.zip(hits, scores):
+                yield label1, self.labels[frag_idx], float(score)
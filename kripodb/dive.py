@@ -4,7 +4,7 @@ import logging
 import math
 from os.path import basename
 
-from progressbar import ProgressBar
+import numpy as np
 from rdkit.Chem.Descriptors import HeavyAtomMolWt
 import six
 
@@ -252,7 +252,8 @@ def dense_dump(inputfile, outputfile, frag1only):
     matrix = FrozenSimilarityMatrix(inputfile)
     writer = csv.writer(outputfile, delimiter='\t', lineterminator='\n')
     writer.writerow(['frag_id1', 'frag_id2', 'score'])
-    writer.writerows(dense_dump_iter(matrix, frag1only))
+    for labels1, labels2, scores in dense_dump_blocks(matrix, frag1only):
+        outputfile.write(''.join(['{0}\t{1}\t{2!r}\n'.format(*row) for row in zip(labels1, labels2, scores)]))
     matrix.close()
 
 
@@ -266,19 +267,24 @@ def dense_dump_iter(matrix, frag1only):
     Yields:
         (str, str, float): Fragment label pair and score
     """
-    completed_frags = set()
-    bar = ProgressBar()
-    labels = [v.decode() for v in matrix.labels]
-    for row_label in bar(labels):
-        if frag1only and not row_label.endswith('frag1'):
-            continue
-        completed_frags.add(row_label)
-        cols = matrix[row_label]
-        for (col_label, score) in cols:
-            if frag1only and not col_label.endswith('frag1'):
-                continue
-            if col_label in completed_frags:
-                continue
-            if not score:
-                continue
-            yield (row_label, col_label, score)
+    for labels1, labels2, scores in dense_dump_blocks(matrix, frag1only):
+        for row in zip(labels1, labels2, scores):
+            yield row
+
+
+def dense_dump_blocks(matrix, frag1only):
+    """Iterate dense matrix with zeros, a block of rows at a time
+
+    Args:
+        matrix (FrozenSimilarityMatrix): Dense similarity matrix
+        frag1only (bool): True to iterate over \*frag1 only
+
+    Yields:
+        (list[str], list[str], list[float]): Fragment labels of pairs and their scores
+    """
+    labels = matrix.cache_labels
+    mask = None
+    if frag1only:
+        mask = np.char.endswith(labels.astype(str), 'frag1')
+    for row_ids, col_ids, raw_scores in matrix.iter_pair_blocks(upper_triangle=True, mask=mask):
+        yield labels[row_ids].tolist(), labels[col_ids].tolist(), matrix.score_codec.decode(raw_scores).tolist()
@@ -13,7 +13,12 @@
 # limitations under the License.
 """Similarity matrix using pytables carray"""
 from __future__ import absolute_import, print_function
-from math import log10, ceil, floor
+from contextlib import contextmanager
+from itertools import islice
+from math import ceil
+import os
+import shutil
+import tempfile
 
 try:
     # for Python >3.3
@@ -23,12 +28,361 @@ except ImportError:
 import numpy as np
 import pandas as pd
 from progressbar import ProgressBar
-from scipy.sparse import coo_matrix
+from scipy.sparse import csc_matrix, csr_matrix
 import six
 import tables
 
+from .cache import RowCache
+from .hdf5 import SimilarityMatrix
 
-class FrozenSimilarityMatrix(object):
+
+class Uint16ScoreCodec(object):
+    """Stores score as 16 bit unsigned integer, the fraction of 2**16-1
+
+    Decoded scores are rounded up to 4 decimals.
+    """
+    name = 'uint16'
+    dtype = np.uint16
+    atom = tables.UInt16Atom()
+    precision = 2**16-1
+    decimals = 4
+
+    def encode(self, scores):
+        """Encode similarity scores
+
+        Args:
+            scores (np.ndarray): Similarity scores between 0 and 1
+
+        Returns:
+            np.ndarray: Raw scores
+        """
+        return (np.asarray(scores) * self.precision).astype(self.dtype)
+
+    def encode_raw(self, raw_scores, precision):
+        """Encode raw scores of another precision, like the scores in a pairs file
+
+        Args:
+            raw_scores (np.ndarray): Raw scores
+            precision (int): Raw score which represents a similarity of 1
+
+        Returns:
+            np.ndarray: Raw scores
+        """
+        if precision == self.precision:
+            return raw_scores.astype(self.dtype)
+        return self.encode(raw_scores / float(precision))
+
+    def decode_raw(self, raw_scores, precision):
+        """Decode raw scores into raw scores of another precision, like the scores in a pairs file
+
+        Args:
+            raw_scores (np.ndarray): Raw scores
+            precision (int): Raw score which represents a similarity of 1
+
+        Returns:
+            np.ndarray: Raw scores of other precision
+        """
+        if precision == self.precision:
+            return raw_scores
+        # epsilon so a score is not truncated to the step below due to floating point error
+        return (self.fractions(raw_scores) * precision + 1e-6).astype(np.uint16)
+
+    def fractions(self, raw_scores):
+        """Unrounded similarity scores of raw scores"""
+        return raw_scores / float(self.precision)
+
+    def decode(self, raw_scores, decimals=None):
+        """Decode raw scores
+
+        Args:
+            raw_scores (np.ndarray): Raw scores
+            decimals (int): Number of decimals to round up to, None for default of codec
+
+        Returns:
+            np.ndarray: Similarity scores
+        """
+        precision10 = float(10 ** (self.decimals if decimals is None else decimals))
+        return np.ceil(precision10 * raw_scores / float(self.precision)) / precision10
+
+    def raw_cutoff(self, cutoff):
+        """Lowest raw score of a score which is equal to or above cutoff"""
+        return int(cutoff * self.precision)
+
+    def add(self, raw_scores1, raw_scores2):
+        """Raw scores of the sum of the scores of two raw scores
+
+        Args:
+            raw_scores1 (np.ndarray): Raw scores
+            raw_scores2 (np.ndarray): Raw scores
+
+        Returns:
+            np.ndarray: Raw scores
+        """
+        return (raw_scores1 + raw_scores2).astype(self.dtype)
+
+    def store(self, attrs):
+        """Record codec in attributes of hdf5 node"""
+        attrs.score_codec = self.name
+
+
+class Uint8ScoreCodec(Uint16ScoreCodec):
+    """Stores score as 8 bit unsigned integer, scores between `min_score` and 1 in 255 steps
+
+    Scores below `min_score` are stored as zero.
+    A raw score of r represents `min_score + (r - 1) * (1 - min_score) / 254`,
+    so a stored score is at most (1 - min_score) / 254, 0.0022 for a min_score of 0.45, below the original score.
+    Decoded scores are rounded to 4 decimals.
+
+    Args:
+        min_score (float): Lowest score that can be stored
+    """
+    name = 'uint8'
+    dtype = np.uint8
+    atom = tables.UInt8Atom()
+    precision = 2**8-1
+
+    def __init__(self, min_score=0.45):
+        self.min_score = float(min_score)
+        self.step = (1.0 - self.min_score) / (self.precision - 1)
+
+    def encode(self, scores):
+        scores = np.asarray(scores, dtype=np.float64)
+        # epsilon so a score on the edge of a step is not put in the step below due to floating point error
+        steps = np.floor((scores - self.min_score) / self.step + 1e-9) + 1
+        raw_scores = np.where(scores >= self.min_score - 1e-9, np.clip(steps, 1, self.precision), 0)
+        return raw_scores.astype(self.dtype)
+
+    def fractions(self, raw_scores):
+        raw_scores = np.asarray(raw_scores, dtype=np.float64)
+        return np.where(raw_scores > 0, self.min_score + (raw_scores - 1) * self.step, 0.0)
+
+    def decode(self, raw_scores, decimals=None):
+        return np.round(self.fractions(raw_scores), self.decimals if decimals is None else decimals)
+
+    def raw_cutoff(self, cutoff):
+        if cutoff <= self.min_score:
+            return 1
+        return int(ceil((cutoff - self.min_score) / self.step - 1e-9)) + 1
+
+    def add(self, raw_scores1, raw_scores2):
+        # raw scores are not proportional to scores, so add the scores
+        return self.encode(self.fractions(raw_scores1) + self.fractions(raw_scores2))
+
+    def store(self, attrs):
+        attrs.score_codec = self.name
+        attrs.score_min = self.min_score
+
+
+def _sum_groups(raw_scores, starts):
+    """Sums of groups of consecutive raw scores, as 64 bit integers so they do not overflow
+
+    Args:
+        raw_scores (np.ndarray): Raw scores proportional to scores, like the scores in a pairs file
+        starts (np.ndarray): Index of first raw score of each group
+
+    Returns:
+        np.ndarray: Sum of raw scores of each group
+    """
+    raw_scores = raw_scores.astype(np.int64)
+    if len(starts) == len(raw_scores):
+        return raw_scores
+    return np.add.reduceat(raw_scores, starts)
+
+
+def load_score_codec(attrs):
+    """Score codec recorded in attributes of hdf5 node
+
+    Args:
+        attrs (tables.AttributeSet): Attributes of hdf5 node
+
+    Returns:
+        Uint16ScoreCodec|Uint8ScoreCodec: Codec, when nothing is recorded the 16 bit codec
+    """
+    if 'score_codec' in attrs and attrs.score_codec == Uint8ScoreCodec.name:
+        return Uint8ScoreCodec(attrs.score_min)
+    return Uint16ScoreCodec()
+
+
+@contextmanager
+def blosc_threads(threads):
+    """Compress and decompress with a number of blosc threads within context, restores previous number afterwards
+
+    Args:
+        threads (int|None): Number of blosc threads, None to keep the current number
+    """
+    if threads is None:
+        yield
+        return
+    previous = tables.set_blosc_max_threads(threads)
+    try:
+        yield
+    finally:
+        tables.set_blosc_max_threads(previous)
+
+
+class TopNeighbors(object):
+    """Top neighbors of each fragment of a frozen similarity matrix stored in the same hdf5 file.
+
+    For each fragment its hits with a score of at least `cutoff` are stored,
+    sorted on score with highest score first and then on fragment id.
+    At most `top` hits are stored for each fragment.
+    The hits of fragment `i` are `ids[indptr[i]:indptr[i + 1]]` with
+    raw scores `scores[indptr[i]:indptr[i + 1]]`.
+
+    Args:
+        h5file (tables.File): Object representing an open hdf5 file
+        score_codec (Uint16ScoreCodec|Uint8ScoreCodec): Codec of the raw scores
+
+    Raises:
+        LookupError: When hdf5 file has no top neighbors
+
+    Attributes:
+        indptr (np.ndarray): Offset of the hits of each fragment identifier
+        ids (tables.EArray): Fragment identifier of hits
+        scores (tables.EArray): Raw score of hits
+        cutoff (float): Hits below cutoff are not stored
+        top (int|None): Maximum number of hits stored for each fragment, None for no maximum
+
+    """
+    group_name = 'top_neighbors'
+    filters = tables.Filters(complevel=6, complib='blosc')
+
+    def __init__(self, h5file, score_codec):
+        if not self.exists(h5file):
+            raise LookupError('No top neighbors found, build them first')
+        group = h5file.get_node('/', self.group_name)
+        # offsets are small compared to hits, keep them in memory so a find only reads hits
+        self.indptr = group.indptr.read()
+        self.ids = group.ids
+        self.scores = group.scores
+        self.cutoff = group._v_attrs.cutoff
+        self.top = group._v_attrs.top or None
+        self.score_codec = score_codec
+
+    @classmethod
+    def exists(cls, h5file):
+        return cls.group_name in h5file.root
+
+    @classmethod
+    def drop(cls, h5file):
+        if cls.exists(h5file):
+            h5file.remove_node('/', cls.group_name, recursive=True)
+
+    @classmethod
+    def build(cls, h5file, matrix, cutoff=0.45, top=1000):
+        """Build top neighbors of frozen similarity matrix.
+
+        Args:
+            h5file (tables.File): Object representing an open hdf5 file
+            matrix (FrozenSimilarityMatrix): Matrix to build top neighbors of
+            cutoff (float): Hits below cutoff are not stored
+            top (int|None): Maximum number of hits stored for each fragment, None for no maximum
+
+        Returns:
+            TopNeighbors
+        """
+        score_codec = matrix.score_codec
+        scutoff = score_codec.raw_cutoff(cutoff)
+        nr_frags = len(matrix.cache_i2l)
+        group = h5file.create_group('/', cls.group_name, 'Top neighbors of each fragment')
+        group._v_attrs.cutoff = cutoff
+        group._v_attrs.top = top or 0
+        ids = h5file.create_earray(group, 'ids', atom=tables.UInt32Atom(), shape=(0,), filters=cls.filters)
+        scores = h5file.create_earray(group, 'scores', atom=score_codec.atom, shape=(0,), filters=cls.filters)
+        lengths = np.zeros(nr_frags, dtype=np.int64)
+        bar = ProgressBar(max_value=nr_frags)
+        for frag_id, row in enumerate(matrix._iter_rows()):
+            hit_ids, raw_scores = matrix._sorted_hits(row, scutoff, top)
+            ids.append(hit_ids.astype(np.uint32))
+            scores.append(raw_scores)
+            lengths[frag_id] = len(hit_ids)
+            bar.update(frag_id + 1)
+        bar.finish()
+        indptr = np.zeros(nr_frags + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        h5file.create_earray(group, 'indptr', obj=indptr, filters=cls.filters)
+        h5file.flush()
+        return cls(h5file, score_codec)
+
+    def find(self, frag_id, scutoff, limit=None):
+        """Find hits of fragment with a raw score of at least scutoff.
+
+        Args:
+            frag_id (int): Query fragment identifier
+            scutoff (int): Raw score cutoff, must not be below the raw score of the cutoff of the top neighbors
+            limit (int): Maximum number of hits. Default is None for no limit.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]|None: Fragment identifiers of hits and their raw scores
+                or None when more hits could be requested than are stored for the fragment
+        """
+        start, stop = self.indptr[frag_id:frag_id + 2]
+        scores = self.scores[start:stop]
+        # hits are sorted on rounded score, so binary search the range of hits with same rounded score as cutoff
+        precision10 = 10 ** self.score_codec.decimals
+        rounded = -np.round(self.score_codec.decode(scores) * precision10)
+        rounded_cutoff = -np.round(self.score_codec.decode(scutoff) * precision10)
+        first = np.searchsorted(rounded, rounded_cutoff, side='left')
+        last = np.searchsorted(rounded, rounded_cutoff, side='right')
+        # within that range raw scores can be below cutoff
+        above = np.ones(last, dtype=bool)
+        above[first:last] = scores[first:last] >= scutoff
+        selected = np.flatnonzero(above)[:limit]
+
+        truncated = self.top is not None and len(scores) >= self.top
+        if truncated and last == len(scores) and (limit is None or len(selected) < limit):
+            # hits which are not stored could be above cutoff and be requested
+            return None
+        ids = self.ids[start:start + (selected[-1] + 1 if len(selected) else 0)]
+        return ids[selected], scores[selected]
+
+
+class AbstractFrozenSimilarityMatrix(object):
+    """Abstract frozen similarity matrix stored in a hdf5 file
+
+    Attributes:
+        h5file (tables.File): Object representing an open hdf5 file
+        labels (tables.CArray): Table to look up label of fragment by id or id of fragment by label
+        score_codec (Uint16ScoreCodec|Uint8ScoreCodec): Codec to encode and decode scores
+
+    """
+    filters = tables.Filters(complevel=6, complib='blosc', shuffle=True)
+
+    def close(self):
+        """Closes the hdf5file"""
+        self.h5file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _all_labels(self):
+        """Labels of all fragments ordered on fragment identifier"""
+        return [v.decode() for v in self.labels]
+
+    def build_label_cache(self):
+        labels = self._all_labels()
+        self.cache_i2l = dict(enumerate(labels))
+        self.cache_l2i = {v: k for k, v in self.cache_i2l.items()}
+        self.cache_labels = np.array(labels, dtype=object)
+
+    def _count_items(self, counts, raw_score):
+        """Convert counts of each raw score into score and number of occurrences pairs, skipping zero counts"""
+        if raw_score:
+            for raw_score in counts.nonzero()[0]:
+                yield (raw_score, counts[raw_score])
+        else:
+            # Convert int score into fraction, with one decimal more than find
+            decimals = self.score_codec.decimals + 1
+            for raw_score in counts.nonzero()[0]:
+                score = float(self.score_codec.decode(raw_score, decimals))
+                count = counts[raw_score]
+                yield (score, count)
+
+
+class FrozenSimilarityMatrix(AbstractFrozenSimilarityMatrix):
     """Frozen similarities matrix
 
     Can retrieve whole column of a specific row fairly quickly.
@@ -57,44 +411,99 @@ class FrozenSimilarityMatrix(object):
     >>> %timeit -n1 [list(dm.find(v, 0.45, None)) for v in ids]
     ... 1 loop, best of 3: 29.7 s per loop
 
+    The scores can also be stored uncompressed in a sidecar ``.npy`` file next to the hdf5 file, the raw layout.
+    The raw scores are opened with :func:`numpy.load` as a memory map,
+    so rows are read straight from the OS page cache and
+    processes reading the same matrix share a single copy of it in memory.
+
+    The scores are stored as 16 bit integers or,
+    to halve the size of the matrix, as 8 bit integers with :class:`Uint8ScoreCodec`.
+    The codec is recorded in the file and decoding is transparent.
+
+    Fragments can be added to an existing matrix with :meth:`extend`.
+    Their scores are stored in a sparse delta segment which is merged with the rows of the matrix when reading.
+
+    Rows read by :meth:`find` and :meth:`__getitem__` can be kept in a least recently used cache,
+    so repeated queries for the same fragment do not read and decompress its row again.
+
     Args:
         filename (str): File name of hdf5 file to write or read similarity matrix from
         mode (str): Can be 'r' for reading or 'w' for writing
+        raw (bool): When writing, store scores in a memory-mappable sidecar file instead of in the hdf5 file.
+            When reading, the layout is detected.
+        score_codec (Uint16ScoreCodec|Uint8ScoreCodec): When writing, codec to store scores with,
+            default is 16 bit. When reading, the codec is detected.
+        row_cache_size (int): Maximum number of bytes of rows to cache, default is 0 for no cache
         **kwargs: Passed though to tables.open_file()
 
     Attributes:
         h5file (tables.File): Object representing an open hdf5 file
-        scores (tables.CArray): HDF5 Table that contains matrix
+        scores (tables.CArray|numpy.memmap): HDF5 Table or memory map that contains matrix
         labels (tables.CArray): Table to look up label of fragment by id or id of fragment by label
+        delta (scipy.sparse.csr_matrix|None): Scores of fragments added with :meth:`extend`
+        top_neighbors (TopNeighbors|None): Top neighbors of each fragment, build with :meth:`build_top_neighbors`
+        score_codec (Uint16ScoreCodec|Uint8ScoreCodec): Codec to encode and decode scores
+        row_cache (RowCache): Cache of rows, with hit, miss and eviction counters
 
     """
-    filters = tables.Filters(complevel=6, complib='blosc', shuffle=True)
-
-    def __init__(self, filename, mode='r', **kwargs):
+    def __init__(self, filename, mode='r', raw=False, score_codec=None, row_cache_size=0, **kwargs):
         self.h5file = tables.open_file(filename, mode, filters=self.filters, **kwargs)
-        self.score_precision = 2**16-1
+        if 'score_codec' in self.h5file.root._v_attrs or score_codec is None:
+            score_codec = load_score_codec(self.h5file.root._v_attrs)
+        self.score_codec = score_codec
+        self.score_precision = score_codec.precision
+        self.raw = raw
         if 'labels' in self.h5file.root:
             self.labels = self.h5file.root.labels
         else:
             self.labels = None
         if 'scores' in self.h5file.root:
             self.scores = self.h5file.root.scores
+        elif 'raw_scores' in self.h5file.root._v_attrs:
+            self.raw = True
+            mmap_mode = 'r' if mode == 'r' else 'r+'
+            raw_fn = os.path.join(os.path.dirname(filename), self.h5file.root._v_attrs.raw_scores)
+            self.scores = np.load(raw_fn, mmap_mode=mmap_mode)
         else:
             self.scores = None
         self.cache_i2l = {}
         self.cache_l2i = {}
+        self.cache_labels = np.array([], dtype=object)
+        self.delta = None
+        if 'delta' in self.h5file.root:
+            self._load_delta()
         if self.labels is not None:
             self.build_label_cache()
+        self.top_neighbors = None
+        if TopNeighbors.exists(self.h5file):
+            self.top_neighbors = TopNeighbors(self.h5file, self.score_codec)
+        self.row_cache = RowCache(row_cache_size)
 
-    def close(self):
-        """Closes the hdf5file"""
-        self.h5file.close()
+    @staticmethod
+    def is_frozen(h5file):
+        """Whether hdf5 file contains a dense frozen similarity matrix
 
-    def __enter__(self):
-        return self
+        Args:
+            h5file (tables.File): Object representing an open hdf5 file
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.close()
+        Returns:
+            bool
+        """
+        return 'scores' in h5file.root or 'raw_scores' in h5file.root._v_attrs
+
+    def raw_scores_filename(self):
+        """File name of sidecar file with the raw scores
+
+        Returns:
+            str: Hdf5 file name with extension replaced by `.scores.npy`
+        """
+        return os.path.splitext(self.h5file.filename)[0] + '.scores.npy'
+
+    def close(self):
+        """Closes the hdf5file"""
+        if isinstance(self.scores, np.memmap) and self.scores.mode != 'r':
+            self.scores.flush()
+        super(FrozenSimilarityMatrix, self).close()
 
     def find(self, query, cutoff, limit=None):
         """Find similar fragments to query.
@@ -105,20 +514,82 @@ class FrozenSimilarityMatrix(object):
             limit (int): Maximum number of hits. Default is None for no limit.
 
         Returns:
-            list[tuple[str,float]]: Hit fragment identifier and similarity score
+            list[tuple[str,float]]: Hit fragment identifier and similarity score,
+                rounded to 4 decimals and as precise as the score codec of the matrix
         """
-        precision = float(self.score_precision)
-        precision10 = float(10**(floor(log10(precision))))
-        scutoff = int(cutoff * precision)
+        scutoff = self.score_codec.raw_cutoff(cutoff)
         query_id = self.cache_l2i[query]
-        subjects = self.h5file.root.scores[query_id, ...]
-        filled_subjects_ids = subjects.nonzero()[0]
-        filled_subjects = [(i, subjects[i]) for i in filled_subjects_ids]
-        hits = [(self.cache_i2l[k], ceil(precision10 * v / precision) / precision10) for k, v in filled_subjects if v >= scutoff]
-        sorted_hits = sorted(hits,  key=lambda r: r[1], reverse=True)
-        if limit is not None:
-            sorted_hits = sorted_hits[:limit]
-        return sorted_hits
+        hits = None
+        if self.top_neighbors is not None and cutoff >= self.top_neighbors.cutoff:
+            hits = self.top_neighbors.find(query_id, scutoff, limit)
+        if hits is None:
+            hits = self._sorted_hits(self._row(query_id), scutoff, limit)
+        return self._labelled_hits(*hits)
+
+    def find_many(self, queries, cutoff, limit=None, read_size=2**27):
+        """Find similar fragments to each query.
+
+        The rows of the queries are read sorted on fragment identifier,
+        adjacent rows and rows in the same chunk are read with a single slice.
+
+        Args:
+            queries (list[str]): Query fragment identifiers
+            cutoff (float): Cutoff, similarity scores below cutoff are discarded.
+            limit (int): Maximum number of hits of each query. Default is None for no limit.
+            read_size (int): Maximum number of bytes of rows read at once
+
+        Returns:
+            list[list[tuple[str,float]]]: Hit fragment identifiers and similarity scores of each query,
+                in same order as queries and like :meth:`find`
+
+        Raises:
+            KeyError: When a query can not be found
+        """
+        scutoff = self.score_codec.raw_cutoff(cutoff)
+        query_ids = [self.cache_l2i[query] for query in queries]
+        hits = {}
+        missing = []
+        for query_id in sorted(set(query_ids)):
+            if self.top_neighbors is not None and cutoff >= self.top_neighbors.cutoff:
+                hits[query_id] = self.top_neighbors.find(query_id, scutoff, limit)
+            if hits.get(query_id) is None:
+                missing.append(query_id)
+        for query_id, row in self._rows(missing, read_size):
+            hits[query_id] = self._sorted_hits(row, scutoff, limit)
+        return [self._labelled_hits(*hits[query_id]) for query_id in query_ids]
+
+    def _labelled_hits(self, hit_ids, raw_scores):
+        labels = self.cache_labels[hit_ids].tolist()
+        scores = self.score_codec.decode(raw_scores).tolist()
+        return list(zip(labels, scores))
+
+    def _sorted_hits(self, subjects, scutoff, limit=None):
+        precision10 = float(10**self.score_codec.decimals)
+        hit_ids = np.flatnonzero((subjects >= scutoff) & (subjects > 0))
+        rounded_scores = np.round(self.score_codec.decode(subjects[hit_ids]) * precision10)
+        # order on highest score first and then on fragment id, as ids are unique the order is total
+        order_key = hit_ids - rounded_scores.astype(np.int64) * len(subjects)
+        if limit is not None and limit < len(order_key):
+            top = np.argpartition(order_key, limit)[:limit]
+            order = top[np.argsort(order_key[top])]
+        else:
+            order = np.argsort(order_key)
+        hit_ids = hit_ids[order]
+        return hit_ids, subjects[hit_ids]
+
+    def build_top_neighbors(self, cutoff=0.45, top=1000):
+        """Store top neighbors of each fragment, so find does not need to read and sort a whole row.
+
+        Find uses the top neighbors when its cutoff is equal to or above the cutoff of the top neighbors
+        and all requested hits are stored.
+        The top neighbors are dropped when the matrix is extended.
+
+        Args:
+            cutoff (float): Hits below cutoff are not stored
+            top (int|None): Maximum number of hits stored for each fragment, None for no maximum
+        """
+        TopNeighbors.drop(self.h5file)
+        self.top_neighbors = TopNeighbors.build(self.h5file, self, cutoff, top)
 
     def __getitem__(self, item):
         """Get all similarities of fragment or the similarity score between to 2 fragments.
@@ -138,29 +609,81 @@ class FrozenSimilarityMatrix(object):
         if isinstance(item, tuple):
             return self._fetch_cell(item[0], item[1])
 
-        precision = float(self.score_precision)
-        precision10 = float(10**(floor(log10(precision))))
         query_id = self.cache_l2i[item]
-        subjects = self.h5file.root.scores[query_id, ...]
-        hits = [(self.cache_i2l[k], ceil(precision10 * v / precision) / precision10) for k, v in enumerate(subjects) if k != query_id]
+        subjects = self.score_codec.decode(self._row(query_id)).tolist()
+        hits = [(self.cache_i2l[k], v) for k, v in enumerate(subjects) if k != query_id]
         return hits
 
     def __iter__(self):
         """
         Yields: Tuple[str, str, float] Fragment id 1, Fragment id 2, similarity score of lower triangle of matrix
         """
-        precision = float(self.score_precision)
-        precision10 = float(10**(floor(log10(precision))))
-        for row_id, row in enumerate(self.h5file.root.scores.iterrows()):
-            row_label = self.cache_i2l[row_id]
-            # loop through raw scores below triangle
-            for col_id, raw_score in enumerate(row[:row_id]):
-                if raw_score == 0:
-                    # skip if below cutoff
+        for labels1, labels2, scores in self.iter_frames():
+            for pair in zip(labels1.tolist(), labels2.tolist(), scores.tolist()):
+                yield pair
+
+    def iter_frames(self, mask=None, read_size=2**27):
+        """Pairs of fragment labels with their similarity score of lower triangle of matrix, a block of rows at a time.
+
+        Args:
+            mask (np.ndarray): Boolean array with a value for each fragment,
+                only pairs of which both fragments are true are yielded. Default is None for all pairs.
+            read_size (int): Maximum number of bytes of rows read at once
+
+        Yields:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: Labels of first and second fragment of pairs and
+                their similarity scores, in same order as iterating the matrix
+        """
+        for row_ids, col_ids, raw_scores in self.iter_pair_blocks(mask=mask, read_size=read_size):
+            yield self.cache_labels[col_ids], self.cache_labels[row_ids], self.score_codec.decode(raw_scores)
+
+    def iter_pair_blocks(self, upper_triangle=False, mask=None, read_size=2**27):
+        """Non-zero scores of lower or upper triangle of matrix, a block of rows at a time.
+
+        Many rows are read at once and the triangle and non-zero scores are selected with NumPy.
+        Within a block the pairs are ordered on row and then on column.
+
+        Args:
+            upper_triangle (bool): When true yield scores from upper triangle else from lower triangle
+            mask (np.ndarray): Boolean array with a value for each fragment,
+                only pairs of which both fragments are true are yielded. Default is None for all pairs.
+            read_size (int): Maximum number of bytes of rows read at once
+
+        Yields:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: Row fragment identifiers, column fragment identifiers
+                and raw scores of the pairs in a block of rows
+        """
+        nr_frags = len(self.cache_labels)
+        nr_frozen = self.scores.shape[0]
+        block_size = max(1, read_size // (nr_frags * np.dtype(self.score_codec.dtype).itemsize))
+        for start in six.moves.range(0, nr_frags, block_size):
+            stop = min(start + block_size, nr_frags)
+            row_ids = np.arange(start, stop)
+            if mask is not None:
+                row_ids = row_ids[mask[start:stop]]
+                if len(row_ids) == 0:
                     continue
-                col_label = self.cache_i2l[col_id]
-                score = ceil(precision10 * raw_score / precision) / precision10
-                yield col_label, row_label, score
+            if self.delta is None:
+                block = self.scores[start:stop]
+            else:
+                block = np.zeros((stop - start, nr_frags), dtype=self.score_codec.dtype)
+                block[:max(0, nr_frozen - start), :nr_frozen] = self.scores[start:min(stop, nr_frozen)]
+                # scores in delta replace scores of frozen matrix
+                delta = self.delta[start:stop].tocoo()
+                block[delta.row, delta.col] = delta.data
+            # only columns which can be in the triangle
+            first_col, last_col = (start + 1, nr_frags) if upper_triangle else (0, stop - 1)
+            block = block[row_ids - start, first_col:last_col]
+            col_ids = np.arange(first_col, last_col)
+            if upper_triangle:
+                selected = col_ids[np.newaxis, :] > row_ids[:, np.newaxis]
+            else:
+                selected = col_ids[np.newaxis, :] < row_ids[:, np.newaxis]
+            selected &= block != 0
+            if mask is not None:
+                selected &= mask[np.newaxis, first_col:last_col]
+            rows, cols = np.nonzero(selected)
+            yield row_ids[rows], col_ids[cols], block[rows, cols]
 
     def _fetch_cell(self, frag_label1, frag_label2):
         frag_id1 = self.cache_l2i[frag_label1]
@@ -169,16 +692,195 @@ class FrozenSimilarityMatrix(object):
         if frag_id1 == frag_id2:
             return 1.0
 
-        raw_score = self.h5file.root.scores[frag_id1, frag_id2]
-        precision = float(self.score_precision)
-        precision10 = float(10**(floor(log10(precision))))
-        return ceil(precision10 * raw_score / precision) / precision10
+        if self.delta is None:
+            raw_score = self.scores[frag_id1, frag_id2]
+        else:
+            raw_score = self._row(frag_id1)[frag_id2]
+        return float(self.score_codec.decode(raw_score))
 
-    def build_label_cache(self):
-        self.cache_i2l = {k: v.decode() for k, v in enumerate(self.labels)}
-        self.cache_l2i = {v: k for k, v in self.cache_i2l.items()}
+    def _row(self, frag_id):
+        if not self.row_cache.max_bytes:
+            return self._read_row(frag_id)
+        row = self.row_cache.get(frag_id)
+        if row is None:
+            row = self._read_cached_row(frag_id)
+        return row
+
+    def _rows(self, frag_ids, read_size=2**27):
+        """Rows of sorted fragment identifiers with coalesced reads
+
+        Args:
+            frag_ids (list[int]): Sorted unique fragment identifiers
+            read_size (int): Maximum number of bytes of rows read at once
+
+        Yields:
+            Tuple[int, np.ndarray]: Fragment identifier and its raw scores
+        """
+        to_read = []
+        for frag_id in frag_ids:
+            row = self.row_cache.get(frag_id) if self.row_cache.max_bytes else None
+            if row is None:
+                to_read.append(frag_id)
+            else:
+                yield frag_id, row
+
+        nr_frozen = self.scores.shape[0]
+        max_rows = max(1, read_size // (self.scores.shape[1] * self.scores.dtype.itemsize))
+        # rows in between which are in the same chunk are decompressed anyway, so read them along
+        gap = self.scores.chunkshape[0] if isinstance(self.scores, tables.Leaf) else 1
+        frozen_ids = [frag_id for frag_id in to_read if frag_id < nr_frozen]
+        first = 0
+        while first < len(frozen_ids):
+            last = first + 1
+            while (last < len(frozen_ids) and frozen_ids[last] - frozen_ids[last - 1] <= gap and
+                   frozen_ids[last] - frozen_ids[first] < max_rows):
+                last += 1
+            offset = frozen_ids[first]
+            block = self.scores[offset:frozen_ids[last - 1] + 1]
+            for frag_id in frozen_ids[first:last]:
+                yield frag_id, self._read_cached_row(frag_id, block[frag_id - offset])
+            first = last
+
+        for frag_id in to_read[len(frozen_ids):]:
+            yield frag_id, self._read_cached_row(frag_id)
+
+    def _read_cached_row(self, frag_id, frozen_row=None):
+        row = self._read_row(frag_id, frozen_row)
+        if self.row_cache.max_bytes:
+            row = np.array(row)
+            # cached row is shared between callers, so guard it against modification
+            row.flags.writeable = False
+            self.row_cache.put(frag_id, row, row.nbytes)
+        return row
+
+    def _read_row(self, frag_id, frozen_row=None):
+        nr_frozen = self.scores.shape[0]
+        if frozen_row is None and frag_id < nr_frozen:
+            frozen_row = self.scores[frag_id, ...]
+        if self.delta is None:
+            return frozen_row
+        row = np.zeros(self.delta.shape[1], dtype=self.score_codec.dtype)
+        if frozen_row is not None:
+            row[:nr_frozen] = frozen_row
+        start, stop = self.delta.indptr[frag_id:frag_id + 2]
+        # scores in delta replace scores of frozen matrix
+        row[self.delta.indices[start:stop]] = self.delta.data[start:stop]
+        return row
+
+    def _iter_rows(self):
+        if self.delta is None:
+            return iter(self.scores)
+        return (self._read_row(frag_id) for frag_id in six.moves.range(self.delta.shape[0]))
+
+    def _all_labels(self):
+        labels = super(FrozenSimilarityMatrix, self)._all_labels()
+        if 'delta' in self.h5file.root:
+            labels += [v.decode() for v in self.h5file.root.delta.labels]
+        return labels
+
+    def _load_delta(self):
+        group = self.h5file.root.delta
+        nr_frags = self.scores.shape[0] + len(group.labels)
+        self.delta = csr_matrix((group.scores.read(), group.indices.read(), group.indptr.read()),
+                                shape=(nr_frags, nr_frags))
+
+    def extend(self, new_labels, pairs, frame_size=10**6, threads=None):
+        """Add fragments and their similarity scores to matrix.
+
+        The matrix itself is not rewritten, the scores are stored in a delta segment which is rewritten instead.
+        So the cost is proportional to all extensions since the matrix was frozen.
+
+        The score of a pair replaces the score already in the matrix,
+        when a pair occurs more than once the last score is kept.
+        Labels which are already in the matrix are ignored.
+
+        Args:
+            new_labels (list[str]): Labels of fragments to add
+            pairs (kripodb.hdf5.SimilarityMatrix|Iterable[Tuple[str, str, float]]): Pairs file of which the raw scores
+                are read a frame at a time or iterator which yields (label1, label2, similarity_score)
+            frame_size (int): Number of pairs to read in a single go
+            threads (int|None): Number of blosc threads to compress with, None for current setting. Default is None.
+
+        Raises:
+            KeyError: When a label of a pair is not in matrix and not in new_labels
+
+        """
+        with blosc_threads(threads):
+            TopNeighbors.drop(self.h5file)
+            self.top_neighbors = None
+            self.row_cache.clear()
+            nr_frozen = self.scores.shape[0]
+            new_labels = [label for label in new_labels if label not in self.cache_l2i]
+            labels = self.cache_labels[nr_frozen:].tolist() + new_labels
+            label2id = dict(self.cache_l2i)
+            for label in new_labels:
+                label2id[label] = len(label2id)
+            nr_frags = len(label2id)
 
-    def from_pairs(self, similarity_matrix, frame_size, limit=None, single_sided=False):
+            rows = []
+            cols = []
+            data = []
+            if self.delta is not None:
+                previous = self.delta.tocoo()
+                rows.append(previous.row)
+                cols.append(previous.col)
+                data.append(previous.data)
+            for ids1, ids2, raw_scores in self._iter_extend_frames(pairs, label2id, frame_size):
+                # store both directions next to each other, so the last occurrence of a pair wins in both directions
+                rows.append(np.column_stack((ids1, ids2)).ravel())
+                cols.append(np.column_stack((ids2, ids1)).ravel())
+                data.append(np.repeat(raw_scores, 2))
+            rows = np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+            cols = np.concatenate(cols) if cols else np.empty(0, dtype=np.int64)
+            data = np.concatenate(data) if data else np.empty(0, dtype=self.score_codec.dtype)
+            # keep last score of each cell, lexsort is stable
+            order = np.lexsort((cols, rows))
+            rows, cols, data = rows[order], cols[order], data[order]
+            last = np.ones(len(rows), dtype=bool)
+            last[:-1] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+            delta = csr_matrix((data[last], (rows[last], cols[last])), shape=(nr_frags, nr_frags))
+
+            if 'delta' in self.h5file.root:
+                self.h5file.remove_node('/delta', recursive=True)
+            group = self.h5file.create_group('/', 'delta')
+            label_atom = tables.StringAtom(itemsize=max([len(label.encode()) for label in labels] + [1]))
+            delta_labels = self.h5file.create_earray(group, 'labels', atom=label_atom, shape=(0,),
+                                                     filters=self.filters)
+            delta_labels.append([np.string_(label) for label in labels])
+            self.h5file.create_carray(group, 'indptr', obj=delta.indptr.astype(np.int64), filters=self.filters)
+            indices = self.h5file.create_earray(group, 'indices', atom=tables.UInt32Atom(), shape=(0,),
+                                                filters=self.filters)
+            indices.append(delta.indices.astype(np.uint32))
+            scores = self.h5file.create_earray(group, 'scores', atom=self.score_codec.atom, shape=(0,),
+                                               filters=self.filters)
+            scores.append(delta.data.astype(self.score_codec.dtype))
+            self.h5file.flush()
+
+            self._load_delta()
+            self.build_label_cache()
+
+    def _iter_extend_frames(self, pairs, label2id, frame_size):
+        """Pairs as fragment identifiers of self and raw scores of codec of self, a frame at a time"""
+        if isinstance(pairs, SimilarityMatrix):
+            oid2label = {v: k for k, v in pairs.labels.label2ids().items()}
+            oid2nid = np.zeros(max(oid2label) + 1 if oid2label else 0, dtype=np.int64)
+            for oid, label in oid2label.items():
+                oid2nid[oid] = label2id[label]
+            for ids1, ids2, raw_scores in pairs.pairs.iter_frames(frame_size, raw_score=True):
+                yield oid2nid[ids1], oid2nid[ids2], self.score_codec.encode_raw(raw_scores,
+                                                                                pairs.pairs.score_precision)
+        else:
+            pairs = iter(pairs)
+            while True:
+                frame = list(islice(pairs, frame_size))
+                if not frame:
+                    break
+                labels1, labels2, scores = zip(*frame)
+                yield (np.array([label2id[label] for label in labels1], dtype=np.int64),
+                       np.array([label2id[label] for label in labels2], dtype=np.int64),
+                       self.score_codec.encode(scores))
+
+    def from_pairs(self, similarity_matrix, frame_size, limit=None, single_sided=False, threads=None):
         """Fills self with matrix which is stored in pairs.
 
         Also known as COOrdinate format, the 'ijv' or 'triplet' format.
@@ -188,6 +890,7 @@ class FrozenSimilarityMatrix(object):
             frame_size (int): Number of pairs to append in a single go
             limit (int|None): Number of pairs to add, None for no limit, default is None.
             single_sided (bool): If false add stored direction and reverse direction. Default is False.
+            threads (int|None): Number of blosc threads to compress with, None for current setting. Default is None.
 
 
         time kripodb similarities freeze --limit 200000 -f 100000 data/feb2016/01-01_to_13-13.out.h5 percell.h5
@@ -202,6 +905,113 @@ class FrozenSimilarityMatrix(object):
         12.8m - 4m59s
         25.6m - 7m27s
         """
+        with blosc_threads(threads):
+            nr_frags = len(similarity_matrix.labels)
+            id2nid = self._fill_labels(similarity_matrix)
+
+            six.print_('Filling matrix')
+            self._create_scores(nr_frags)
+            if limit is None:
+                limit = len(similarity_matrix.pairs)
+
+            self._ingest_pairs(similarity_matrix.pairs, id2nid, frame_size, limit, single_sided)
+            self.h5file.flush()
+
+    def from_pairs_external(self, similarity_matrix, memory, limit=None, single_sided=False, tmpdir=None, threads=None):
+        """Fills self with matrix which is stored in pairs using an external sort.
+
+        The pairs are read in runs which fit in `memory`, sorted on row and written to temporary files.
+        The runs are merged one block of rows at a time, so each row of the matrix is written exactly once.
+
+        Args:
+            similarity_matrix (kripodb.hdf5.SimilarityMatrix):
+            memory (int): Memory budget in bytes for a run or a block of rows
+            limit (int|None): Number of pairs to add, None for no limit, default is None.
+            single_sided (bool): If false add stored direction and reverse direction. Default is False.
+            tmpdir (str|None): Directory in which temporary run files are written, None for system default.
+            threads (int|None): Number of blosc threads to compress with, None for current setting. Default is None.
+
+        """
+        with blosc_threads(threads):
+            nr_frags = len(similarity_matrix.labels)
+            id2nid = self._fill_labels(similarity_matrix)
+            oid2nid = np.zeros(max(id2nid) + 1 if id2nid else 0, dtype=np.uint32)
+            oid2nid[list(id2nid.keys())] = list(id2nid.values())
+
+            self._create_scores(nr_frags)
+            if limit is None:
+                limit = len(similarity_matrix.pairs)
+
+            run_dir = tempfile.mkdtemp(prefix='kripodb-freeze-', dir=tmpdir)
+            try:
+                runs = self._write_runs(similarity_matrix.pairs, oid2nid, memory, limit, single_sided, run_dir)
+                self._merge_runs(runs, memory, similarity_matrix.pairs.score_precision)
+            finally:
+                shutil.rmtree(run_dir)
+            self.h5file.flush()
+
+    def _write_runs(self, pairs_table, oid2nid, memory, limit, single_sided, run_dir):
+        pairs = pairs_table.table
+        # row + col + score, sorted copy and argsort index
+        entry_size = 2 * (4 + 4 + 2) + 8
+        frame_size = max(1, memory // entry_size)
+        if not single_sided:
+            frame_size = max(1, frame_size // 2)
+        runs = []
+        for start in six.moves.range(0, limit, frame_size):
+            stop = min(start + frame_size, limit)
+            six.print_('Sorting pairs {0}:{1} of {2}'.format(start, stop, limit), flush=True)
+            raw_frame = pairs.read(start=start, stop=stop)
+            a = oid2nid[raw_frame['a']]
+            b = oid2nid[raw_frame['b']]
+            # scores are encoded after duplicate pairs are added up in merge
+            scores = raw_frame['score']
+            del raw_frame
+            if single_sided:
+                rows, cols = a, b
+            else:
+                rows, cols, scores = np.concatenate((b, a)), np.concatenate((a, b)), np.concatenate((scores, scores))
+            del a, b
+            order = np.argsort(rows, kind='mergesort')
+            run = []
+            for name, values in (('rows', rows), ('cols', cols), ('scores', scores)):
+                fn = os.path.join(run_dir, 'run{0}.{1}.npy'.format(len(runs), name))
+                np.save(fn, values[order])
+                run.append(fn)
+            runs.append(run)
+        return runs
+
+    def _merge_runs(self, runs, memory, pairs_precision):
+        runs = [[np.load(fn, mmap_mode='r') for fn in run] for run in runs]
+        nr_frags = self.scores.shape[0]
+        # a cell of the block and the run entries which can fill it with their cell index and sort order
+        block_size = max(1, memory // ((2 + 8 + 8 + 2) * nr_frags))
+        bar = ProgressBar(max_value=nr_frags)
+        for first_row in six.moves.range(0, nr_frags, block_size):
+            last_row = min(first_row + block_size, nr_frags)
+            block = np.zeros((last_row - first_row, nr_frags), dtype=self.score_codec.dtype)
+            cells = []
+            scores = []
+            for run_rows, run_cols, run_scores in runs:
+                start, stop = np.searchsorted(run_rows, [first_row, last_row])
+                cells.append((run_rows[start:stop] - first_row).astype(np.int64) * nr_frags + run_cols[start:stop])
+                scores.append(run_scores[start:stop])
+            cells = np.concatenate(cells)
+            scores = np.concatenate(scores)
+            order = np.argsort(cells, kind='mergesort')
+            cells = cells[order]
+            scores = scores[order]
+            # scores of a pair which occurs more than once are added up
+            first = np.ones(len(cells), dtype=bool)
+            first[1:] = cells[1:] != cells[:-1]
+            firsts = np.flatnonzero(first)
+            scores = _sum_groups(scores, firsts)
+            block.ravel()[cells[firsts]] = self.score_codec.encode_raw(scores, pairs_precision)
+            self.scores[first_row:last_row, :] = block
+            bar.update(last_row)
+        bar.finish()
+
+    def _fill_labels(self, similarity_matrix):
         nr_frags = len(similarity_matrix.labels)
 
         six.print_('Filling labels ... ', end='')
@@ -216,17 +1026,21 @@ class FrozenSimilarityMatrix(object):
         self.build_label_cache()
 
         six.print_('Done')
-        six.print_('Filling matrix')
-        self.scores = self.h5file.create_carray('/', 'scores', atom=tables.UInt16Atom(),
-                                                shape=(nr_frags, nr_frags), chunkshape=(1, nr_frags),
-                                                filters=self.filters)
-        if limit is None:
-            limit = len(similarity_matrix.pairs)
+        return id2nid
 
-        self._ingest_pairs(similarity_matrix.pairs.table, id2nid, frame_size, limit, single_sided)
-        self.h5file.flush()
+    def _create_scores(self, nr_frags):
+        self.score_codec.store(self.h5file.root._v_attrs)
+        if self.raw:
+            self.scores = np.lib.format.open_memmap(self.raw_scores_filename(), mode='w+',
+                                                    dtype=self.score_codec.dtype, shape=(nr_frags, nr_frags))
+            self.h5file.root._v_attrs.raw_scores = os.path.basename(self.raw_scores_filename())
+        else:
+            self.scores = self.h5file.create_carray('/', 'scores', atom=self.score_codec.atom,
+                                                    shape=(nr_frags, nr_frags), chunkshape=(1, nr_frags),
+                                                    filters=self.filters)
 
-    def _ingest_pairs(self, pairs, oid2nid, frame_size, limit, single_sided):
+    def _ingest_pairs(self, pairs_table, oid2nid, frame_size, limit, single_sided):
+        pairs = pairs_table.table
         oid2nid_v = np.vectorize(oid2nid.get)
         # whole pairs set does not fit in memory, so split it in frames with `frame_size` number of pairs.
         for start in range(0, limit, frame_size):
@@ -236,7 +1050,7 @@ class FrozenSimilarityMatrix(object):
             raw_frame = pairs.read(start=start, stop=stop)
             t2 = process_time()
             six.print_('{0}s, Parsing ... '.format(int(t2 - t1)), flush=True)
-            frame = self._translate_frame(raw_frame, oid2nid_v, single_sided)
+            frame = self._translate_frame(raw_frame, oid2nid_v, single_sided, pairs_table.score_precision)
             t3 = process_time()
             six.print_('Writing ... '.format(int(t3 - t2)), flush=True)
             # alternate direction, to make use of cached chunks of prev frame
@@ -245,19 +1059,28 @@ class FrozenSimilarityMatrix(object):
             t4 = process_time()
             six.print_('{0}s, Done with {1}:{2} in {3}s'.format(int(t4 - t3), start, stop, int(t4 - t1)), flush=True)
 
-    def _translate_frame(self, raw_frame, oid2nid, single_sided):
+    def _translate_frame(self, raw_frame, oid2nid, single_sided, pairs_precision):
         bar = ProgressBar(max_value=4)
         bar.update(0)
         a = oid2nid(raw_frame['a'])
         bar.update(1)
         b = oid2nid(raw_frame['b'])
         bar.update(2)
-        data = raw_frame['score']
-        nr_frags = len(self.labels)
-        smat = coo_matrix((data, (b, a)), shape=(nr_frags, nr_frags)).tocsc()
+        raw_scores = raw_frame['score']
+        if single_sided:
+            rows, cols = b, a
+        else:
+            rows, cols, raw_scores = np.concatenate((b, a)), np.concatenate((a, b)), np.concatenate((raw_scores, raw_scores))
         bar.update(3)
-        if not single_sided:
-            smat += smat.transpose()
+        # scores of a pair which occurs more than once are added up before they are encoded
+        order = np.lexsort((rows, cols))
+        rows, cols, raw_scores = rows[order], cols[order], raw_scores[order]
+        first = np.ones(len(rows), dtype=bool)
+        first[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+        firsts = np.flatnonzero(first)
+        data = self.score_codec.encode_raw(_sum_groups(raw_scores, firsts), pairs_precision)
+        nr_frags = len(self.labels)
+        smat = csc_matrix((data, (rows[firsts], cols[firsts])), shape=(nr_frags, nr_frags))
         bar.update(4)
         return smat
 
@@ -272,7 +1095,7 @@ class FrozenSimilarityMatrix(object):
                 continue
             current_row = scores[row_idx, ...]
             # write whole column, so chunk compression + shuffle only performed once per row_idx
-            scores[row_idx, ...] = current_row + new_row.toarray()[:, 0]
+            scores[row_idx, ...] = self.score_codec.add(current_row, new_row.toarray()[:, 0])
 
     def to_pandas(self):
         """Pandas dataframe with labelled colums and rows.
@@ -283,31 +1106,32 @@ class FrozenSimilarityMatrix(object):
             pd.DataFrame
 
         """
-        precision = float(self.score_precision)
-        decimals = int(log10(precision))
-        labels = [v.decode() for v in self.labels]
-        df = pd.DataFrame(self.scores.read(), index=labels, columns=labels)
-        df /= precision
-        df = df.round(decimals)
+        if self.delta is None:
+            scores = self.scores[:]
+        else:
+            scores = np.array(list(self._iter_rows()))
+        labels = self.cache_labels.tolist()
+        df = pd.DataFrame(self.score_codec.fractions(scores), index=labels, columns=labels)
+        df = df.round(self.score_codec.decimals)
         return df
 
-    def from_array(self, data, labels):
+    def from_array(self, data, labels, threads=None):
         """Fill matrix from 2 dimensional array
 
         Args:
             data (np.array): 2 dimensional square array with scores
             labels (list): List of labels for each column and row index
+            threads (int|None): Number of blosc threads to compress with, None for current setting. Default is None.
         """
-        labels = [np.string_(d) for d in labels]
-        self.labels = self.h5file.create_carray('/', 'labels', obj=labels, filters=self.filters)
-        self.h5file.flush()
-        self.build_label_cache()
+        with blosc_threads(threads):
+            labels = [np.string_(d) for d in labels]
+            self.labels = self.h5file.create_carray('/', 'labels', obj=labels, filters=self.filters)
+            self.h5file.flush()
+            self.build_label_cache()
 
-        nr_frags = len(labels)
-        self.scores = self.h5file.create_carray('/', 'scores', atom=tables.UInt16Atom(),
-                                                shape=(nr_frags, nr_frags), chunkshape=(1, nr_frags),
-                                                filters=self.filters)
-        self.scores[0:nr_frags, 0:nr_frags] = (data * self.score_precision).astype('uint16')
+            nr_frags = len(labels)
+            self._create_scores(nr_frags)
+            self.scores[0:nr_frags, 0:nr_frags] = self.score_codec.encode(data)
 
     def to_pairs(self, pairs):
         """Copies labels and scores from self to pairs matrix.
@@ -321,10 +1145,10 @@ class FrozenSimilarityMatrix(object):
         pairs.labels.update(self.cache_l2i)
 
         six.print_('copy matrix to pairs', flush=True)
-        limit = self.scores.shape[0]
+        limit = len(self.cache_i2l)
         bar = ProgressBar()
         for query_id in bar(six.moves.range(0, limit)):
-            subjects = self.scores[query_id, ...]
+            subjects = self.score_codec.decode_raw(self._read_row(query_id), pairs.pairs.score_precision)
             filled_subjects_ids = subjects.nonzero()[0]
             filled_subjects = [(query_id, i, subjects[i]) for i in filled_subjects_ids if query_id < i]
             if filled_subjects:
@@ -335,35 +1159,430 @@ class FrozenSimilarityMatrix(object):
 
         Only scores are counted of the upper triangle or lower triangle.
         Zero scores are skipped.
+        Fraction scores are rounded to one decimal more than the scores returned by :meth:`find`.
 
         Args:
             frame_size (int): Dummy argument to force same interface for thawed and frozen matrix
-            raw_score (bool): When true return raw int16 score else fraction score
+            raw_score (bool): When true return raw score of codec else fraction score
             lower_triangle (bool): When true return scores from lower triangle else return scores from upper triangle
 
         Returns:
             Tuple[(str, int)]: Score and number of occurrences
         """
-        nr_rows = self.scores.shape[0]
+        nr_rows = len(self.cache_i2l)
         nr_bins = self.score_precision + 1
         counts = np.zeros(shape=nr_bins, dtype=np.int64)
         bar = ProgressBar()
         for query_id in bar(six.moves.range(0, nr_rows)):
-            if lower_triangle:
+            if self.delta is not None:
+                row = self._read_row(query_id)
+                subjects = row[query_id + 1:] if lower_triangle else row[:query_id + 1]
+            elif lower_triangle:
                 subjects = self.scores[query_id, query_id + 1:]
             else:
                 subjects = self.scores[query_id, :query_id + 1]
             frame_counts = np.bincount(subjects[subjects.nonzero()], minlength=nr_bins)
             counts += frame_counts
 
-        if raw_score:
-            for raw_score in counts.nonzero()[0]:
-                yield (raw_score, counts[raw_score])
-        else:
-            # Convert int score into fraction
-            precision = float(self.score_precision)
-            precision10 = float(10 ** (ceil(log10(precision))))
-            for raw_score in counts.nonzero()[0]:
-                score = ceil(precision10 * raw_score / precision) / precision10
-                count = counts[raw_score]
-                yield (score, count)
+        return self._count_items(counts, raw_score)
+
+
+class FrozenSparseSimilarityMatrix(AbstractFrozenSimilarityMatrix):
+    """Frozen similarities matrix stored in compressed sparse row (CSR) format
+
+    Only the non-zero scores are stored, so it uses a fraction of the disk space and IO of
+    :class:`FrozenSimilarityMatrix` when most scores are zero.
+    The hits of fragment with id `i` are `indices[indptr[i]:indptr[i + 1]]` with
+    raw scores `scores[indptr[i]:indptr[i + 1]]`.
+    Each row is sorted on score with highest score first and then on fragment id.
+
+    Rows read by :meth:`find` and :meth:`find_many` can be kept in a least recently used cache.
+
+    Warning! Can not be enlarged.
+
+    Args:
+        filename (str): File name of hdf5 file to write or read similarity matrix from
+        mode (str): Can be 'r' for reading or 'w' for writing
+        row_cache_size (int): Maximum number of bytes of rows to cache, default is 0 for no cache
+        **kwargs: Passed though to tables.open_file()
+
+    Attributes:
+        h5file (tables.File): Object representing an open hdf5 file
+        labels (tables.CArray): Table to look up label of fragment by id or id of fragment by label
+        indptr (tables.CArray): Offset of the hits of each fragment
+        indices (tables.EArray): Fragment id of hits
+        scores (tables.EArray): Raw score of hits
+        score_codec (Uint16ScoreCodec): Codec to encode and decode scores
+        row_cache (RowCache): Cache of rows, with hit, miss and eviction counters
+
+    """
+    def __init__(self, filename, mode='r', row_cache_size=0, **kwargs):
+        self.h5file = tables.open_file(filename, mode, filters=self.filters, **kwargs)
+        self.score_codec = Uint16ScoreCodec()
+        self.score_precision = self.score_codec.precision
+        for name in ('labels', 'indptr', 'indices', 'scores'):
+            if name in self.h5file.root:
+                setattr(self, name, self.h5file.get_node('/', name))
+            else:
+                setattr(self, name, None)
+        self.cache_i2l = {}
+        self.cache_l2i = {}
+        self.cache_labels = np.array([], dtype=object)
+        if self.labels is not None:
+            self.build_label_cache()
+        self.row_cache = RowCache(row_cache_size)
+
+    @staticmethod
+    def is_sparse(h5file):
+        """Whether hdf5 file contains a sparse frozen similarity matrix
+
+        Args:
+            h5file (tables.File): Object representing an open hdf5 file
+
+        Returns:
+            bool
+        """
+        return 'indptr' in h5file.root
+
+    def _row(self, frag_id):
+        row = self.row_cache.get(frag_id) if self.row_cache.max_bytes else None
+        if row is None:
+            start, stop = self.indptr[frag_id:frag_id + 2]
+            row = self._cache_row(frag_id, self.indices[start:stop], self.scores[start:stop])
+        return row
+
+    def _cache_row(self, frag_id, hit_ids, raw_scores):
+        if self.row_cache.max_bytes:
+            hit_ids = np.array(hit_ids)
+            raw_scores = np.array(raw_scores)
+            # cached row is shared between callers, so guard it against modification
+            hit_ids.flags.writeable = False
+            raw_scores.flags.writeable = False
+            self.row_cache.put(frag_id, (hit_ids, raw_scores), hit_ids.nbytes + raw_scores.nbytes)
+        return hit_ids, raw_scores
+
+    def _iter_row_blocks(self, block_size=10000):
+        indptr = self.indptr.read()
+        nr_rows = len(indptr) - 1
+        for first_row in six.moves.range(0, nr_rows, block_size):
+            last_row = min(first_row + block_size, nr_rows)
+            start, stop = indptr[first_row], indptr[last_row]
+            rows = np.repeat(np.arange(first_row, last_row), np.diff(indptr[first_row:last_row + 1]))
+            yield rows, self.indices[start:stop], self.scores[start:stop]
+
+    def find(self, query, cutoff, limit=None):
+        """Find similar fragments to query.
+
+        Args:
+            query (str): Query fragment identifier
+            cutoff (float): Cutoff, similarity scores below cutoff are discarded.
+            limit (int): Maximum number of hits. Default is None for no limit.
+
+        Returns:
+            list[tuple[str,float]]: Hit fragment identifier and similarity score
+        """
+        scutoff = self.score_codec.raw_cutoff(cutoff)
+        query_id = self.cache_l2i[query]
+        hit_ids, raw_scores = self._row(query_id)
+        return self._hits(hit_ids, raw_scores, scutoff, limit)
+
+    def find_many(self, queries, cutoff, limit=None):
+        """Find similar fragments to each query.
+
+        The rows of the queries which are not cached are read sorted on fragment identifier,
+        adjacent rows and rows separated by less than a chunk are read with a single slice.
+
+        Args:
+            queries (list[str]): Query fragment identifiers
+            cutoff (float): Cutoff, similarity scores below cutoff are discarded.
+            limit (int): Maximum number of hits of each query. Default is None for no limit.
+
+        Returns:
+            list[list[tuple[str,float]]]: Hit fragment identifiers and similarity scores of each query,
+                in same order as queries and like :meth:`find`
+
+        Raises:
+            KeyError: When a query can not be found
+        """
+        scutoff = self.score_codec.raw_cutoff(cutoff)
+        query_ids = [self.cache_l2i[query] for query in queries]
+        frag_ids = np.unique(np.array(query_ids, dtype=np.int64))
+        hits = {}
+        if self.row_cache.max_bytes:
+            to_read = []
+            for frag_id in frag_ids.tolist():
+                row = self.row_cache.get(frag_id)
+                if row is None:
+                    to_read.append(frag_id)
+                else:
+                    hits[frag_id] = self._hits(row[0], row[1], scutoff, limit)
+            frag_ids = np.array(to_read, dtype=np.int64)
+        if len(frag_ids) == 0:
+            return [list(hits[query_id]) for query_id in query_ids]
+        indptr = self.indptr[frag_ids[0]:frag_ids[-1] + 2]
+        starts = indptr[frag_ids - frag_ids[0]]
+        stops = indptr[frag_ids - frag_ids[0] + 1]
+        breaks = np.flatnonzero(starts[1:] - stops[:-1] > self.indices.chunkshape[0]) + 1
+        for run in np.split(np.arange(len(frag_ids)), breaks):
+            run_start = starts[run[0]]
+            indices = self.indices[run_start:stops[run[-1]]]
+            raw_scores = self.scores[run_start:stops[run[-1]]]
+            for i in run.tolist():
+                start, stop = starts[i] - run_start, stops[i] - run_start
+                frag_id = int(frag_ids[i])
+                hit_ids, row_scores = self._cache_row(frag_id, indices[start:stop], raw_scores[start:stop])
+                hits[frag_id] = self._hits(hit_ids, row_scores, scutoff, limit)
+        return [list(hits[query_id]) for query_id in query_ids]
+
+    def _hits(self, hit_ids, raw_scores, scutoff, limit):
+        # row is sorted on score, so hits stay sorted
+        above = raw_scores >= scutoff
+        hit_ids = hit_ids[above][:limit]
+        scores = self.score_codec.decode(raw_scores[above][:limit])
+        return [(self.cache_i2l[k], v) for k, v in zip(hit_ids.tolist(), scores.tolist())]
+
+    def __getitem__(self, item):
+        """Get all similarities of fragment or the similarity score between to 2 fragments.
+
+        Self is excluded in list of similarity scores.
+
+        Args:
+            item (str|Tuple[str, str]): Label of a fragment or tuple of 2 fragment labels
+
+        Returns:
+            list[tuple[str, float]]|float: list of (fragment_label, score) or the score
+
+
+        Raises:
+            KeyError: When item can not be found
+        """
+        if isinstance(item, tuple):
+            return self._fetch_cell(item[0], item[1])
+
+        query_id = self.cache_l2i[item]
+        hit_ids, raw_scores = self._row(query_id)
+        subjects = np.zeros(len(self.labels), dtype=raw_scores.dtype)
+        subjects[hit_ids] = raw_scores
+        scores = self.score_codec.decode(subjects).tolist()
+        return [(self.cache_i2l[k], v) for k, v in enumerate(scores) if k != query_id]
+
+    def _fetch_cell(self, frag_label1, frag_label2):
+        frag_id1 = self.cache_l2i[frag_label1]
+        frag_id2 = self.cache_l2i[frag_label2]
+
+        if frag_id1 == frag_id2:
+            return 1.0
+
+        hit_ids, raw_scores = self._row(frag_id1)
+        raw_score = raw_scores[hit_ids == frag_id2].sum()
+        return float(self.score_codec.decode(raw_score))
+
+    def __iter__(self):
+        """
+        Yields: Tuple[str, str, float] Fragment id 1, Fragment id 2, similarity score of lower triangle of matrix
+        """
+        for labels1, labels2, scores in self.iter_frames():
+            for pair in zip(labels1.tolist(), labels2.tolist(), scores.tolist()):
+                yield pair
+
+    def iter_frames(self, mask=None, block_size=10000):
+        """Pairs of fragment labels with their similarity score of lower triangle of matrix, a block of rows at a time.
+
+        Args:
+            mask (np.ndarray): Boolean array with a value for each fragment,
+                only pairs of which both fragments are true are yielded. Default is None for all pairs.
+            block_size (int): Number of rows read each time
+
+        Yields:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: Labels of first and second fragment of pairs and
+                their similarity scores, in same order as iterating the matrix
+        """
+        for rows, cols, raw_scores in self._iter_row_blocks(block_size):
+            selected = cols < rows
+            if mask is not None:
+                selected &= mask[rows] & mask[cols]
+            rows, cols, scores = rows[selected], cols[selected], self.score_codec.decode(raw_scores[selected])
+            order = np.lexsort((cols, rows))
+            yield self.cache_labels[cols[order]], self.cache_labels[rows[order]], scores[order]
+
+    def count(self, frame_size=None, raw_score=False, lower_triangle=False):
+        """Count occurrences of each score
+
+        Only scores are counted of the upper triangle or lower triangle.
+        Zero scores are skipped.
+
+        Args:
+            frame_size (int): Dummy argument to force same interface for thawed and frozen matrix
+            raw_score (bool): When true return raw int16 score else fraction score
+            lower_triangle (bool): When true return scores from lower triangle else return scores from upper triangle
+
+        Returns:
+            Tuple[(str, int)]: Score and number of occurrences
+        """
+        nr_bins = self.score_precision + 1
+        counts = np.zeros(shape=nr_bins, dtype=np.int64)
+        for rows, cols, raw_scores in self._iter_row_blocks():
+            if lower_triangle:
+                subjects = raw_scores[cols > rows]
+            else:
+                subjects = raw_scores[cols <= rows]
+            counts += np.bincount(subjects, minlength=nr_bins)
+
+        return self._count_items(counts, raw_score)
+
+    def from_pairs(self, similarity_matrix, frame_size, limit=None, single_sided=False, tmpdir=None, threads=None):
+        """Fills self with matrix which is stored in pairs.
+
+        The pairs are read twice, a frame at a time.
+        The first pass counts the hits of each fragment,
+        the second pass puts each hit in the row of its fragment in temporary memory-mapped files.
+        The rows are then sorted and written a block at a time.
+
+        Args:
+            similarity_matrix (kripodb.hdf5.SimilarityMatrix):
+            frame_size (int): Number of pairs to read in a single go
+            limit (int|None): Number of pairs to add, None for no limit, default is None.
+            single_sided (bool): If false add stored direction and reverse direction. Default is False.
+            tmpdir (str|None): Directory in which temporary files are written, None for system default.
+            threads (int|None): Number of blosc threads to compress with, None for current setting. Default is None.
+
+        """
+        with blosc_threads(threads):
+            id2labels = {v: k for k, v in similarity_matrix.labels.label2ids().items()}
+            labels = list(id2labels.values())
+            oids = np.fromiter(id2labels.keys(), dtype=np.int64, count=len(id2labels))
+            oid2nid = np.zeros(oids.max() + 1 if len(oids) else 0, dtype=np.int64)
+            oid2nid[oids] = np.arange(len(oids))
+            nr_frags = len(labels)
+
+            if limit is None:
+                limit = len(similarity_matrix.pairs)
+            frames = (similarity_matrix.pairs, oid2nid, frame_size, limit, single_sided)
+
+            counts = np.zeros(nr_frags, dtype=np.int64)
+            for rows, _, _ in self._iter_pair_frames(*frames):
+                counts += np.bincount(rows, minlength=nr_frags)
+            indptr = np.zeros(nr_frags + 1, dtype=np.int64)
+            np.cumsum(counts, out=indptr[1:])
+
+            tmp_dir = tempfile.mkdtemp(prefix='kripodb-freeze-', dir=tmpdir)
+            try:
+                indices = np.lib.format.open_memmap(os.path.join(tmp_dir, 'indices.npy'), mode='w+',
+                                                    dtype=np.uint32, shape=(indptr[-1],))
+                scores = np.lib.format.open_memmap(os.path.join(tmp_dir, 'scores.npy'), mode='w+',
+                                                   dtype=self.score_codec.dtype, shape=(indptr[-1],))
+                # next free position in each row
+                cursor = indptr[:-1].copy()
+                for rows, cols, raw_scores in self._iter_pair_frames(*frames):
+                    order = np.argsort(rows, kind='mergesort')
+                    rows = rows[order]
+                    # position of hit among the hits of the same row in this frame
+                    rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+                    positions = cursor[rows] + rank
+                    indices[positions] = cols[order]
+                    scores[positions] = raw_scores[order]
+                    cursor += np.bincount(rows, minlength=nr_frags)
+                self._write(labels, indptr, indices, scores, frame_size)
+                del indices, scores
+            finally:
+                shutil.rmtree(tmp_dir)
+
+    def _iter_pair_frames(self, pairs_table, oid2nid, frame_size, limit, single_sided):
+        pairs = pairs_table.table
+        for start in six.moves.range(0, limit, frame_size):
+            stop = min(frame_size + start, limit)
+            raw_frame = pairs.read(start=start, stop=stop)
+            a = oid2nid[raw_frame['a']]
+            b = oid2nid[raw_frame['b']]
+            raw_scores = self.score_codec.encode_raw(raw_frame['score'], pairs_table.score_precision)
+            if single_sided:
+                yield a, b, raw_scores
+            else:
+                yield np.concatenate((a, b)), np.concatenate((b, a)), np.concatenate((raw_scores, raw_scores))
+
+    def from_array(self, data, labels, threads=None):
+        """Fill matrix from 2 dimensional array
+
+        Args:
+            data (np.array): 2 dimensional square array with scores
+            labels (list): List of labels for each column and row index
+            threads (int|None): Number of blosc threads to compress with, None for current setting. Default is None.
+        """
+        with blosc_threads(threads):
+            matrix = csr_matrix(self.score_codec.encode(data))
+            self._write(labels, matrix.indptr, matrix.indices, matrix.data)
+
+    def _write(self, labels, indptr, indices, scores, block_size=10**8):
+        """Write labels and rows, rows are sorted and written a block of at most `block_size` hits at a time.
+
+        Scores of duplicate hits in a row are summed and zero scores are skipped.
+
+        Args:
+            labels (list[str]): Label of each fragment
+            indptr (np.ndarray): Offset of the hits of each fragment in indices and scores
+            indices (np.ndarray): Fragment id of unsorted hits
+            scores (np.ndarray): Raw score of unsorted hits
+            block_size (int): Maximum number of hits sorted at once, a row is never split
+        """
+        self.row_cache.clear()
+        labels = [np.string_(d) for d in labels]
+        self.labels = self.h5file.create_carray('/', 'labels', obj=labels, filters=self.filters)
+        self.build_label_cache()
+
+        nr_frags = len(indptr) - 1
+        self.indices = self.h5file.create_earray('/', 'indices', atom=tables.UInt32Atom(), shape=(0,),
+                                                 filters=self.filters, expectedrows=max(1, indptr[-1]))
+        self.scores = self.h5file.create_earray('/', 'scores', atom=self.score_codec.atom, shape=(0,),
+                                                filters=self.filters, expectedrows=max(1, indptr[-1]))
+        counts = np.zeros(nr_frags, dtype=np.int64)
+        first_row = 0
+        while first_row < nr_frags:
+            last_row = np.searchsorted(indptr, indptr[first_row] + block_size, side='right') - 1
+            last_row = min(max(last_row, first_row + 1), nr_frags)
+            start, stop = indptr[first_row], indptr[last_row]
+            rows = np.repeat(np.arange(first_row, last_row), np.diff(indptr[first_row:last_row + 1]))
+            cols = np.asarray(indices[start:stop], dtype=np.int64)
+            raw_scores = np.asarray(scores[start:stop])
+            order = np.lexsort((cols, rows))
+            rows, cols, raw_scores = rows[order], cols[order], raw_scores[order]
+            duplicate = np.zeros(len(rows), dtype=bool)
+            duplicate[1:] = (rows[1:] == rows[:-1]) & (cols[1:] == cols[:-1])
+            if duplicate.any():
+                firsts = np.flatnonzero(~duplicate)
+                rows, cols = rows[firsts], cols[firsts]
+                raw_scores = np.add.reduceat(raw_scores, firsts).astype(self.score_codec.dtype)
+            nonzero = raw_scores != 0
+            rows, cols, raw_scores = rows[nonzero], cols[nonzero], raw_scores[nonzero]
+            # highest score first, same score ordered on fragment id
+            order = np.lexsort((cols, -self.score_codec.decode(raw_scores), rows))
+            self.indices.append(cols[order].astype(np.uint32))
+            self.scores.append(raw_scores[order])
+            counts[first_row:last_row] = np.bincount(rows - first_row, minlength=last_row - first_row)
+            first_row = last_row
+        indptr = np.zeros(nr_frags + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        self.indptr = self.h5file.create_carray('/', 'indptr', obj=indptr, filters=self.filters)
+        self.h5file.flush()
+
+    def to_pairs(self, pairs):
+        """Copies labels and scores from self to pairs matrix.
+
+        Args:
+            pairs (SimilarityMatrix):
+
+        """
+        self.build_label_cache()
+        pairs.labels.update(self.cache_l2i)
+
+        table = pairs.pairs.table
+        for rows, cols, raw_scores in self._iter_row_blocks():
+            upper = rows < cols
+            rows, cols, raw_scores = rows[upper], cols[upper], raw_scores[upper]
+            order = np.lexsort((cols, rows))
+            frame = np.empty(len(order), dtype=table.dtype)
+            frame['a'] = rows[order]
+            frame['b'] = cols[order]
+            frame['score'] = raw_scores[order]
+            if len(frame):
+                table.append(frame)
+        table.flush()
@@ -14,13 +14,20 @@
 """Similarity matrix using hdf5 as storage backend."""
 from __future__ import absolute_import
 
+from itertools import islice
 from math import log10, ceil, floor
+from operator import itemgetter
+import os
+import shutil
+import tempfile
 
 import numpy as np
 from progressbar import ProgressBar
 import tables
 import six
 
+from .cache import RowCache
+
 
 class SimilarityMatrix(object):
     """Similarity matrix
@@ -33,20 +40,25 @@ class SimilarityMatrix(object):
         expectedlabelrows (int): Expected number of labels to be added.
             Required when similarity matrix is opened in write mode, helps optimize storage
         cache_labels (bool): Cache labels, speed up label lookups
+        row_cache_size (int): Maximum number of bytes of hits of :meth:`find` to cache, default is 0 for no cache
 
     Attributes:
         h5file (tables.File): Object representing an open hdf5 file
         pairs (PairsTable): HDF5 Table that contains pairs
         labels (LabelsLookup): Table to look up label of fragment by id or id of fragment by label
+        row_cache (RowCache): Cache of hits, with hit, miss and eviction counters
     """
     filters = tables.Filters(complevel=6, complib='blosc')
 
-    def __init__(self, filename, mode='r', expectedpairrows=None, expectedlabelrows=None, cache_labels=False, **kwargs):
+    def __init__(self, filename, mode='r', expectedpairrows=None, expectedlabelrows=None, cache_labels=False,
+                 row_cache_size=0, **kwargs):
         self.h5file = tables.open_file(filename, mode, filters=self.filters, **kwargs)
         self.pairs = PairsTable(self.h5file, expectedpairrows)
         self.labels = LabelsLookup(self.h5file, expectedlabelrows)
         self.cache_i2l = {}
         self.cache_l2i = {}
+        self.cache_labels = np.array([], dtype=object)
+        self.row_cache = RowCache(row_cache_size)
         if cache_labels:
             self._build_label_cache()
 
@@ -54,6 +66,10 @@ class SimilarityMatrix(object):
         if not self.cache_l2i:
             self.cache_l2i = self.labels.label2ids()
             self.cache_i2l = {v: k for k, v in six.iteritems(self.cache_l2i)}
+            # array lookup of label by fragment identifier, None for identifiers without a label
+            self.cache_labels = np.empty(max(self.cache_i2l.keys()) + 1 if self.cache_i2l else 0, dtype=object)
+            for frag_id, label in six.iteritems(self.cache_i2l):
+                self.cache_labels[frag_id] = label
 
     def close(self):
         """Closes the hdf5file"""
@@ -65,6 +81,7 @@ class SimilarityMatrix(object):
         Args:
             other (SimilarityMatrix): Other similarity matrix
         """
+        self.row_cache.clear()
         if len(self.labels) == 0:
             # copy labels when self has no labels
             self.labels.append(other.labels)
@@ -80,9 +97,28 @@ class SimilarityMatrix(object):
             self.pairs.update(other, self.labels.label2ids())
 
     def __iter__(self):
+        for labels1, labels2, scores in self.iter_frames():
+            for pair in zip(labels1.tolist(), labels2.tolist(), scores.tolist()):
+                yield pair
+
+    def iter_frames(self, mask=None, frame_size=10**6):
+        """Pairs of fragment labels with their similarity score, a frame of pairs at a time.
+
+        Args:
+            mask (np.ndarray): Boolean array indexed by fragment identifier,
+                only pairs of which both fragments are true are yielded. Default is None for all pairs.
+            frame_size (int): Number of pairs read each time
+
+        Yields:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: Labels of first and second fragment of pairs and
+                their similarity scores, in order of pairs table
+        """
         self._build_label_cache()
-        for pair in self.pairs:
-            yield self.cache_i2l[pair['a']], self.cache_i2l[pair['b']], pair['score']
+        for ids1, ids2, scores in self.pairs.iter_frames(frame_size):
+            if mask is not None:
+                selected = mask[ids1] & mask[ids2]
+                ids1, ids2, scores = ids1[selected], ids2[selected], scores[selected]
+            yield self.cache_labels[ids1], self.cache_labels[ids2], scores
 
     def update(self, similarities_iter, label2id):
         """Store pairs of fragment identifier with their similarity score and label 2 id lookup
@@ -92,6 +128,7 @@ class SimilarityMatrix(object):
             label2id (dict): Dictionary with fragment label as key and fragment identifier as value.
 
         """
+        self.row_cache.clear()
         self.pairs.update(similarities_iter, label2id)
         self.labels.update(label2id)
 
@@ -108,13 +145,80 @@ class SimilarityMatrix(object):
         """
         if self.cache_l2i:
             frag_id = self.cache_l2i[query]
-            for hit_frag_id, score in self.pairs.find(frag_id, cutoff, limit):
+            for hit_frag_id, score in self._find_ids(frag_id, cutoff, limit):
                 yield self.cache_i2l[hit_frag_id], score
         else:
             frag_id = self.labels.by_label(query)
-            for hit_frag_id, score in self.pairs.find(frag_id, cutoff, limit):
+            for hit_frag_id, score in self._find_ids(frag_id, cutoff, limit):
                 yield self.labels.by_id(hit_frag_id), score
 
+    def find_many(self, queries, cutoff, limit=None):
+        """Find similar fragments to each query.
+
+        The pairs of all queries are read together,
+        with a single scan of the pairs or, when indexed, with reads of runs of adjacent neighbors.
+
+        Args:
+            queries (list[str]): Query fragment identifiers
+            cutoff (float): Cutoff, similarity scores below cutoff are discarded.
+            limit (int): Maximum number of hits of each query. Default is None for no limit.
+
+        Returns:
+            list[list[tuple[str,float]]]: Hit fragment identifiers and similarity scores of each query,
+                in same order as queries
+
+        Raises:
+            KeyError: When a query can not be found
+        """
+        self._build_label_cache()
+        frag_ids = [self.cache_l2i[query] for query in queries]
+        hits = {}
+        missing = []
+        for frag_id in sorted(set(frag_ids)):
+            cached = self._cached_hits(frag_id, cutoff, limit)
+            if cached is None:
+                missing.append(frag_id)
+            else:
+                hits[frag_id] = cached
+        for frag_id, frag_hits in zip(missing, self.pairs.find_many(missing, cutoff, limit)):
+            self._cache_hits(frag_id, cutoff, limit, frag_hits)
+            hits[frag_id] = frag_hits
+        return [[(self.cache_i2l[hit_id], score) for hit_id, score in hits[frag_id]] for frag_id in frag_ids]
+
+    def _find_ids(self, frag_id, cutoff, limit):
+        hits = self._cached_hits(frag_id, cutoff, limit)
+        if hits is None:
+            hits = self.pairs.find(frag_id, cutoff, limit)
+            self._cache_hits(frag_id, cutoff, limit, hits)
+        return hits
+
+    def _cached_hits(self, frag_id, cutoff, limit):
+        if not self.row_cache.max_bytes:
+            return None
+        hits = self.row_cache.get((frag_id, cutoff, limit))
+        if hits is None:
+            return None
+        hit_ids, scores = hits
+        return list(zip(hit_ids.tolist(), scores.tolist()))
+
+    def _cache_hits(self, frag_id, cutoff, limit, hits):
+        if not self.row_cache.max_bytes:
+            return
+        hit_ids = np.array([hit[0] for hit in hits], dtype=np.int64)
+        scores = np.array([hit[1] for hit in hits], dtype=np.float64)
+        self.row_cache.put((frag_id, cutoff, limit), (hit_ids, scores), hit_ids.nbytes + scores.nbytes)
+
+    def build_index(self, frame_size=10**8, tmpdir=None):
+        """Build neighbors index of pairs, so :meth:`find` reads a single slice instead of scanning all pairs.
+
+        See :class:`NeighborsIndex`.
+
+        Args:
+            frame_size (int): Number of pairs read each time
+            tmpdir (str|None): Directory in which temporary files are written, None for system default.
+        """
+        self.pairs.build_index(frame_size, tmpdir)
+
     def count(self, frame_size, raw_score=False, lower_triangle=False):
         """Count occurrences of each score
 
@@ -214,6 +318,7 @@ class PairsTable(AbstractSimpleTable):
         score_precision (int): Similarity score is a fraction,
             the score is converted to an int by multiplying it with the precision
         full_matrix (bool): Matrix is filled above and below diagonal.
+        neighbors (NeighborsIndex): Neighbors index of pairs or None when pairs have not been indexed
     """
     table_name = 'pairs'
     filters = tables.Filters(complevel=6, complib='blosc')
@@ -229,7 +334,26 @@ class PairsTable(AbstractSimpleTable):
                                         expectedrows=expectedrows)
 
         super(PairsTable, self).__init__(table)
+        self.h5file = h5file
         self.score_precision = 2 ** 16 - 1
+        self.neighbors = None
+        if NeighborsIndex.exists(h5file):
+            self.neighbors = NeighborsIndex(h5file)
+
+    def build_index(self, frame_size=10**8, tmpdir=None):
+        """Build neighbors index of pairs, replacing any previous index.
+
+        Args:
+            frame_size (int): Number of pairs read each time
+            tmpdir (str|None): Directory in which temporary files are written, None for system default.
+        """
+        self.drop_index()
+        self.neighbors = NeighborsIndex.build(self.h5file, self.table, self.full_matrix, frame_size, tmpdir)
+
+    def drop_index(self):
+        """Remove neighbors index of pairs"""
+        NeighborsIndex.drop(self.h5file)
+        self.neighbors = None
 
     @property
     def full_matrix(self):
@@ -242,21 +366,31 @@ class PairsTable(AbstractSimpleTable):
     def full_matrix(self, value):
         self.table.attrs['full_matrix'] = value
 
-    def update(self, similarities_iter, label2id):
+    def update(self, similarities_iter, label2id, buffer_size=2**16):
         """Store pairs of fragment identifier with their similarity score
 
         Args:
             similarities_iter (Iterator): Iterator which yields (label1, label2, similarity_score)
             label2id (Dict): Lookup with fragment label as key and fragment identifier as value
+            buffer_size (int): Number of pairs appended to table in one call
 
         """
-        hit = self.table.row
-        for label1, label2, similarity in similarities_iter:
-            hit['a'] = label2id[label1]
-            hit['b'] = label2id[label2]
-            hit['score'] = int(similarity * self.score_precision)
-            hit.append()
-        self.table.flush()
+        with self.writer(label2id, buffer_size) as writer:
+            writer.write_labels(similarities_iter)
+
+    def writer(self, label2id=None, buffer_size=2**16):
+        """Buffered writer of pairs into this table, drops neighbors index
+
+        Args:
+            label2id (Dict): Lookup with fragment label as key and fragment identifier as value.
+                Only required when writing labels.
+            buffer_size (int): Number of pairs appended to table in one call
+
+        Returns:
+            PairsWriter
+        """
+        self.drop_index()
+        return PairsWriter(self.table, self.score_precision, label2id, buffer_size)
 
     def find(self, frag_id, cutoff, limit):
         """Find fragment hits which has a similarity score with frag_id above cutoff.
@@ -274,6 +408,13 @@ class PairsTable(AbstractSimpleTable):
         precision10 = float(10**(floor(log10(precision))))
         scutoff = int(cutoff * precision)
 
+        if self.neighbors is not None:
+            hit_ids, scores = self.neighbors.find(frag_id, scutoff)
+            scores = np.ceil(precision10 * scores / precision) / precision10
+            # highest score==most similar first
+            order = np.argsort(-scores, kind='mergesort')[:limit]
+            return list(zip(hit_ids[order].tolist(), scores[order].tolist()))
+
         hits = {}
         query1 = '(a == {0}) & (score >= {1})'.format(frag_id, scutoff)
         for row in self.table.where(query1):
@@ -296,6 +437,66 @@ class PairsTable(AbstractSimpleTable):
 
         return sorted_hits
 
+    def find_many(self, frag_ids, cutoff, limit=None, frame_size=10**6):
+        """Find fragment hits of each fragment in frag_ids which have a similarity score above cutoff.
+
+        When the pairs are indexed the neighbors of the fragments are read in runs of adjacent rows,
+        otherwise the pairs are scanned once for all fragments.
+
+        Args:
+            frag_ids (list[int]): Query fragment identifiers
+            cutoff (float): Cutoff, similarity scores below cutoff are discarded.
+            limit (int): Maximum number of hits of each query. Default is None for no limit.
+            frame_size (int): Number of pairs read each time when scanning pairs
+
+        Returns:
+            List[List[Tuple]]: Hits of each fragment in same order as frag_ids,
+                like :meth:`find` the hits are tuples of hit fragment identifier and similarity score
+
+        """
+        precision = float(self.score_precision)
+        precision10 = float(10**(floor(log10(precision))))
+        scutoff = int(cutoff * precision)
+
+        if self.neighbors is not None:
+            raw_hits = self.neighbors.find_many(frag_ids, scutoff)
+        else:
+            raw_hits = self._scan_many(frag_ids, scutoff, frame_size)
+
+        hits = []
+        for frag_id in frag_ids:
+            hit_ids, scores = raw_hits[frag_id]
+            scores = np.ceil(precision10 * scores / precision) / precision10
+            # highest score==most similar first
+            order = np.argsort(-scores, kind='mergesort')[:limit]
+            hits.append(list(zip(hit_ids[order].tolist(), scores[order].tolist())))
+        return hits
+
+    def _scan_many(self, frag_ids, scutoff, frame_size):
+        queries = np.unique(np.asarray(frag_ids, dtype=np.int64))
+        a_pairs = []
+        b_pairs = []
+        for start in six.moves.range(0, len(self.table), frame_size):
+            frame = self.table.read(start=start, stop=start + frame_size)
+            frame = frame[frame['score'] >= scutoff]
+            a_pairs.append(frame[np.isin(frame['a'], queries)])
+            if not self.full_matrix:
+                b_pairs.append(frame[np.isin(frame['b'], queries)])
+        a_pairs = np.concatenate(a_pairs) if a_pairs else np.empty(0, dtype=self.table.dtype)
+        b_pairs = np.concatenate(b_pairs) if b_pairs else np.empty(0, dtype=self.table.dtype)
+
+        # like find, hits of query as a before hits of query as b and both in order of pairs table
+        query_ids = np.concatenate((a_pairs['a'], b_pairs['b']))
+        hit_ids = np.concatenate((a_pairs['b'], b_pairs['a']))
+        scores = np.concatenate((a_pairs['score'], b_pairs['score']))
+        order = np.argsort(query_ids, kind='mergesort')
+        query_ids, hit_ids, scores = query_ids[order], hit_ids[order], scores[order]
+
+        starts = np.searchsorted(query_ids, queries, side='left')
+        stops = np.searchsorted(query_ids, queries, side='right')
+        return {frag_id: NeighborsIndex.unique_hits(hit_ids[start:stop], scores[start:stop])
+                for frag_id, start, stop in zip(queries.tolist(), starts, stops)}
+
     def append(self, other):
         """Append rows of other table to self
 
@@ -303,17 +504,37 @@ class PairsTable(AbstractSimpleTable):
             other: Table of same type as self
 
         """
+        self.drop_index()
         super(PairsTable, self).append(other)
 
         if self.score_precision is None:
             self.score_precision = other.score_precision
 
     def __iter__(self):
+        for ids1, ids2, scores in self.iter_frames():
+            for a, b, score in zip(ids1.tolist(), ids2.tolist(), scores.tolist()):
+                yield {'a': a, 'b': b, 'score': score}
+
+    def iter_frames(self, frame_size=10**6, raw_score=False):
+        """Pairs of fragment identifiers with their similarity score, a frame of pairs at a time.
+
+        Args:
+            frame_size (int): Number of pairs read each time
+            raw_score (bool): When true yield raw int16 score else fraction score
+
+        Yields:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: Identifiers of first and second fragment of pairs and
+                their similarity scores
+        """
         precision = float(self.score_precision)
         precision10 = float(10**(floor(log10(precision))))
-        for pair in super(PairsTable, self).__iter__():
-            score = ceil(precision10 * pair['score'] / precision) / precision10
-            yield {'a': pair['a'], 'b': pair['b'], 'score': score}
+        for start in six.moves.range(0, len(self.table), frame_size):
+            frame = self.table.read(start=start, stop=start + frame_size)
+            if raw_score:
+                scores = frame['score']
+            else:
+                scores = np.ceil(precision10 * frame['score'] / precision) / precision10
+            yield frame['a'], frame['b'], scores
 
     def count(self, frame_size, raw_score=False):
         """Count occurrences of each score
@@ -358,28 +579,18 @@ class PairsTable(AbstractSimpleTable):
         Returns:
             set[int]: Fragment identifiers that have been copied to other
         """
-        all_frags2keep = set(keep)
-        hit = other.table.row
-        for row in self.table:
-            if row['a'] in keep and row['b'] in keep:
-                hit['a'] = row['a']
-                hit['b'] = row['b']
-                hit['score'] = row['score']
-                hit.append()
-            elif row['a'] in keep:
-                hit['a'] = row['a']
-                hit['b'] = row['b']
-                hit['score'] = row['score']
-                hit.append()
-                all_frags2keep.add(row['b'])
-            elif row['a'] in keep:
-                hit['a'] = row['a']
-                hit['b'] = row['b']
-                hit['score'] = row['score']
-                hit.append()
-                all_frags2keep.add(row['a'])
+        other.drop_index()
+        keep_ids = np.array(sorted(keep), dtype=np.int64)
+        paired_ids = [np.empty(0, dtype=np.int64)]
+        for start in six.moves.range(0, len(self.table), self.append_chunk_size):
+            frame = self.table.read(start=start, stop=start + self.append_chunk_size)
+            a_kept = np.isin(frame['a'], keep_ids)
+            b_kept = np.isin(frame['b'], keep_ids)
+            paired_ids.append(np.unique(frame['b'][a_kept & ~b_kept]))
+            paired_ids.append(np.unique(frame['a'][b_kept & ~a_kept]))
+            other.table.append(frame[a_kept | b_kept])
         other.table.flush()
-        return all_frags2keep
+        return set(keep) | set(np.unique(np.concatenate(paired_ids)).tolist())
 
     def skip(self, other, skip):
         """Copy content from self to other and skip given fragment identifiers
@@ -388,16 +599,301 @@ class PairsTable(AbstractSimpleTable):
             other (PairsTable): Pairs table to fill
             skip (set[int]): Fragment identifiers to skip
         """
-        hit = other.table.row
-        for row in self.table:
-            if row['a'] not in skip and row['b'] not in skip:
-                hit['a'] = row['a']
-                hit['b'] = row['b']
-                hit['score'] = row['score']
-                hit.append()
+        other.drop_index()
+        skip_ids = np.array(sorted(skip), dtype=np.int64)
+        for start in six.moves.range(0, len(self.table), self.append_chunk_size):
+            frame = self.table.read(start=start, stop=start + self.append_chunk_size)
+            skipped = np.isin(frame['a'], skip_ids) | np.isin(frame['b'], skip_ids)
+            other.table.append(frame[~skipped])
         other.table.flush()
 
 
+class PairsWriter(object):
+    """Buffered writer of pairs into a pairs table.
+
+    Pairs are collected in a preallocated structured array which is appended to the table in one call when full.
+    Remaining pairs are appended when the writer is closed.
+
+    Args:
+        table (tables.Table): Pairs table to append to
+        score_precision (int): Similarity score is a fraction,
+            the score is converted to an int by multiplying it with the precision
+        label2id (Dict): Lookup with fragment label as key and fragment identifier as value.
+            Only required when writing labels.
+        buffer_size (int): Number of pairs appended to table in one call
+
+    """
+    def __init__(self, table, score_precision, label2id=None, buffer_size=2**16):
+        self.table = table
+        self.score_precision = score_precision
+        self.label2id = label2id
+        self.buffer = np.empty(buffer_size, dtype=table.dtype)
+        self.size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write_labels(self, similarities_iter):
+        """Write pairs of labels with their similarity score
+
+        Args:
+            similarities_iter (Iterator): Iterator which yields (label1, label2, similarity_score)
+
+        """
+        batch_size = len(self.buffer)
+        similarities_iter = iter(similarities_iter)
+        batch = list(islice(similarities_iter, batch_size))
+        while batch:
+            lookup = self.label2id.__getitem__
+            count = len(batch)
+            self.write(np.fromiter(map(lookup, map(itemgetter(0), batch)), dtype=np.uint32, count=count),
+                       np.fromiter(map(lookup, map(itemgetter(1), batch)), dtype=np.uint32, count=count),
+                       np.fromiter(map(itemgetter(2), batch), dtype=np.float64, count=count))
+            batch = list(islice(similarities_iter, batch_size))
+
+    def write(self, ids1, ids2, scores):
+        """Write pairs of fragment identifiers with their similarity score
+
+        Args:
+            ids1 (np.ndarray): Fragment identifiers of first fragment of pairs
+            ids2 (np.ndarray): Fragment identifiers of second fragment of pairs
+            scores (np.ndarray): Similarity scores as fractions
+
+        """
+        raw_scores = (np.asarray(scores, dtype=np.float64) * self.score_precision).astype(np.uint16)
+        start = 0
+        while start < len(raw_scores):
+            size = min(len(self.buffer) - self.size, len(raw_scores) - start)
+            chunk = self.buffer[self.size:self.size + size]
+            chunk['a'] = ids1[start:start + size]
+            chunk['b'] = ids2[start:start + size]
+            chunk['score'] = raw_scores[start:start + size]
+            self.size += size
+            start += size
+            if self.size == len(self.buffer):
+                self.flush()
+
+    def flush(self):
+        """Append buffered pairs to table"""
+        if self.size:
+            self.table.append(self.buffer[:self.size])
+            self.size = 0
+        self.table.flush()
+
+    def close(self):
+        """Append remaining buffered pairs to table"""
+        self.flush()
+
+
+def _add_bincount(counts, ids):
+    """Counts of identifiers added to counts, enlarged when an identifier is beyond counts"""
+    frame_counts = np.bincount(ids, minlength=len(counts))
+    frame_counts[:len(counts)] += counts
+    return frame_counts
+
+
+class NeighborsIndex(object):
+    """Neighbors index of a pairs table stored in the same hdf5 file.
+
+    Compressed sparse row layout of the pairs with a row for each fragment identifier.
+    The hits of fragment `i` are `ids[indptr[i]:indptr[i + 1]]` with
+    raw scores `scores[indptr[i]:indptr[i + 1]]`.
+    When the pairs table is not a full matrix, each pair is stored in the rows of both its fragments.
+    Within a row the hits are in the order a scan of the pairs table would find them,
+    first the pairs where fragment is `a` and then the pairs where fragment is `b`.
+
+    Args:
+        h5file (tables.File): Object representing an open hdf5 file
+
+    Raises:
+        LookupError: When hdf5 file has no neighbors index
+
+    Attributes:
+        indptr (tables.EArray): Offset of the hits of each fragment identifier
+        ids (tables.EArray): Fragment identifier of hits
+        scores (tables.EArray): Raw score of hits
+
+    """
+    group_name = 'neighbors'
+    filters = tables.Filters(complevel=6, complib='blosc')
+
+    def __init__(self, h5file):
+        if not self.exists(h5file):
+            raise LookupError('No neighbors index found, build it first')
+        group = h5file.get_node('/', self.group_name)
+        self.indptr = group.indptr
+        self.ids = group.ids
+        self.scores = group.scores
+
+    @classmethod
+    def exists(cls, h5file):
+        return cls.group_name in h5file.root
+
+    @classmethod
+    def drop(cls, h5file):
+        if cls.exists(h5file):
+            h5file.remove_node('/', cls.group_name, recursive=True)
+
+    @classmethod
+    def build(cls, h5file, table, full_matrix, frame_size=10**8, tmpdir=None):
+        """Build neighbors index of pairs table.
+
+        The pairs are read twice, a frame at a time.
+        The first pass counts the hits of each fragment identifier,
+        the second pass puts each hit at the next free position in the row of its fragment identifier
+        in temporary memory-mapped files, which are then appended to the index a frame at a time.
+        So memory use is bounded by the frame size and the number of fragment identifiers.
+
+        Args:
+            h5file (tables.File): Object representing an open hdf5 file
+            table (tables.Table): Pairs table
+            full_matrix (bool): When true pairs table is filled above and below diagonal,
+                so each pair is only stored in row of its first fragment
+            frame_size (int): Number of pairs read each time
+            tmpdir (str|None): Directory in which temporary files are written, None for system default.
+
+        Returns:
+            NeighborsIndex
+        """
+        nr_pairs = len(table)
+        a_counts = np.zeros(0, dtype=np.int64)
+        b_counts = np.zeros(0, dtype=np.int64)
+        for start in six.moves.range(0, nr_pairs, frame_size):
+            frame = table.read(start=start, stop=start + frame_size)
+            a_counts = _add_bincount(a_counts, frame['a'])
+            b_counts = _add_bincount(b_counts, frame['b'])
+        nr_ids = max(len(a_counts), len(b_counts))
+        a_counts = np.pad(a_counts, (0, nr_ids - len(a_counts)), 'constant')
+        b_counts = np.pad(b_counts, (0, nr_ids - len(b_counts)), 'constant')
+        if full_matrix:
+            b_counts[:] = 0
+        indptr = np.zeros(nr_ids + 1, dtype=np.int64)
+        np.cumsum(a_counts + b_counts, out=indptr[1:])
+        nr_hits = int(indptr[-1])
+
+        group = h5file.create_group('/', cls.group_name, 'Neighbors index of pairs')
+        earrays = {}
+        for name, atom in (('indptr', tables.Int64Atom()), ('ids', tables.UInt32Atom()),
+                           ('scores', tables.UInt16Atom())):
+            expectedrows = len(indptr) if name == 'indptr' else nr_hits
+            earrays[name] = h5file.create_earray(group, name, atom=atom, shape=(0,),
+                                                 filters=cls.filters, expectedrows=max(1, expectedrows))
+        earrays['indptr'].append(indptr)
+        if nr_hits:
+            tmp_dir = tempfile.mkdtemp(prefix='kripodb-index-', dir=tmpdir)
+            try:
+                ids = np.lib.format.open_memmap(os.path.join(tmp_dir, 'ids.npy'), mode='w+',
+                                                dtype=np.uint32, shape=(nr_hits,))
+                scores = np.lib.format.open_memmap(os.path.join(tmp_dir, 'scores.npy'), mode='w+',
+                                                   dtype=np.uint16, shape=(nr_hits,))
+                # next free position in each row,
+                # hits of pairs where fragment is b are placed after hits of pairs where fragment is a,
+                # so hits with same score keep order of a pairs table scan
+                cursors = [('a', 'b', indptr[:-1].copy())]
+                if not full_matrix:
+                    cursors.append(('b', 'a', indptr[:-1] + a_counts))
+                for start in six.moves.range(0, nr_pairs, frame_size):
+                    frame = table.read(start=start, stop=start + frame_size)
+                    for query_column, hit_column, cursor in cursors:
+                        queries = frame[query_column]
+                        order = np.argsort(queries, kind='mergesort')
+                        queries = queries[order]
+                        # position of hit among the hits of the same query in this frame
+                        rank = np.arange(len(queries)) - np.searchsorted(queries, queries)
+                        positions = cursor[queries] + rank
+                        ids[positions] = frame[hit_column][order]
+                        scores[positions] = frame['score'][order]
+                        cursor += np.bincount(queries, minlength=nr_ids)
+                for start in six.moves.range(0, nr_hits, frame_size):
+                    earrays['ids'].append(ids[start:start + frame_size])
+                    earrays['scores'].append(scores[start:start + frame_size])
+                del ids, scores
+            finally:
+                shutil.rmtree(tmp_dir)
+        h5file.flush()
+        return cls(h5file)
+
+    def find(self, frag_id, scutoff):
+        """Find hits of fragment with a raw score of at least scutoff.
+
+        Args:
+            frag_id (int): Query fragment identifier
+            scutoff (int): Raw score cutoff
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Fragment identifiers of hits and their raw scores
+        """
+        if frag_id + 1 >= len(self.indptr):
+            return np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.uint16)
+        start, stop = self.indptr[frag_id:frag_id + 2]
+        ids = self.ids[start:stop]
+        scores = self.scores[start:stop]
+        above = scores >= scutoff
+        return self.unique_hits(ids[above], scores[above])
+
+    def find_many(self, frag_ids, scutoff):
+        """Find hits of each fragment with a raw score of at least scutoff.
+
+        The fragments are sorted and the neighbors of adjacent fragments are read at once.
+        Fragments whose neighbors are separated by less than a chunk are also read at once,
+        as the chunk in between is decompressed anyway.
+
+        Args:
+            frag_ids (list[int]): Query fragment identifiers
+            scutoff (int): Raw score cutoff
+
+        Returns:
+            dict[int, Tuple[np.ndarray, np.ndarray]]: Fragment identifiers of hits and their raw scores
+                for each query fragment identifier
+        """
+        nr_rows = len(self.indptr) - 1
+        frag_ids = np.unique(np.asarray(frag_ids, dtype=np.int64))
+        hits = {frag_id: (np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.uint16))
+                for frag_id in frag_ids[frag_ids >= nr_rows].tolist()}
+        frag_ids = frag_ids[frag_ids < nr_rows]
+        if len(frag_ids) == 0:
+            return hits
+
+        indptr = self.indptr[frag_ids[0]:frag_ids[-1] + 2]
+        starts = indptr[frag_ids - frag_ids[0]]
+        stops = indptr[frag_ids - frag_ids[0] + 1]
+        gap = self.ids.chunkshape[0]
+        breaks = np.flatnonzero(starts[1:] - stops[:-1] > gap) + 1
+        for run in np.split(np.arange(len(frag_ids)), breaks):
+            run_start = starts[run[0]]
+            ids = self.ids[run_start:stops[run[-1]]]
+            scores = self.scores[run_start:stops[run[-1]]]
+            for i in run.tolist():
+                start, stop = starts[i] - run_start, stops[i] - run_start
+                above = scores[start:stop] >= scutoff
+                hits[int(frag_ids[i])] = self.unique_hits(ids[start:stop][above], scores[start:stop][above])
+        return hits
+
+    @staticmethod
+    def unique_hits(ids, scores):
+        """Remove duplicate hits
+
+        Args:
+            ids (np.ndarray): Fragment identifiers of hits
+            scores (np.ndarray): Raw scores of hits
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Fragment identifiers of hits and their raw scores
+        """
+        unique_ids, first = np.unique(ids, return_index=True)
+        if len(unique_ids) != len(ids):
+            # pair found more than once, like a scan keep the position of the first and the score of the last
+            _, last = np.unique(ids[::-1], return_index=True)
+            last = len(ids) - 1 - last
+            order = np.argsort(first)
+            ids = unique_ids[order]
+            scores = scores[last[order]]
+        return ids, scores
+
+
 class Id2Label(tables.IsDescription):
     """Table description of id 2 label table."""
     frag_id = tables.UInt32Col()
@@ -549,13 +1045,11 @@ class LabelsLookup(AbstractSimpleTable):
         for r in self.table.__iter__():
             yield {'frag_id': r['frag_id'], 'label': r['label'].decode()}
 
-    def _copy(self, other, condition):
-        hit = other.table.row
-        for row in self.table:
-            if condition(row['frag_id']):
-                hit['frag_id'] = row['frag_id']
-                hit['label'] = row['label']
-                hit.append()
+    def _copy(self, other, frag_ids, invert=False):
+        frag_ids = np.array(sorted(frag_ids), dtype=np.int64)
+        for start in six.moves.range(0, len(self.table), self.append_chunk_size):
+            frame = self.table.read(start=start, stop=start + self.append_chunk_size)
+            other.table.append(frame[np.isin(frame['frag_id'], frag_ids, invert=invert)])
         other.table.flush()
 
     def keep(self, other, keep):
@@ -565,7 +1059,7 @@ class LabelsLookup(AbstractSimpleTable):
             other (LabelsLookup): Labels table to fill
             keep (set[int]): Fragment identifiers to keep
         """
-        self._copy(other, lambda d: d in keep)
+        self._copy(other, keep)
 
     def skip(self, other, skip):
         """Copy content of self to other and skip given fragment identifiers
@@ -574,4 +1068,4 @@ class LabelsLookup(AbstractSimpleTable):
             other (LabelsLookup): Labels table to fill
             skip (set[int]): Fragment identifiers to skip
         """
-        self._copy(other, lambda d: d not in skip)
+        self._copy(other, skip, invert=True)
@@ -14,6 +14,9 @@
 """Module to read/write fingerprints in Makebits file format"""
 
 from __future__ import absolute_import
+from itertools import islice
+
+import numpy as np
 from pyroaring import BitMap
 import six
 
@@ -84,6 +87,110 @@ def iter_file(infile):
         yield fid, bitset
 
 
+def read_bitsets_block(lines):
+    """Parse a block of Makebits formatted fingerprint lines at once.
+
+    The numbers of all lines are parsed by NumPy in one go and
+    the on bit checksums are validated for all fingerprints together.
+    Numbers on a line must be separated by a single space.
+
+    Args:
+        lines (List[str]): Fingerprint lines of a Makebits formatted file
+
+    Raises:
+        Exception: When on bit checksum of a fingerprint is incorrect
+
+    Returns:
+        Tuple[List[str], np.ndarray, np.ndarray]: Fingerprint identifiers,
+            bit positions of all fingerprints concatenated
+            and offsets into bit positions with fingerprint i having positions[offsets[i]:offsets[i + 1]]
+
+    Examples:
+        Parse two lines
+
+        >>> fids, positions, offsets = read_bitsets_block(['id1 1 2 3 4 0 4', 'id2 5 0 1'])
+        >>> fids
+        ['id1', 'id2']
+        >>> positions
+        array([1, 2, 3, 4, 5], dtype=uint32)
+        >>> offsets
+        array([0, 4, 5])
+
+    """
+    fids = []
+    numbers = []
+    for line in lines:
+        fid, _, rest = line.strip().partition(' ')
+        fids.append(fid)
+        numbers.append(rest)
+    if not fids:
+        return fids, np.empty(0, dtype=np.uint32), np.zeros(1, dtype=np.int64)
+    counts = np.array([len(rest) and rest.count(' ') + 1 for rest in numbers], dtype=np.int64)
+    text = '\n'.join(numbers)
+    values = np.fromstring(text, dtype=np.int64, sep=' ')
+    if len(values) != counts.sum() or (counts < 2).any():
+        raise Exception('Unable to parse fingerprints {} to {}'.format(fids[0], fids[-1]))
+
+    # each line ends with a 0 seperator and the number of on bits
+    ends = np.cumsum(counts)
+    nr_onbits = values[ends - 1]
+    bit_counts = counts - 2
+    wrong = (nr_onbits != bit_counts).nonzero()[0]
+    if len(wrong):
+        raise Exception('On bit checksum incorrect for {}'.format(fids[wrong[0]]))
+
+    is_bit = np.ones(len(values), dtype=bool)
+    is_bit[ends - 1] = False
+    is_bit[ends - 2] = False
+    positions = values[is_bit].astype(np.uint32)
+    offsets = np.zeros(len(fids) + 1, dtype=np.int64)
+    np.cumsum(bit_counts, out=offsets[1:])
+    return fids, positions, offsets
+
+
+def iter_file_blocks(infile, block_size=10000):
+    """Reads Makebits formatted file in blocks of fingerprints, see :func:`read_bitsets_block`.
+
+    Args:
+        infile (File): File object of Makebits formatted file to read
+        block_size (int): Number of fingerprints in a block
+
+    Yields:
+        first header (format name, format version, number of bits, description),
+        then tuples of fingerprint identifiers, bit positions and offsets of a block
+
+    """
+    header = read_header(infile.readline())
+    yield header
+    while True:
+        lines = list(islice(infile, block_size))
+        if not lines:
+            break
+        yield read_bitsets_block(lines)
+
+
+def iter_file_bulk(infile, block_size=10000):
+    """Reads Makebits formatted file like :func:`iter_file`, but parses blocks of lines at once.
+
+    Args:
+        infile (File): File object of Makebits formatted file to read
+        block_size (int): Number of fingerprints to parse in one go
+
+    Yields:
+        first header (format name, format version, number of bits, description),
+        then tuples of the fingerprint identifier and an BitMap object
+
+    """
+    blocks = iter_file_blocks(infile, block_size)
+    yield next(blocks)
+    for fids, positions, offsets in blocks:
+        # slicing a list is cheaper than constructing BitMap from many small arrays
+        positions = positions.tolist()
+        offsets = offsets.tolist()
+        for i, fid in enumerate(fids):
+            yield fid, BitMap(positions[offsets[i]:offsets[i + 1]])
+
+
 def write_header(fp_size):
     return "MAKEBITS 1.0 {} BigGrid\n".format(fp_size)
 
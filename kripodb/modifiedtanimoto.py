@@ -15,9 +15,20 @@
 """Module to calculate modified tanimoto similarity"""
 
 from __future__ import absolute_import
+from collections import deque, OrderedDict
+import heapq
+import json
 from math import fsum
+import multiprocessing
+import os
+
+import numpy as np
+from pyroaring import BitMap
 import six
 
+# Number of bits set for each possible byte value, used to count bits of packed bitsets
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
 
 def calc_mean_onbit_density(bitsets, number_of_bits):
     """Calculate the mean density of bits that are on in bitsets collection.
@@ -97,15 +108,20 @@ def similarity(bitset1, bitset2, number_of_bits, corr_st, corr_sto):
     return smt
 
 
-def similarities(bitsets1, bitsets2, number_of_bits, corr_st, corr_sto, cutoff, ignore_upper_triangle=False):
+def similarities(bitsets1, bitsets2, number_of_bits, corr_st, corr_sto, cutoff, ignore_upper_triangle=False,
+                 prune=False):
     """Calculate modified tanimoto similarity between two collections of fingerprints
 
     Excludes similarity of the same fingerprint.
 
+    When pruning, the pairs for which the number of on bits alone rules out a score above cutoff are skipped,
+    see :class:`PopcountPruner`. Pruning loads bitsets2 into memory,
+    unless it already is a :class:`PrunableBitsets`.
+
     Args:
         bitsets1 (Dict{str, pyroaring.BitMap}): First dict of fingerprints
             with fingerprint label as key and pyroaring.BitMap as value
-        bitsets2 (Dict{str, pyroaring.BitMap}): Second dict of fingerprints
+        bitsets2 (Dict{str, pyroaring.BitMap}|PrunableBitsets): Second dict of fingerprints
             with fingerprint label as key and pyroaring.BitMap as value
         number_of_bits (int): Number of bits for all fingerprints
         corr_st (float): St correction
@@ -113,13 +129,24 @@ def similarities(bitsets1, bitsets2, number_of_bits, corr_st, corr_sto, cutoff,
         cutoff (float): Cutoff, similarity scores below cutoff are discarded.
         ignore_upper_triangle (Optional[bool]): When true returns similarity where label1 > label2,
             when false returns all similarities
+        prune (Optional[bool]): When true skip pairs which can not reach cutoff based on their number of on bits
 
     Yields:
         (fingerprint label 1, fingerprint label2, similarity score)
 
     """
+    if prune:
+        if not isinstance(bitsets2, PrunableBitsets):
+            bitsets2 = PrunableBitsets(six.iteritems(bitsets2))
+        targets = bitsets2.targets
+        pruner = bitsets2.pruner(number_of_bits, corr_st, corr_sto, cutoff)
+
     for (label1, bs1) in six.iteritems(bitsets1):
-        for (label2, bs2) in six.iteritems(bitsets2):
+        if prune:
+            candidates = (targets[i] for i in pruner.candidates(len(bs1)))
+        else:
+            candidates = six.iteritems(bitsets2)
+        for (label2, bs2) in candidates:
             if label1 == label2:
                 # always skip self
                 continue
@@ -130,3 +157,671 @@ def similarities(bitsets1, bitsets2, number_of_bits, corr_st, corr_sto, cutoff,
 
             if score >= cutoff:
                 yield label1, label2, score
+
+
+def top_similarities(bitsets1, bitsets2, number_of_bits, corr_st, corr_sto, cutoff, top,
+                     ignore_upper_triangle=False):
+    """Calculate the most similar fingerprints of the second collection for each fingerprint in the first collection.
+
+    Targets are visited in order of their upper bound of similarity, see :meth:`PopcountPruner.ranked_ranges`,
+    while keeping the `top` best hits in a heap.
+    Once the heap is full and no remaining target can score higher than the worst hit in the heap, the search stops.
+    Loads bitsets2 into memory, unless it already is a :class:`PrunableBitsets`.
+
+    Args:
+        bitsets1 (Dict{str, pyroaring.BitMap}): First dict of fingerprints
+            with fingerprint label as key and pyroaring.BitMap as value
+        bitsets2 (Dict{str, pyroaring.BitMap}): Second dict of fingerprints
+            with fingerprint label as key and pyroaring.BitMap as value
+        number_of_bits (int): Number of bits for all fingerprints
+        corr_st (float): St correction
+        corr_sto (float): Sto correction
+        cutoff (float): Cutoff, similarity scores below cutoff are discarded.
+        top (int): Maximum number of hits for each fingerprint of first collection, at least 1
+        ignore_upper_triangle (Optional[bool]): When true returns similarity where label1 > label2,
+            when false returns all similarities
+
+    Yields:
+        (fingerprint label 1, fingerprint label2, similarity score),
+            for each fingerprint of first collection sorted on similarity score with highest score first
+
+    Raises:
+        ValueError: When top is below 1
+
+    """
+    if top < 1:
+        raise ValueError('Top must be at least 1, got {0}'.format(top))
+    if not isinstance(bitsets2, PrunableBitsets):
+        bitsets2 = PrunableBitsets(six.iteritems(bitsets2))
+    targets = bitsets2.targets
+    pruner = bitsets2.pruner(number_of_bits, corr_st, corr_sto, cutoff)
+
+    for (label1, bs1) in six.iteritems(bitsets1):
+        heap = []
+        for bound, start, stop in pruner.ranked_ranges(len(bs1)):
+            if len(heap) == top and bound <= heap[0][0]:
+                # no remaining target can enter the top
+                break
+            for target_idx in pruner.order[start:stop]:
+                label2, bs2 = targets[target_idx]
+                if label1 == label2:
+                    # always skip self
+                    continue
+                if ignore_upper_triangle and label1 > label2:
+                    continue
+
+                score = similarity(bs1, bs2, number_of_bits, corr_st, corr_sto)
+
+                if score < cutoff:
+                    continue
+                if len(heap) < top:
+                    heapq.heappush(heap, (score, label2))
+                elif score > heap[0][0]:
+                    heapq.heapreplace(heap, (score, label2))
+
+        for score, label2 in sorted(heap, reverse=True):
+            yield label1, label2, score
+
+
+def pack_bitsets(bitsets, number_of_bits):
+    """Pack collection of fingerprints into a dense bit matrix
+
+    Args:
+        bitsets (Iterable[Tuple[str, pyroaring.BitMap]]): Fingerprint label and fingerprint pairs
+        number_of_bits (int): Number of bits for all fingerprints
+
+    Returns:
+        Tuple[list[str], np.ndarray, np.ndarray]: Fingerprint labels,
+            matrix of uint64 with a row for each fingerprint and number of on bits of each fingerprint
+    """
+    labels = []
+    positions = []
+    for label, bitset in bitsets:
+        labels.append(label)
+        positions.append(np.fromiter(bitset, dtype=np.int64, count=len(bitset)))
+    offsets = np.zeros(len(labels) + 1, dtype=np.int64)
+    np.cumsum([len(p) for p in positions], out=offsets[1:])
+    bits = np.concatenate(positions) if positions else np.empty(0, dtype=np.int64)
+    matrix, popcounts = pack_positions(bits, offsets, number_of_bits)
+    return labels, matrix, popcounts
+
+
+def pack_positions(positions, offsets, number_of_bits):
+    """Pack bit positions of fingerprints into a dense bit matrix
+
+    Args:
+        positions (np.ndarray): Bit positions of all fingerprints concatenated, each position should occur once
+            per fingerprint
+        offsets (np.ndarray): Offsets into positions with fingerprint i having positions[offsets[i]:offsets[i + 1]],
+            as returned by :func:`kripodb.makebits.read_bitsets_block`
+        number_of_bits (int): Number of bits for all fingerprints
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Matrix of uint64 with a row for each fingerprint and
+            number of on bits of each fingerprint
+    """
+    nr_words = (number_of_bits + 63) // 64
+    popcounts = np.diff(offsets).astype(np.int64)
+    matrix = np.zeros((len(popcounts), nr_words), dtype=np.uint64)
+    if len(positions):
+        rows = np.repeat(np.arange(len(popcounts)), popcounts)
+        bits = positions.astype(np.int64)
+        np.bitwise_or.at(matrix, (rows, bits >> 6), np.left_shift(np.uint64(1), (bits & 63).astype(np.uint64)))
+    return matrix, popcounts
+
+
+class PackedBitsets(object):
+    """Collection of fingerprints packed into a dense bit matrix, see :func:`pack_bitsets`.
+
+    Can be saved to and loaded from a directory with a file for each array,
+    see :meth:`save` and :meth:`load`.
+
+    Args:
+        bitsets (Iterable[Tuple[str, pyroaring.BitMap]]): Fingerprint label and fingerprint pairs
+        number_of_bits (int): Number of bits for all fingerprints
+
+    Attributes:
+        labels (list[str]): Fingerprint labels
+        labels_array (np.ndarray): Fingerprint labels as array
+        matrix (np.ndarray): Bit matrix with a row for each fingerprint
+        popcounts (np.ndarray): Number of on bits of each fingerprint
+        number_of_bits (int): Number of bits for all fingerprints
+    """
+
+    def __init__(self, bitsets, number_of_bits):
+        self.labels, self.matrix, self.popcounts = pack_bitsets(bitsets, number_of_bits)
+        self.labels_array = np.array(self.labels)
+        self.number_of_bits = number_of_bits
+        self._sorted_on_popcount = None
+
+    @classmethod
+    def from_arrays(cls, labels_array, matrix, popcounts, number_of_bits):
+        """Construct from already packed arrays.
+
+        Args:
+            labels_array (np.ndarray): Fingerprint labels
+            matrix (np.ndarray): Bit matrix of uint64 with a row for each fingerprint
+            popcounts (np.ndarray): Number of on bits of each fingerprint
+            number_of_bits (int): Number of bits for all fingerprints
+
+        Returns:
+            PackedBitsets
+        """
+        packed = cls.__new__(cls)
+        packed.labels_array = labels_array
+        packed.labels = labels_array.tolist()
+        packed.matrix = matrix
+        packed.popcounts = popcounts
+        packed.number_of_bits = number_of_bits
+        packed._sorted_on_popcount = None
+        return packed
+
+    def save(self, directory):
+        """Save to directory as NumPy files.
+
+        The directory will contain `labels.npy`, `popcounts.npy`, `matrix.npy` and `attributes.json`.
+
+        Args:
+            directory (str): Name of directory, is created when it does not exist
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        np.save(os.path.join(directory, 'matrix.npy'), self.matrix)
+        _save_packed_attributes(directory, self.labels_array, self.popcounts, self.number_of_bits)
+
+    @classmethod
+    def pack(cls, bitsets, number_of_bits, directory, nr_fingerprints, block_size=1024):
+        """Pack fingerprints into directory, a block of fingerprints at a time.
+
+        Only a block of fingerprints is packed in memory,
+        the bit matrix is written into a memory-mapped `matrix.npy` file.
+        The directory is the same as written by :meth:`save`.
+
+        Args:
+            bitsets (Iterable[Tuple[str, pyroaring.BitMap]]): Fingerprint label and fingerprint pairs
+            number_of_bits (int): Number of bits for all fingerprints
+            directory (str): Name of directory, is created when it does not exist
+            nr_fingerprints (int): Number of fingerprints in bitsets
+            block_size (int): Number of fingerprints to pack in one go
+
+        Returns:
+            PackedBitsets: Memory-mapped packed fingerprints
+
+        Raises:
+            ValueError: When bitsets does not contain nr_fingerprints fingerprints
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        nr_words = (number_of_bits + 63) // 64
+        matrix = np.lib.format.open_memmap(os.path.join(directory, 'matrix.npy'), mode='w+',
+                                           dtype=np.uint64, shape=(nr_fingerprints, nr_words))
+        popcounts = np.zeros(nr_fingerprints, dtype=np.int64)
+        labels = []
+        for block in _iter_blocks(bitsets, block_size):
+            start = len(labels)
+            stop = start + len(block)
+            if stop > nr_fingerprints:
+                raise ValueError('More than {0} fingerprints to pack'.format(nr_fingerprints))
+            block_labels, block_matrix, block_popcounts = pack_bitsets(block, number_of_bits)
+            matrix[start:stop] = block_matrix
+            popcounts[start:stop] = block_popcounts
+            labels.extend(block_labels)
+        if len(labels) != nr_fingerprints:
+            raise ValueError('Expected {0} fingerprints to pack, got {1}'.format(nr_fingerprints, len(labels)))
+        matrix.flush()
+        del matrix
+        _save_packed_attributes(directory, np.array(labels), popcounts, number_of_bits)
+        return cls.load(directory)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """Load from directory written by :meth:`save`.
+
+        Args:
+            directory (str): Name of directory
+            mmap_mode (Optional[str]): Memory-map the arrays with this mode, see :func:`numpy.load`.
+                Use None to read the arrays into memory.
+
+        Returns:
+            PackedBitsets
+        """
+        with open(os.path.join(directory, 'attributes.json')) as f:
+            attributes = json.load(f)
+        return cls.from_arrays(np.load(os.path.join(directory, 'labels.npy'), mmap_mode=mmap_mode),
+                               np.load(os.path.join(directory, 'matrix.npy'), mmap_mode=mmap_mode),
+                               np.load(os.path.join(directory, 'popcounts.npy'), mmap_mode=mmap_mode),
+                               attributes['number_of_bits'],
+                               )
+
+    def __len__(self):
+        return len(self.labels)
+
+    def iter_blocks(self, block_size):
+        """Iterate over consecutive blocks of packed fingerprints.
+
+        Args:
+            block_size (int): Number of fingerprints in a block
+
+        Yields:
+            Tuple[list[str], np.ndarray, np.ndarray]: Fingerprint labels,
+                bit matrix and number of on bits of fingerprints in block
+        """
+        for start in six.moves.range(0, len(self), block_size):
+            stop = start + block_size
+            yield self.labels[start:stop], self.matrix[start:stop], self.popcounts[start:stop]
+
+    def items(self, block_size=1024):
+        """Unpack fingerprints.
+
+        Args:
+            block_size (int): Number of fingerprints to unpack in one go
+
+        Yields:
+            Tuple[str, pyroaring.BitMap]: Fingerprint label and fingerprint
+        """
+        for labels, matrix, popcounts in self.iter_blocks(block_size):
+            # bit i of a fingerprint is bit i % 8 of byte i // 8 of the little endian words,
+            # unpackbits yields the most significant bit of a byte first, so reverse the bits of each byte
+            bits = np.unpackbits(matrix.astype('<u8').view(np.uint8), axis=1)
+            bits = bits.reshape(len(labels), -1, 8)[:, :, ::-1].reshape(len(labels), -1)
+            positions = np.split(np.nonzero(bits)[1], np.cumsum(popcounts)[:-1])
+            for label, position in zip(labels, positions):
+                yield label, BitMap(position.astype(np.uint32))
+
+    iteritems = items
+
+    def sorted_on_popcount(self):
+        """Rows of bit matrix sorted on number of on bits.
+
+        The sorted matrix is computed once and reused.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: Original row index, bit matrix and number of on bits
+                of each sorted row
+        """
+        if self._sorted_on_popcount is None:
+            order = np.argsort(self.popcounts, kind='mergesort')
+            self._sorted_on_popcount = (order, self.matrix[order], self.popcounts[order])
+        return self._sorted_on_popcount
+
+
+def _save_packed_attributes(directory, labels_array, popcounts, number_of_bits):
+    np.save(os.path.join(directory, 'labels.npy'), labels_array.astype(six.text_type))
+    np.save(os.path.join(directory, 'popcounts.npy'), popcounts)
+    with open(os.path.join(directory, 'attributes.json'), 'w') as f:
+        json.dump({'number_of_bits': number_of_bits}, f)
+
+
+def intersection_cardinalities(query_matrix, target_matrix, buffer_size=2**26):
+    """Count bits set in both fingerprints for each query and target fingerprint combination.
+
+    Args:
+        query_matrix (np.ndarray): Packed query fingerprints, see :func:`pack_bitsets`
+        target_matrix (np.ndarray): Packed target fingerprints, see :func:`pack_bitsets`
+        buffer_size (int): Maximum number of bytes used for intermediate results.
+
+    Returns:
+        np.ndarray: Matrix with a row for each query and column for each target
+    """
+    nr_queries, nr_words = query_matrix.shape
+    nr_targets = target_matrix.shape[0]
+    counts = np.zeros((nr_queries, nr_targets), dtype=np.int64)
+    step = max(1, buffer_size // max(1, nr_queries * nr_words * 8))
+    for start in six.moves.range(0, nr_targets, step):
+        stop = start + step
+        both = np.bitwise_and(query_matrix[:, np.newaxis, :], target_matrix[np.newaxis, start:stop, :])
+        bytes_ = both.view(np.uint8).reshape(both.shape[0], both.shape[1], -1)
+        counts[:, start:stop] = POPCOUNT_TABLE[bytes_].sum(axis=2, dtype=np.int64)
+    return counts
+
+
+def packed_similarities(bitsets1, bitsets2, number_of_bits, corr_st, corr_sto, cutoff,
+                        ignore_upper_triangle=False, block_size=128, prune=False):
+    """Calculate modified tanimoto similarity between two collections of fingerprints using packed bit matrices
+
+    Same as :func:`similarities`, but instead of comparing one pair of fingerprints at a time,
+    a block of fingerprints of the first collection is compared with all fingerprints of the second collection at once.
+
+    The second collection is completely loaded in memory as a bit matrix,
+    requiring `number_of_bits / 8` bytes per fingerprint.
+
+    Args:
+        bitsets1 (Dict{str, pyroaring.BitMap}|PackedBitsets): First dict of fingerprints
+            with fingerprint label as key and pyroaring.BitMap as value or already packed fingerprints
+        bitsets2 (Dict{str, pyroaring.BitMap}|PackedBitsets): Second dict of fingerprints
+            with fingerprint label as key and pyroaring.BitMap as value or already packed fingerprints
+        number_of_bits (int): Number of bits for all fingerprints
+        corr_st (float): St correction
+        corr_sto (float): Sto correction
+        cutoff (float): Cutoff, similarity scores below cutoff are discarded.
+        ignore_upper_triangle (Optional[bool]): When true returns similarity where label1 > label2,
+            when false returns all similarities
+        block_size (int): Number of fingerprints of first collection to compare in one go
+        prune (Optional[bool]): When true skip pairs which can not reach cutoff based on their number of on bits,
+            see :class:`PopcountPruner`
+
+    Yields:
+        (fingerprint label 1, fingerprint label2, similarity score)
+
+    """
+    if not isinstance(bitsets2, PackedBitsets):
+        bitsets2 = PackedBitsets(six.iteritems(bitsets2), number_of_bits)
+    if not len(bitsets2):
+        return
+    labels2 = bitsets2.labels
+    labels2_array = bitsets2.labels_array
+    if prune:
+        # targets ordered on number of on bits, so the candidates of a query are a contiguous slice
+        order, matrix2, popcounts2 = bitsets2.sorted_on_popcount()
+        pruner = PopcountPruner(popcounts2, number_of_bits, corr_st, corr_sto, cutoff)
+    else:
+        matrix2 = bitsets2.matrix
+        popcounts2 = bitsets2.popcounts
+
+    if isinstance(bitsets1, PackedBitsets):
+        blocks = bitsets1.iter_blocks(block_size)
+    else:
+        blocks = (pack_bitsets(block, number_of_bits) for block in _iter_blocks(six.iteritems(bitsets1), block_size))
+
+    for labels1, matrix1, popcounts1 in blocks:
+        if not prune:
+            c = intersection_cardinalities(matrix1, matrix2)
+            scores = modified_tanimoto(popcounts1[:, np.newaxis], popcounts2[np.newaxis, :], c,
+                                       number_of_bits, corr_st, corr_sto)
+            for row, label1 in enumerate(labels1):
+                cols = (scores[row] >= cutoff).nonzero()[0]
+                for pair in _label_hits(label1, cols, scores[row, cols], labels2, labels2_array,
+                                        ignore_upper_triangle):
+                    yield pair
+        else:
+            for row, label1 in enumerate(labels1):
+                start, stop = pruner.range(popcounts1[row])
+                c = intersection_cardinalities(matrix1[row:row + 1], matrix2[start:stop])[0]
+                row_scores = modified_tanimoto(popcounts1[row], popcounts2[start:stop], c,
+                                               number_of_bits, corr_st, corr_sto)
+                hits = (row_scores >= cutoff).nonzero()[0]
+                # back to order of bitsets2
+                cols = order[start + hits]
+                cols_order = np.argsort(cols)
+                for pair in _label_hits(label1, cols[cols_order], row_scores[hits][cols_order], labels2, labels2_array,
+                                        ignore_upper_triangle):
+                    yield pair
+
+
+def _iter_blocks(items, block_size):
+    block = []
+    for item in items:
+        block.append(item)
+        if len(block) == block_size:
+            yield block
+            block = []
+    if block:
+        yield block
+
+
+def _label_hits(label1, cols, scores, labels2, labels2_array, ignore_upper_triangle):
+    hit_labels = labels2_array[cols]
+    # always skip self
+    mask = hit_labels != label1
+    if ignore_upper_triangle:
+        mask &= hit_labels >= label1
+    for col, score in zip(cols[mask], scores[mask]):
+        yield label1, labels2[col], float(score)
+
+
+def modified_tanimoto(a, b, c, number_of_bits, corr_st, corr_sto):
+    """Vectorized version of :func:`similarity` which works on numbers of on bits.
+
+    Args:
+        a (np.ndarray): Number of on bits in first fingerprint(s)
+        b (np.ndarray): Number of on bits in second fingerprint(s)
+        c (np.ndarray): Number of on bits in both fingerprints
+        number_of_bits (int): Number of bits for all fingerprints
+        corr_st (float): St correction
+        corr_sto (float): Sto correction
+
+    Returns:
+        np.ndarray: Modified Tanimoto similarities, NaN when both fingerprints have no bits on
+    """
+    n = number_of_bits
+    with np.errstate(divide='ignore', invalid='ignore'):
+        st = c / np.asarray(a + b - c, dtype=np.float64)
+        st0 = (n - a - b + c) / np.asarray(n - c, dtype=np.float64)
+        return corr_st * st + corr_sto * st0
+
+
+def similarity_upper_bound(a, b, number_of_bits, corr_st, corr_sto):
+    """Highest possible modified Tanimoto similarity between fingerprints with a and b bits on.
+
+    Both S\ :sub:`T` and S\ :sub:`T0` increase with c, the number of bits set in both fingerprints,
+    so the similarity is highest when c equals the smallest of a and b.
+
+    Args:
+        a (int|np.ndarray): Number of on bits in first fingerprint(s)
+        b (int|np.ndarray): Number of on bits in second fingerprint(s)
+        number_of_bits (int): Number of bits for all fingerprints
+        corr_st (float): St correction
+        corr_sto (float): Sto correction
+
+    Returns:
+        np.ndarray: Upper bound of modified Tanimoto similarity
+    """
+    return modified_tanimoto(a, b, np.minimum(a, b), number_of_bits, corr_st, corr_sto)
+
+
+class PopcountPruner(object):
+    """Finds target fingerprints which could have a similarity above cutoff with a query fingerprint
+
+    Uses :func:`similarity_upper_bound` on the number of on bits of the query and target fingerprints.
+    The upper bound rises until the number of on bits of the target equals the one of the query and then falls,
+    so the candidates form a contiguous range of targets sorted on number of on bits.
+
+    Args:
+        popcounts (np.ndarray): Number of on bits of each target fingerprint
+        number_of_bits (int): Number of bits for all fingerprints
+        corr_st (float): St correction
+        corr_sto (float): Sto correction
+        cutoff (float): Cutoff, similarity scores below cutoff are discarded.
+
+    Attributes:
+        order (np.ndarray): Indices of targets sorted on number of on bits
+        sorted_popcounts (np.ndarray): Number of on bits of targets in sorted order
+    """
+
+    def __init__(self, popcounts, number_of_bits, corr_st, corr_sto, cutoff):
+        self.order = np.argsort(popcounts, kind='mergesort')
+        self.sorted_popcounts = popcounts[self.order]
+        self.unique_popcounts, self.unique_starts = np.unique(self.sorted_popcounts, return_index=True)
+        self.unique_stops = np.append(self.unique_starts[1:], len(self.sorted_popcounts))
+        self.number_of_bits = number_of_bits
+        self.corr_st = corr_st
+        self.corr_sto = corr_sto
+        self.cutoff = cutoff
+
+    def range(self, a):
+        """Range of sorted targets which could be above cutoff.
+
+        Args:
+            a (int): Number of on bits of query fingerprint
+
+        Returns:
+            Tuple[int, int]: Start and stop index into sorted targets
+        """
+        allowed = (self._bounds(a) >= self.cutoff).nonzero()[0]
+        if len(allowed) == 0:
+            return 0, 0
+        return int(self.unique_starts[allowed[0]]), int(self.unique_stops[allowed[-1]])
+
+    def ranked_ranges(self, a):
+        """Ranges of sorted targets with the same number of on bits, the range with highest upper bound first.
+
+        Ranges which can not reach cutoff are skipped.
+
+        Args:
+            a (int): Number of on bits of query fingerprint
+
+        Yields:
+            Tuple[float, int, int]: Upper bound of similarity and start and stop index into sorted targets
+        """
+        bounds = self._bounds(a)
+        for i in np.argsort(-bounds, kind='mergesort'):
+            if not bounds[i] >= self.cutoff:
+                break
+            yield float(bounds[i]), int(self.unique_starts[i]), int(self.unique_stops[i])
+
+    def _bounds(self, a):
+        return similarity_upper_bound(a, self.unique_popcounts, self.number_of_bits, self.corr_st, self.corr_sto)
+
+    def candidates(self, a):
+        """Indices of targets which could be above cutoff.
+
+        Args:
+            a (int): Number of on bits of query fingerprint
+
+        Returns:
+            np.ndarray: Indices of targets in original order
+        """
+        start, stop = self.range(a)
+        return np.sort(self.order[start:stop])
+
+
+class PrunableBitsets(object):
+    """Fingerprints in memory with their number of on bits, to compare many collections with while pruning.
+
+    The :class:`PopcountPruner` of a cutoff is made once and reused,
+    so :func:`similarities` and :func:`top_similarities` do not collect and sort the fingerprints on each call.
+
+    Args:
+        bitsets (Iterable[Tuple[str, pyroaring.BitMap]]): Fingerprint label and fingerprint pairs
+
+    Attributes:
+        targets (list[Tuple[str, pyroaring.BitMap]]): Fingerprint label and fingerprint pairs
+        popcounts (np.ndarray): Number of on bits of each fingerprint
+    """
+
+    def __init__(self, bitsets):
+        self.targets = list(bitsets)
+        self.popcounts = np.array([len(bs) for _, bs in self.targets], dtype=np.int64)
+        self._pruners = {}
+
+    def __len__(self):
+        return len(self.targets)
+
+    def items(self):
+        return iter(self.targets)
+
+    iteritems = items
+
+    def pruner(self, number_of_bits, corr_st, corr_sto, cutoff):
+        """Pruner of fingerprints, made once for each combination of arguments
+
+        Args:
+            number_of_bits (int): Number of bits for all fingerprints
+            corr_st (float): St correction
+            corr_sto (float): Sto correction
+            cutoff (float): Cutoff, similarity scores below cutoff are discarded.
+
+        Returns:
+            PopcountPruner
+        """
+        key = (number_of_bits, corr_st, corr_sto, cutoff)
+        if key not in self._pruners:
+            self._pruners[key] = PopcountPruner(self.popcounts, number_of_bits, corr_st, corr_sto, cutoff)
+        return self._pruners[key]
+
+
+# State of a worker process of parallel_similarities
+_worker = {}
+
+
+def _init_worker(similarities_func, bitsets2, kwargs):
+    _worker['similarities_func'] = similarities_func
+    _worker['bitsets2'] = bitsets2
+    _worker['kwargs'] = kwargs
+
+
+def _tile_similarities(tile):
+    bitsets1 = tile if isinstance(tile, PackedBitsets) else OrderedDict(tile)
+    return list(_worker['similarities_func'](bitsets1, _worker['bitsets2'], **_worker['kwargs']))
+
+
+def _iter_tiles(bitsets1, tile_size):
+    if not isinstance(bitsets1, PackedBitsets):
+        for tile in _iter_blocks(six.iteritems(bitsets1), tile_size):
+            yield tile
+        return
+    # rows stay packed, so they are not unpacked here and packed again in the worker
+    for start in six.moves.range(0, len(bitsets1), tile_size):
+        stop = start + tile_size
+        yield PackedBitsets.from_arrays(np.asarray(bitsets1.labels_array[start:stop]),
+                                        np.asarray(bitsets1.matrix[start:stop]),
+                                        np.asarray(bitsets1.popcounts[start:stop]),
+                                        bitsets1.number_of_bits)
+
+
+def parallel_similarities(similarities_func, bitsets1, bitsets2, number_of_bits, corr_st, corr_sto, cutoff,
+                          ignore_upper_triangle=False, prune=False, workers=2, tile_size=1000):
+    """Calculate modified tanimoto similarity between two collections of fingerprints using a pool of processes
+
+    The first collection is split in tiles of `tile_size` fingerprints,
+    each tile is compared with the second collection in a worker process using `similarities_func`.
+    A tile of a :class:`PackedBitsets` first collection is sent to the worker as packed rows.
+    The second collection is prepared once, packed for :func:`packed_similarities` and
+    made a :class:`PrunableBitsets` when pruning with :func:`similarities`,
+    and handed to the workers once when they start,
+    on platforms which fork processes the workers share the memory of the second collection.
+    Results are yielded in the same order as `similarities_func` would yield them in a single process.
+
+    Args:
+        similarities_func (function): Function to calculate similarities between a tile and second collection,
+            :func:`similarities` or :func:`packed_similarities`
+        bitsets1 (Dict{str, pyroaring.BitMap}|PackedBitsets): First collection of fingerprints
+        bitsets2 (Dict{str, pyroaring.BitMap}|PackedBitsets|PrunableBitsets): Second collection of fingerprints,
+            must be in memory, so not a :class:`kripodb.db.IntbitsetDict`
+        number_of_bits (int): Number of bits for all fingerprints
+        corr_st (float): St correction
+        corr_sto (float): Sto correction
+        cutoff (float): Cutoff, similarity scores below cutoff are discarded.
+        ignore_upper_triangle (Optional[bool]): When true returns similarity where label1 > label2,
+            when false returns all similarities
+        prune (Optional[bool]): When true skip pairs which can not reach cutoff based on their number of on bits
+        workers (int): Number of worker processes
+        tile_size (int): Number of fingerprints of first collection to compare in one worker task
+
+    Yields:
+        (fingerprint label 1, fingerprint label2, similarity score)
+
+    """
+    kwargs = {
+        'number_of_bits': number_of_bits,
+        'corr_st': corr_st,
+        'corr_sto': corr_sto,
+        'cutoff': cutoff,
+        'ignore_upper_triangle': ignore_upper_triangle,
+        'prune': prune,
+    }
+    if similarities_func is packed_similarities:
+        if not isinstance(bitsets2, PackedBitsets):
+            bitsets2 = PackedBitsets(six.iteritems(bitsets2), number_of_bits)
+        if prune:
+            bitsets2.sorted_on_popcount()
+    elif prune:
+        if not isinstance(bitsets2, PrunableBitsets):
+            bitsets2 = PrunableBitsets(six.iteritems(bitsets2))
+        bitsets2.pruner(number_of_bits, corr_st, corr_sto, cutoff)
+    pool = multiprocessing.Pool(workers, _init_worker, (similarities_func, bitsets2, kwargs))
+    try:
+        # bitsets1 is read in this process and only a few tiles are in flight,
+        # so memory usage stays bounded and results can be yielded in order
+        pending = deque()
+        for tile in _iter_tiles(bitsets1, tile_size):
+            pending.append(pool.apply_async(_tile_similarities, (tile,)))
+            if len(pending) >= 2 * workers:
+                for pair in pending.popleft().get():
+                    yield pair
+        while pending:
+            for pair in pending.popleft().get():
+                yield pair
+    finally:
+        pool.terminate()
+        pool.join()
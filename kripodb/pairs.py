@@ -15,13 +15,19 @@
 
 from __future__ import absolute_import
 
+from itertools import groupby
+
+import numpy as np
 import tables
+import six
 
 import logging
-from kripodb.frozen import FrozenSimilarityMatrix
+from kripodb.frozen import FrozenSimilarityMatrix, FrozenSparseSimilarityMatrix
 
+from .db import FingerprintsIndex
 from .hdf5 import SimilarityMatrix
-from .modifiedtanimoto import similarities, corrections
+from .modifiedtanimoto import similarities, packed_similarities, parallel_similarities, top_similarities, corrections
+from .modifiedtanimoto import PackedBitsets
 from .webservice.client import WebserviceClient
 
 
@@ -35,7 +41,10 @@ def dump_pairs(bitsets1,
                cutoff,
                label2id,
                nomemory,
-               ignore_upper_triangle=False):
+               ignore_upper_triangle=False,
+               engine='roaring',
+               prune=False,
+               workers=1):
     """Dump pairs of bitset collection.
 
     A pairs are rows of the bitset identifier of both bitsets with a similarity score.
@@ -55,15 +64,32 @@ def dump_pairs(bitsets1,
         nomemory: If true bitset2 is not loaded into memory
         ignore_upper_triangle: When true returns similarity where label1 > label2,
             when false returns all similarities
+        engine (str): Similarity engine to use.
+            'roaring' compares one pair of bitsets at a time,
+            'packed' compares blocks of bitsets1 against whole of bitsets2 using packed bit matrices,
+            see :func:`kripodb.modifiedtanimoto.packed_similarities`.
+            The 'packed' engine always loads bitsets2 into memory,
+            unless it is already a :class:`kripodb.modifiedtanimoto.PackedBitsets`.
+        prune (bool): When true skip pairs which can not reach cutoff based on their number of on bits,
+            see :class:`kripodb.modifiedtanimoto.PopcountPruner`
+        workers (int): Number of processes to compute similarities with.
+            When more than 1, bitsets1 is split into tiles which are computed in a pool of processes
+            and bitsets2 is always loaded into memory, see :func:`kripodb.modifiedtanimoto.parallel_similarities`.
 
     """
     if out_file == '-' and out_format.startswith('hdf5'):
         raise Exception("hdf5 formats can't be outputted to stdout")
 
-    if not nomemory:
-        # load whole dict in memory so it can be reused for each bitset1
-        # deserialization of bitsets2 is only done one time
-        bitsets2 = bitsets2.materialize()
+    if engine == 'roaring':
+        similarities_func = similarities
+        if not nomemory or workers > 1:
+            # load whole dict in memory so it can be reused for each bitset1
+            # deserialization of bitsets2 is only done one time
+            bitsets2 = bitsets2.materialize()
+    elif engine == 'packed':
+        similarities_func = packed_similarities
+    else:
+        raise LookupError('Invalid engine')
 
     expectedrows = len(bitsets1) * len(bitsets2) * cutoff * 0.025
 
@@ -71,10 +97,20 @@ def dump_pairs(bitsets1,
 
     logging.warning('Generating pairs')
 
-    similarities_iter = similarities(bitsets1, bitsets2,
-                                     number_of_bits, corr_st, corr_sto,
-                                     cutoff,
-                                     ignore_upper_triangle)
+    if workers > 1:
+        similarities_iter = parallel_similarities(similarities_func,
+                                                  bitsets1, bitsets2,
+                                                  number_of_bits, corr_st, corr_sto,
+                                                  cutoff,
+                                                  ignore_upper_triangle,
+                                                  prune,
+                                                  workers)
+    else:
+        similarities_iter = similarities_func(bitsets1, bitsets2,
+                                              number_of_bits, corr_st, corr_sto,
+                                              cutoff,
+                                              ignore_upper_triangle,
+                                              prune=prune)
 
     if out_format == 'tsv':
         dump_pairs_tsv(similarities_iter, out)
@@ -103,6 +139,49 @@ def dump_pairs_tsv(similarities_iter, out):
         out.write('{0}\t{1}\t{2:.5}\n'.format(label1, label2, similarity))
 
 
+def export_pairs_tsv(similarity_matrix, out, frag1=False, pdbs=None):
+    """Write pairs of similarity matrix to tab delimited file, a frame of pairs at a time
+
+    The filters are applied with a boolean mask of the fragments of the matrix.
+
+    Args:
+        similarity_matrix (SimilarityMatrix | FrozenSimilarityMatrix | FrozenSparseSimilarityMatrix): Matrix to export
+        out (File): Writeable file
+        frag1 (bool): Only write pairs of which both fragments are \*frag1
+        pdbs (set[str]): Only write pairs of which both fragments are from these lower case pdb codes.
+            Default is None for all pdb codes.
+    """
+    mask = None
+    if frag1 or pdbs is not None:
+        if isinstance(similarity_matrix, SimilarityMatrix):
+            similarity_matrix._build_label_cache()
+        mask = label_mask(similarity_matrix.cache_labels, frag1, pdbs)
+    for labels1, labels2, scores in similarity_matrix.iter_frames(mask=mask):
+        out.write(''.join(['{0}\t{1}\t{2!r}\n'.format(*pair)
+                           for pair in zip(labels1.tolist(), labels2.tolist(), scores.tolist())]))
+
+
+def label_mask(labels, frag1=False, pdbs=None):
+    """Boolean mask of fragment labels which pass filters
+
+    Args:
+        labels (np.ndarray): Fragment labels, None for fragment identifiers without a label
+        frag1 (bool): Only pass \*frag1 fragments
+        pdbs (set[str]): Only pass fragments which are from these pdb codes. Default is None for all pdb codes.
+
+    Returns:
+        np.ndarray: Boolean for each label
+    """
+    labels = np.array(['' if label is None else label for label in labels], dtype=six.text_type)
+    mask = np.ones(len(labels), dtype=bool)
+    if frag1:
+        mask &= np.char.endswith(labels, 'frag1')
+    if pdbs is not None:
+        # first 4 characters of label are the pdb code
+        mask &= np.isin(labels.astype('<U4'), list(pdbs))
+    return mask
+
+
 def dump_pairs_hdf5(similarities_iter,
                     label2id,
                     expectedrows,
@@ -130,7 +209,7 @@ def dump_pairs_hdf5(similarities_iter,
     matrix.close()
 
 
-def similarity2query(bitsets2, query, out, mean_onbit_density, cutoff, memory):
+def similarity2query(bitsets2, query, out, mean_onbit_density, cutoff, memory, prune=False, index=False, top=None):
     """Calculate similarity of query against all fingerprints in bitsets2 and write to tab delimited file.
 
     Args:
@@ -140,6 +219,11 @@ def similarity2query(bitsets2, query, out, mean_onbit_density, cutoff, memory):
         mean_onbit_density (flaot): Mean on bit density
         cutoff (float): Cutoff, similarity scores below cutoff are discarded.
         memory (Optional[bool]): When true will load bitset2 into memory, when false it doesn't
+        prune (Optional[bool]): When true skip fingerprints which can not reach cutoff based on their number of on bits
+        index (Optional[bool]): When true use inverted index of fingerprints db,
+            see :class:`kripodb.db.FingerprintsIndex`
+        top (Optional[int]): Maximum number of hits for each query, see :func:`kripodb.modifiedtanimoto.top_similarities`.
+            Default is None for no limit.
 
     """
     number_of_bits = bitsets2.number_of_bits
@@ -153,20 +237,101 @@ def similarity2query(bitsets2, query, out, mean_onbit_density, cutoff, memory):
         # all bitsets which have a key that starts with query
         bitsets1 = {k: v for k, v in bitsets2.iteritems_startswith(query)}
 
-        if memory:
+        if memory and not index:
             # load whole dict in memory so it can be reused for each bitset1
             # deserialization of bitset2 is only done one time
             bitsets2 = bitsets2.materialize()
 
     (corr_st, corr_sto) = corrections(mean_onbit_density)
 
-    similarities_iter = similarities(bitsets1, bitsets2,
-                               number_of_bits, corr_st, corr_sto,
-                               cutoff, True)
+    if index:
+        fingerprints_index = FingerprintsIndex(bitsets2.connection)
+        similarities_iter = fingerprints_index.similarities(bitsets1,
+                                                            number_of_bits, corr_st, corr_sto,
+                                                            cutoff, True, top)
+    elif top is not None:
+        similarities_iter = top_similarities(bitsets1, bitsets2,
+                                             number_of_bits, corr_st, corr_sto,
+                                             cutoff, top, True)
+    else:
+        similarities_iter = similarities(bitsets1, bitsets2,
+                                         number_of_bits, corr_st, corr_sto,
+                                         cutoff, True, prune)
     sorted_similarities = sorted(similarities_iter, key=lambda row: row[2], reverse=True)
     dump_pairs_tsv(sorted_similarities, out)
 
 
+def similarity2queries(bitsets2, queries, out_format, out_file, out, mean_onbit_density, cutoff,
+                        label2id=None, prune=False, top=None, block_size=128):
+    """Calculate similarity of many queries against all fingerprints in bitsets2 and write to a single output.
+
+    The fingerprints of bitsets2 are loaded into memory once as a packed bit matrix and
+    blocks of query fingerprints are compared against it at once,
+    see :func:`kripodb.modifiedtanimoto.packed_similarities`.
+
+    For each query the same hits as :func:`similarity2query` are written,
+    sorted on similarity score with highest score first.
+
+    Args:
+        bitsets2 (kripodb.db.IntbitsetDict): Fingerprints to search in
+        queries (Iterable[str]): Query identifiers or beginnings of them
+        out_format: 'tsv' or 'hdf5'
+        out_file: Filename of output file where 'hdf5' format is written to.
+        out (File): File object where 'tsv' format is written to.
+        mean_onbit_density (float): Mean on bit density
+        cutoff (float): Cutoff, similarity scores below cutoff are discarded.
+        label2id (dict): dict to translate label to id (string to int), only required for 'hdf5' format
+        prune (Optional[bool]): When true skip fingerprints which can not reach cutoff based on their number of on bits
+        top (Optional[int]): Maximum number of hits for each query. Default is None for no limit.
+        block_size (int): Number of query fingerprints to compare in one go
+
+    """
+    if out_file == '-' and out_format.startswith('hdf5'):
+        raise Exception("hdf5 formats can't be outputted to stdout")
+
+    number_of_bits = bitsets2.number_of_bits
+    bitsets1 = _query_bitsets(bitsets2, queries)
+    targets = PackedBitsets(six.iteritems(bitsets2), number_of_bits)
+
+    (corr_st, corr_sto) = corrections(mean_onbit_density)
+
+    similarities_iter = packed_similarities(bitsets1, targets,
+                                            number_of_bits, corr_st, corr_sto,
+                                            cutoff, True, block_size, prune)
+    sorted_similarities = _sorted_query_hits(similarities_iter, top)
+
+    if out_format == 'tsv':
+        dump_pairs_tsv(sorted_similarities, out)
+    elif out_format == 'hdf5':
+        expectedrows = len(bitsets1) * len(targets) * cutoff * 0.025
+        dump_pairs_hdf5(sorted_similarities,
+                        label2id,
+                        expectedrows,
+                        out_file)
+    else:
+        raise LookupError('Invalid output format')
+
+
+def _query_bitsets(bitsets, queries):
+    query_bitsets = {}
+    for query in queries:
+        if query in bitsets:
+            # exact match
+            query_bitsets[query] = bitsets[query]
+        else:
+            # all bitsets which have a key that starts with query
+            query_bitsets.update(bitsets.iteritems_startswith(query))
+    return query_bitsets
+
+
+def _sorted_query_hits(similarities_iter, top=None):
+    # hits of a query are adjacent, sort them per query
+    for _, hits in groupby(similarities_iter, key=lambda row: row[0]):
+        sorted_hits = sorted(hits, key=lambda row: row[2], reverse=True)
+        for hit in sorted_hits[:top]:
+            yield hit
+
+
 def similar_run(query, pairsdbfn, cutoff, out):
     """Find similar fragments to query based on similarity matrix and write to tab delimited file.
 
@@ -189,24 +354,28 @@ def similar_run(query, pairsdbfn, cutoff, out):
         matrix.close()
 
 
-def open_similarity_matrix(fn):
+def open_similarity_matrix(fn, row_cache_size=0):
     """Open read-only similarity matrix file.
 
     Args:
         fn (str): Filename of similarity matrix
+        row_cache_size (int): Maximum number of bytes of rows or hits to cache, default is 0 for no cache
 
     Returns:
-        SimilarityMatrix | FrozenSimilarityMatrix: A read-only similarity matrix object
+        SimilarityMatrix | FrozenSimilarityMatrix | FrozenSparseSimilarityMatrix: A read-only similarity matrix object
 
     """
     # peek in file to detect format
     f = tables.open_file(fn, 'r')
-    is_frozen = 'scores' in f.root
+    is_sparse = FrozenSparseSimilarityMatrix.is_sparse(f)
+    is_frozen = FrozenSimilarityMatrix.is_frozen(f)
     f.close()
-    if is_frozen:
-        matrix = FrozenSimilarityMatrix(fn)
+    if is_sparse:
+        matrix = FrozenSparseSimilarityMatrix(fn, row_cache_size=row_cache_size)
+    elif is_frozen:
+        matrix = FrozenSimilarityMatrix(fn, row_cache_size=row_cache_size)
     else:
-        matrix = SimilarityMatrix(fn, cache_labels=True)
+        matrix = SimilarityMatrix(fn, cache_labels=True, row_cache_size=row_cache_size)
     return matrix
 
 
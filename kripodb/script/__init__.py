@@ -64,6 +64,11 @@ def serve_sc(subparsers):
                     type=str,
                     default='http://localhost:8084/kripo',
                     help='URL which should be used in Swagger spec (default: %(default)s)')
+    sc.add_argument('--row_cache_size',
+                    type=int,
+                    default=0,
+                    help='Maximum number of bytes of similarity matrix rows to cache, 0 for no cache '
+                         '(default: %(default)s)')
 
     sc.set_defaults(func=serve_app)
 
@@ -1,11 +1,19 @@
 import argparse
+from collections import deque
 import gzip
+import io
+from itertools import islice
+import multiprocessing
+import os
 import sys
 import tarfile
 
+from pyroaring import BitMap
+import six
+
 from .. import pairs, makebits
-from ..db import FragmentsDb, FingerprintsDb
-from ..modifiedtanimoto import calc_mean_onbit_density
+from ..db import FragmentsDb, FingerprintsDb, adapt_BitMap
+from ..modifiedtanimoto import calc_mean_onbit_density, PackedBitsets
 
 
 def make_fingerprints_parser(subparsers):
@@ -19,8 +27,33 @@ def make_fingerprints_parser(subparsers):
     fingerprintsdb2makebits_sc(fp_sc)
     meanbitdensity_sc(fp_sc)
     similarity2query_sc(fp_sc)
+    similarity2queries_sc(fp_sc)
+    index_sc(fp_sc)
     pairs_sc(fp_sc)
     merge_fingerprintsdb_sc(fp_sc)
+    pack_sc(fp_sc)
+    unpack_sc(fp_sc)
+
+
+def positive_int(value):
+    """Argument type of an integer of at least 1
+
+    Args:
+        value (str): Command line argument
+
+    Returns:
+        int
+
+    Raises:
+        argparse.ArgumentTypeError: When value is not an integer of at least 1
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid int value: {0!r}'.format(value))
+    if number < 1:
+        raise argparse.ArgumentTypeError('must be at least 1, got {0}'.format(number))
+    return number
 
 
 def pairs_sc(subparsers):
@@ -35,15 +68,18 @@ def pairs_sc(subparsers):
     When input has been split into chunks,
     use `--ignore_upper_triangle` flag for computing similarities between same chunk.
     This prevents storing pair a->b also as b->a.
+
+    Fingerprints can also be read from a packed fingerprints directory made with `kripodb fingerprints pack`,
+    the packed engine is then always used.
     '''
     out_formats = ['tsv', 'hdf5']
     sc = subparsers.add_parser('similarities',
                                help=sc_help,
                                description=sc_description)
     sc.add_argument('fingerprintsfn1',
-                    help='Name of reference fingerprints db file')
+                    help='Name of reference fingerprints db file or packed fingerprints directory')
     sc.add_argument('fingerprintsfn2',
-                    help='Name of query fingerprints db file')
+                    help='Name of query fingerprints db file or packed fingerprints directory')
     sc.add_argument('out_file',
                     help='Name of output file (use - for stdout)')
     sc.add_argument('--out_format',
@@ -66,6 +102,19 @@ def pairs_sc(subparsers):
     sc.add_argument('--ignore_upper_triangle',
                     action='store_true',
                     help='Ignore upper triangle (default: %(default)s)')
+    sc.add_argument('--engine',
+                    choices=['roaring', 'packed'],
+                    default='roaring',
+                    help='Similarity engine, packed compares blocks of fingerprints at once '
+                         'using bit matrices (default: %(default)s)')
+    sc.add_argument('--prune',
+                    action='store_true',
+                    help='Skip pairs which can not reach cutoff based on their number of on bits '
+                         '(default: %(default)s)')
+    sc.add_argument('--workers',
+                    type=int,
+                    default=1,
+                    help='Number of processes to compute similarities with (default: %(default)s)')
     sc.set_defaults(func=pairs_run)
 
 
@@ -75,7 +124,10 @@ def pairs_run(fingerprintsfn1, fingerprintsfn2,
               cutoff,
               fragmentsdbfn,
               nomemory,
-              ignore_upper_triangle):
+              ignore_upper_triangle,
+              engine='roaring',
+              prune=False,
+              workers=1):
 
     if 'hdf5' in out_format and fragmentsdbfn is None:
         raise Exception('Hdf5 format requires fragments db')
@@ -84,12 +136,15 @@ def pairs_run(fingerprintsfn1, fingerprintsfn2,
     if fragmentsdbfn is not None:
         label2id = FragmentsDb(fragmentsdbfn).label2id().materialize()
 
-    bitsets1 = FingerprintsDb(fingerprintsfn1).as_dict()
+    bitsets1 = open_fingerprints(fingerprintsfn1)
     if fingerprintsfn1 == fingerprintsfn2:
         bitsets2 = bitsets1
         ignore_upper_triangle = True
     else:
-        bitsets2 = FingerprintsDb(fingerprintsfn2).as_dict()
+        bitsets2 = open_fingerprints(fingerprintsfn2)
+
+    if isinstance(bitsets1, PackedBitsets) or isinstance(bitsets2, PackedBitsets):
+        engine = 'packed'
 
     if bitsets1.number_of_bits != bitsets2.number_of_bits:
         raise Exception('Number of bits is not the same')
@@ -111,7 +166,24 @@ def pairs_run(fingerprintsfn1, fingerprintsfn2,
                      cutoff,
                      label2id,
                      nomemory,
-                     ignore_upper_triangle)
+                     ignore_upper_triangle,
+                     engine,
+                     prune,
+                     workers)
+
+
+def open_fingerprints(fn):
+    """Open fingerprints db file or packed fingerprints directory
+
+    Args:
+        fn (str): Name of fingerprints db file or packed fingerprints directory
+
+    Returns:
+        kripodb.db.IntbitsetDict|kripodb.modifiedtanimoto.PackedBitsets: Fingerprints
+    """
+    if os.path.isdir(fn):
+        return PackedBitsets.load(fn)
+    return FingerprintsDb(fn).as_dict()
 
 
 def makebits2fingerprintsdb_sc(subparsers):
@@ -119,29 +191,109 @@ def makebits2fingerprintsdb_sc(subparsers):
     sc.add_argument('infiles', nargs='+', type=argparse.FileType('r'), metavar='infile',
                     help='Name of makebits formatted fingerprint file (.tar.gz or not packed or - for stdin)')
     sc.add_argument('outfile', help='Name of fingerprints db file', default='fingerprints.db')
+    sc.add_argument('--workers',
+                    type=int,
+                    default=1,
+                    help='Number of processes to parse and compress fingerprints with (default: %(default)s)')
+    sc.add_argument('--batch_size',
+                    type=int,
+                    default=100000,
+                    help='Number of fingerprints to insert between commits (default: %(default)s)')
     sc.set_defaults(func=makebits2fingerprintsdb)
 
 
-def makebits2fingerprintsdb_single(infile, bitsets):
-    gen = makebits.iter_file(infile)
-    header = next(gen)
-    number_of_bits = makebits.read_fp_size(header)
-    bitsets.number_of_bits = number_of_bits
-    bitsets.update(gen)
+def iter_makebits_files(infile):
+    """Iterate over Makebits formatted files in a file, which can be a tar.gz archive of them
 
+    Args:
+        infile (File): File object of Makebits formatted file or tar.gz archive
+
+    Yields:
+        File: File object of Makebits formatted file
+    """
+    if infile.name.endswith('tar.gz'):
+        with tarfile.open(fileobj=getattr(infile, 'buffer', infile)) as tar:
+            for tarinfo in tar:
+                if tarinfo.isfile():
+                    f = tar.extractfile(tarinfo)
+                    if six.PY3:
+                        f = io.TextIOWrapper(f)
+                    yield f
+                    f.close()
+    else:
+        yield infile
+
+
+def makebits2fingerprintsdb(infiles, outfile, workers=1, batch_size=100000, block_size=10000):
+    """Add Makebits formatted files to fingerprints db
+
+    Blocks of lines are read in this process and parsed and serialized in a pool of worker processes.
+    The serialized fingerprints are written in order by this process in batches,
+    so the resulting db is the same for any number of workers.
+
+    Args:
+        infiles (List[File]): File objects of Makebits formatted files or tar.gz archives of them
+        outfile (str): Name of fingerprints db file
+        workers (int): Number of worker processes, when 1 no worker processes are used.
+        batch_size (int): Number of fingerprints to insert between commits
+        block_size (int): Number of fingerprints in a worker task
 
-def makebits2fingerprintsdb(infiles, outfile):
+    """
     bitsets = FingerprintsDb(outfile).as_dict()
-    for infile in infiles:
-        if infile.name.endswith('tar.gz'):
-            with tarfile.open(fileobj=infile) as tar:
-                for tarinfo in tar:
-                    if tarinfo.isfile():
-                        f = tar.extractfile(tarinfo)
-                        makebits2fingerprintsdb_single(f, bitsets)
-                        f.close()
-        else:
-            makebits2fingerprintsdb_single(infile, bitsets)
+    bitsets.batch_size = batch_size
+    numbers_of_bits = []
+
+    def iter_blocks():
+        for infile in infiles:
+            for f in iter_makebits_files(infile):
+                header = makebits.read_header(f.readline())
+                numbers_of_bits.append(makebits.read_fp_size(header))
+                while True:
+                    lines = list(islice(f, block_size))
+                    if not lines:
+                        break
+                    yield lines
+
+    def iter_rows(pool):
+        # only a few blocks are in flight, so memory usage stays bounded and rows are written in order
+        pending = deque()
+        for lines in iter_blocks():
+            pending.append(pool.apply_async(serialize_makebits_lines, (lines,)))
+            if len(pending) >= 2 * workers:
+                for row in pending.popleft().get():
+                    yield row
+        while pending:
+            for row in pending.popleft().get():
+                yield row
+
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            bitsets.update_serialized(iter_rows(pool))
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        bitsets.update_serialized(row for lines in iter_blocks() for row in serialize_makebits_lines(lines))
+
+    # set number of bits like it would have been set for each file
+    for number_of_bits in numbers_of_bits:
+        bitsets.number_of_bits = number_of_bits
+
+
+def serialize_makebits_lines(lines):
+    """Parse Makebits formatted fingerprint lines and serialize the fingerprints for the fingerprints db
+
+    Args:
+        lines (List[str]): Fingerprint lines of a Makebits formatted file
+
+    Returns:
+        List[Tuple[str, bytes]]: Fingerprint identifier and serialized fingerprint
+    """
+    fids, positions, offsets = makebits.read_bitsets_block(lines)
+    positions = positions.tolist()
+    offsets = offsets.tolist()
+    return [(fid, bytes(adapt_BitMap(BitMap(positions[offsets[i]:offsets[i + 1]])))) for i, fid in enumerate(fids)]
 
 
 def fingerprintsdb2makebits_sc(subparsers):
@@ -181,12 +333,109 @@ def similarity2query_sc(subparsers):
     sc.add_argument('--memory',
                     action='store_true',
                     help='Store bitsets in memory (default: %(default)s)')
-    sc.set_defaults(func=pairs.similarity2query)
+    sc.add_argument('--prune',
+                    action='store_true',
+                    help='Skip fingerprints which can not reach cutoff based on their number of on bits '
+                         '(default: %(default)s)')
+    sc.add_argument('--index',
+                    action='store_true',
+                    help='Use inverted index of fingerprints db, '
+                         'build it with `kripodb fingerprints index` (default: %(default)s)')
+    sc.add_argument('--top',
+                    type=positive_int,
+                    help='Maximum number of hits for each query, None for no limit (default: %(default)s)')
+    sc.set_defaults(func=similarity2query_run)
 
 
-def similarity2query_run(fingerprintsdb, query, out, mean_onbit_density, cutoff, memory):
+def similarity2query_run(fingerprintsdb, query, out, mean_onbit_density, cutoff, memory,
+                         prune=False, index=False, top=None):
     bitsets = FingerprintsDb(fingerprintsdb).as_dict()
-    pairs.similarity2query(bitsets, query, out, mean_onbit_density, cutoff, memory)
+    pairs.similarity2query(bitsets, query, out, mean_onbit_density, cutoff, memory, prune, index, top)
+
+
+def similarity2queries_sc(subparsers):
+    sc_help = 'Find the fragments closests to each query in a file based on fingerprints'
+    sc_description = '''
+
+    Fingerprints db is loaded into memory once and blocks of queries are compared against it at once.
+
+    Output formats:
+    * tsv, tab separated query, hit, score
+    * hdf5, hdf5 file constructed with pytables with a, b and score, but but a and b have been replaced
+      by numbers and similarity has been converted to scaled int
+    '''
+    sc = subparsers.add_parser('similar_batch', help=sc_help, description=sc_description)
+    sc.add_argument('fingerprintsdb',
+                    default='fingerprints.db',
+                    help='Name of fingerprints db file')
+    sc.add_argument('queries',
+                    type=argparse.FileType('r'),
+                    help='File with a query identifier or beginning of it on each line (or - for stdin)')
+    sc.add_argument('out_file',
+                    help='Name of output file (use - for stdout)')
+    sc.add_argument('--out_format',
+                    choices=['tsv', 'hdf5'],
+                    default='tsv',
+                    help='Format of output (default: %(default)s)')
+    sc.add_argument('--fragmentsdbfn',
+                    help='Name of fragments db file (only required for hdf5 format)')
+    sc.add_argument('--mean_onbit_density',
+                    help='Mean on bit density (default: %(default)s)',
+                    type=float,
+                    default=0.01)
+    sc.add_argument('--cutoff',
+                    type=float,
+                    default=0.55,
+                    help='Set Tanimoto cutoff (default: %(default)s)')
+    sc.add_argument('--prune',
+                    action='store_true',
+                    help='Skip fingerprints which can not reach cutoff based on their number of on bits '
+                         '(default: %(default)s)')
+    sc.add_argument('--top',
+                    type=positive_int,
+                    help='Maximum number of hits for each query, None for no limit (default: %(default)s)')
+    sc.set_defaults(func=similarity2queries_run)
+
+
+def similarity2queries_run(fingerprintsdb, queries, out_file, out_format, fragmentsdbfn,
+                           mean_onbit_density, cutoff, prune=False, top=None):
+    if 'hdf5' in out_format and fragmentsdbfn is None:
+        raise Exception('Hdf5 format requires fragments db')
+
+    label2id = {}
+    if fragmentsdbfn is not None:
+        label2id = FragmentsDb(fragmentsdbfn).label2id().materialize()
+
+    query_ids = [line.strip() for line in queries if line.strip()]
+
+    bitsets = FingerprintsDb(fingerprintsdb).as_dict()
+
+    out = sys.stdout
+    if out_file != '-' and out_format.startswith('tsv'):
+        if out_file.endswith('gz'):
+            out = gzip.open(out_file, 'wt')
+        else:
+            out = open(out_file, 'w')
+
+    try:
+        pairs.similarity2queries(bitsets, query_ids, out_format, out_file, out,
+                                 mean_onbit_density, cutoff, label2id, prune, top)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+def index_sc(subparsers):
+    sc = subparsers.add_parser('index', help='Build inverted index of fingerprints db to speed up similar command')
+    sc.add_argument('fingerprintsdb',
+                    default='fingerprints.db',
+                    help='Name of fingerprints db file')
+    sc.set_defaults(func=index_run)
+
+
+def index_run(fingerprintsdb):
+    with FingerprintsDb(fingerprintsdb) as db:
+        db.build_index()
 
 
 def meanbitdensity_sc(subparsers):
@@ -223,3 +472,37 @@ def merge_fingerprintsdb(ins, out):
             for table in tables:
                 c.execute('INSERT INTO {0} SELECT * FROM other.{0}'.format(table))
             c.execute('DETACH DATABASE other')
+
+
+def pack_sc(subparsers):
+    sc_help = 'Export fingerprints db to packed fingerprints directory'
+    sc_description = '''
+
+    The packed fingerprints directory contains NumPy files with
+    the fingerprint labels, the number of on bits of each fingerprint and
+    a bit matrix with a row for each fingerprint.
+    The files are memory-mapped when read, so the fingerprints can be used without deserializing them one by one.
+    '''
+    sc = subparsers.add_parser('pack', help=sc_help, description=sc_description)
+    sc.add_argument('fingerprintsdb', help='Name of fingerprints db file')
+    sc.add_argument('packeddir', help='Name of packed fingerprints directory')
+    sc.set_defaults(func=pack_run)
+
+
+def pack_run(fingerprintsdb, packeddir):
+    bitsets = FingerprintsDb(fingerprintsdb).as_dict()
+    PackedBitsets.pack(six.iteritems(bitsets), bitsets.number_of_bits, packeddir, len(bitsets))
+
+
+def unpack_sc(subparsers):
+    sc = subparsers.add_parser('unpack', help='Import packed fingerprints directory into fingerprints db')
+    sc.add_argument('packeddir', help='Name of packed fingerprints directory')
+    sc.add_argument('fingerprintsdb', help='Name of fingerprints db file')
+    sc.set_defaults(func=unpack_run)
+
+
+def unpack_run(packeddir, fingerprintsdb):
+    packed = PackedBitsets.load(packeddir)
+    bitsets = FingerprintsDb(fingerprintsdb).as_dict()
+    bitsets.number_of_bits = packed.number_of_bits
+    bitsets.update(packed.items())
@@ -1,10 +1,10 @@
 import argparse
 import csv
 
-from tables import parameters
+from tables import open_file, parameters
 from .. import pairs
 from ..db import FragmentsDb
-from ..frozen import FrozenSimilarityMatrix
+from ..frozen import FrozenSimilarityMatrix, FrozenSparseSimilarityMatrix, Uint16ScoreCodec, Uint8ScoreCodec
 from ..hdf5 import SimilarityMatrix
 
 
@@ -22,6 +22,7 @@ def make_similarities_parser(subparsers):
     simmatrix_filter_sc(sc)
     similarity_freeze_sc(sc)
     similarity_thaw_sc(sc)
+    similarity_index_sc(sc)
     fpneigh2tsv_sc(sc)
     histogram_sc(sc)
 
@@ -66,18 +67,6 @@ def load_pdb_filter_file(pdbs_file):
     return pdbs
 
 
-def pdb_filter(rows, pdbs):
-    for row in rows:
-        if row[0][:4] in pdbs and row[1][:4] in pdbs:
-            yield row
-
-
-def frag1_filter(rows):
-    for row in rows:
-        if row[0].endswith('frag1') and row[1].endswith('frag1'):
-            yield row
-
-
 def simmatrix_export_run(simmatrixfn, outputfile, no_header, frag1, pdb):
     """Export similarity matrix to tab delimited file
 
@@ -100,14 +89,7 @@ def simmatrix_export_run(simmatrixfn, outputfile, no_header, frag1, pdb):
     if with_header:
         writer.writerow(['frag_id1', 'frag_id2', 'score'])
 
-    if frag1 and pdb:
-        writer.writerows(pdb_filter(frag1_filter(simmatrix), pdbs))
-    elif frag1:
-        writer.writerows(frag1_filter(simmatrix))
-    elif pdb:
-        writer.writerows(pdb_filter(simmatrix, pdbs))
-    else:
-        writer.writerows(simmatrix)
+    pairs.export_pairs_tsv(simmatrix, outputfile, frag1, pdbs)
 
     simmatrix.close()
 
@@ -235,20 +217,71 @@ def simmatrix_filter(input, output, fragmentsdb, skip):
 def similarity_freeze_sc(subparsers):
     sc = subparsers.add_parser('freeze', help='Optimize similarity matrix for reading')
     sc.add_argument('in_fn', type=str, help='Input pairs file')
-    sc.add_argument('out_fn', type=str, help='Output array file, file is overwritten')
+    sc.add_argument('out_fn', type=str, help='Output array file, file is overwritten unless --append is used')
     sc.add_argument('-f', '--frame_size', type=int, default=10**8, help='Size of frame (default: %(default)s)')
     sc.add_argument('-m', '--memory', type=int, default=1, help='Memory cache in Gigabytes (default: %(default)s)')
     sc.add_argument('-l', '--limit', type=int, help='Number of pairs to copy, None for no limit (default: %(default)s)')
     sc.add_argument('-s', '--single_sided', action='store_true', help='Store half matrix (default: %(default)s)')
+    sc.add_argument('-t', '--threads', type=int, default=1,
+                    help='Number of threads used by blosc to compress rows (default: %(default)s)')
+    sc.add_argument('--external', action='store_true',
+                    help='Sort pairs in temporary files which fit in memory, '
+                         'so each row is written once (default: %(default)s)')
+    sc.add_argument('--tmpdir', help='Directory for temporary files of external sort or sparse format '
+                                     '(default: system default)')
+    sc.add_argument('--score_codec', choices=['uint16', 'uint8'],
+                    help='Store scores of dense matrix as 16 bit or 8 bit integers, '
+                         '8 bit halves size of matrix but is less precise (default: uint16)')
+    sc.add_argument('--score_min', type=float,
+                    help='Lowest score stored when score codec is uint8 (default: 0.45)')
+    layout = sc.add_mutually_exclusive_group()
+    layout.add_argument('--sparse', action='store_true',
+                        help='Store only non-zero scores in compressed sparse row format (default: %(default)s)')
+    layout.add_argument('--raw', action='store_true',
+                        help='Store scores uncompressed in memory-mappable .scores.npy file '
+                             'next to output file (default: %(default)s)')
+    layout.add_argument('--append', action='store_true',
+                        help='Add fragments and pairs of input to existing dense output file without rewriting it, '
+                             'scores of pairs replace existing scores (default: %(default)s)')
     sc.set_defaults(func=similarity_freeze_run)
 
 
-def similarity_freeze_run(in_fn, out_fn, frame_size, memory, limit, single_sided):
+def similarity_freeze_run(in_fn, out_fn, frame_size, memory, limit, single_sided, sparse=False, raw=False,
+                          external=False, tmpdir=None, threads=1, append=False, score_codec=None, score_min=None):
+    if sparse and external:
+        raise Exception('External sort is only available for dense format, the sparse format always uses tmpdir')
+    if sparse and score_codec is not None:
+        raise Exception('Score codec is only available for dense format, the sparse format always uses uint16')
+    if score_min is not None and score_codec != 'uint8':
+        raise Exception('Score min can only be used with uint8 score codec')
+    if append:
+        if limit is not None or single_sided or external or score_codec is not None:
+            raise Exception('Limit, single sided, external sort and score codec can not be used when appending, '
+                            'appending uses score codec of output file')
+        with open_file(out_fn, 'r') as h5file:
+            is_dense = FrozenSimilarityMatrix.is_frozen(h5file) and not FrozenSparseSimilarityMatrix.is_sparse(h5file)
+        if not is_dense:
+            raise Exception('Can only append to dense frozen similarity matrix, {0} is not one'.format(out_fn))
     dm = SimilarityMatrix(in_fn, 'r')
     parameters.CHUNK_CACHE_SIZE = memory * 1024 ** 3
     parameters.CHUNK_CACHE_NELMTS = 2 ** 14
-    dfm = FrozenSimilarityMatrix(out_fn, 'w')
-    dfm.from_pairs(dm, frame_size, limit, single_sided)
+    if append:
+        dfm = FrozenSimilarityMatrix(out_fn, 'a')
+        new_labels = [label for label in dm.labels.label2ids() if label not in dfm.cache_l2i]
+        dfm.extend(new_labels, dm, frame_size, threads)
+    elif sparse:
+        dfm = FrozenSparseSimilarityMatrix(out_fn, 'w')
+        dfm.from_pairs(dm, frame_size, limit, single_sided, tmpdir, threads)
+    else:
+        if score_codec == 'uint8':
+            codec = Uint8ScoreCodec() if score_min is None else Uint8ScoreCodec(score_min)
+        else:
+            codec = Uint16ScoreCodec()
+        dfm = FrozenSimilarityMatrix(out_fn, 'w', raw=raw, score_codec=codec)
+        if external:
+            dfm.from_pairs_external(dm, memory * 1024 ** 3, limit, single_sided, tmpdir, threads)
+        else:
+            dfm.from_pairs(dm, frame_size, limit, single_sided, threads)
     dm.close()
     dfm.close()
 
@@ -260,13 +293,18 @@ def similarity_thaw_sc(subparsers):
     sc.add_argument('--nonzero_fraction',
                     type=float,
                     default=0.012,
-                    help='Fraction of pairs which have score above threshold (default: %(default)s)')
+                    help='Fraction of pairs which have score above threshold, '
+                         'only used for dense frozen matrix (default: %(default)s)')
     sc.set_defaults(func=similarity_thaw_run)
 
 
 def similarity_thaw_run(in_fn, out_fn, nonzero_fraction):
-    fsm = FrozenSimilarityMatrix(in_fn, 'r')
-    nr_scores = int(fsm.scores.shape[0] * fsm.scores.shape[1] * nonzero_fraction)
+    fsm = pairs.open_similarity_matrix(in_fn)
+    if isinstance(fsm, FrozenSparseSimilarityMatrix):
+        # both directions are stored, pairs only one
+        nr_scores = fsm.scores.shape[0] // 2
+    else:
+        nr_scores = int(fsm.scores.shape[0] * fsm.scores.shape[1] * nonzero_fraction)
     nr_labels = fsm.labels.shape[0]
     sm = SimilarityMatrix(out_fn, 'w', expectedpairrows=nr_scores, expectedlabelrows=nr_labels)
     fsm.to_pairs(sm)
@@ -274,6 +312,31 @@ def similarity_thaw_run(in_fn, out_fn, nonzero_fraction):
     fsm.close()
 
 
+def similarity_index_sc(subparsers):
+    sc = subparsers.add_parser('index', help='Index pairs or dense frozen file to speed up finding similar fragments')
+    sc.add_argument('pairsdbfn', type=str, help='Pairs or dense frozen file, index is stored inside it')
+    sc.add_argument('-f', '--frame_size', type=int, default=10**8, help='Size of frame (default: %(default)s)')
+    sc.add_argument('--cutoff', type=float, default=0.45,
+                    help='Dense frozen file only, store hits with score above cutoff (default: %(default)s)')
+    sc.add_argument('--top', type=int, default=1000,
+                    help='Dense frozen file only, maximum number of hits stored for each fragment, '
+                         '0 for no maximum (default: %(default)s)')
+    sc.add_argument('--tmpdir', help='Pairs file only, directory for temporary files (default: system default)')
+    sc.set_defaults(func=similarity_index_run)
+
+
+def similarity_index_run(pairsdbfn, frame_size, cutoff=0.45, top=1000, tmpdir=None):
+    with open_file(pairsdbfn, 'r') as h5file:
+        is_frozen = FrozenSimilarityMatrix.is_frozen(h5file) and not FrozenSparseSimilarityMatrix.is_sparse(h5file)
+    if is_frozen:
+        sm = FrozenSimilarityMatrix(pairsdbfn, 'a')
+        sm.build_top_neighbors(cutoff, top or None)
+    else:
+        sm = SimilarityMatrix(pairsdbfn, 'a')
+        sm.build_index(frame_size, tmpdir)
+    sm.close()
+
+
 def read_fpneighpairs_file(inputfile, ignore_upper_triangle=False):
     """Read fpneigh formatted similarity matrix file.
 
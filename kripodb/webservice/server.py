@@ -197,6 +197,15 @@ def get_version():
     return {'version': __version__}
 
 
+def get_cache_stats():
+    """
+    Returns:
+        dict: Statistics of row cache of similarity matrix, see :meth:`kripodb.cache.RowCache.stats`
+    """
+    similarity_matrix = current_app.config['similarities']
+    return similarity_matrix.row_cache.stats()
+
+
 def wsgi_app(similarities, fragments, pharmacophores, external_url='http://localhost:8084/kripo'):
     """Create wsgi app
 
@@ -223,7 +232,8 @@ def wsgi_app(similarities, fragments, pharmacophores, external_url='http://local
     return app
 
 
-def serve_app(similarities, fragments, pharmacophores, internal_port=8084, external_url='http://localhost:8084/kripo'):
+def serve_app(similarities, fragments, pharmacophores, internal_port=8084, external_url='http://localhost:8084/kripo',
+              row_cache_size=0):
     """Serve webservice forever
 
     Args:
@@ -232,15 +242,18 @@ def serve_app(similarities, fragments, pharmacophores, internal_port=8084, exter
         pharmacophores: Filename of pharmacophores hdf5 file
         internal_port: TCP port on which to listen
         external_url (str): URL which should be used in Swagger spec
+        row_cache_size (int): Maximum number of bytes of similarity matrix rows to cache
     """
-    sim_matrix = open_similarity_matrix(similarities)
+    sim_matrix = open_similarity_matrix(similarities, row_cache_size)
     pharmacophores_db = PharmacophoresDb(pharmacophores)
     app = wsgi_app(sim_matrix, fragments, pharmacophores_db, external_url)
     LOGGER.setLevel(logging.INFO)
     LOGGER.addHandler(logging.StreamHandler())
     LOGGER.info(' * Swagger spec at {}/swagger.json'.format(external_url))
     LOGGER.info(' * Swagger ui at {}/ui'.format(external_url))
+    LOGGER.info(' * Row cache statistics at {}/cache'.format(external_url))
     try:
         app.run(port=internal_port)
     finally:
+        LOGGER.info(' * Row cache statistics: {}'.format(sim_matrix.row_cache.stats()))
         sim_matrix.close()
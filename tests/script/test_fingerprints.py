@@ -12,11 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from __future__ import absolute_import
+import gzip
 
+from pyroaring import BitMap
+import pytest
 from six import StringIO
 
 import kripodb.script as script
 import kripodb.script.fingerprints
+from kripodb.db import FingerprintsDb
 
 
 def test_pairs_subcommand_defaults():
@@ -39,10 +43,20 @@ def test_pairs_subcommand_defaults():
         'fingerprintsfn2': 'fp2',
         'fingerprintsfn1': 'fp1',
         'ignore_upper_triangle': False,
+        'engine': 'roaring',
+        'prune': False,
+        'workers': 1,
     }
     assert fargs == expected
 
 
+def test_similar_subcommand_top0():
+    parser = script.make_parser()
+
+    with pytest.raises(SystemExit):
+        parser.parse_args(['fingerprints', 'similar', '--top', '0', 'fp', 'query', 'outfn'])
+
+
 def test_meanbitdensity():
     out = StringIO()
 
@@ -51,3 +65,57 @@ def test_meanbitdensity():
     assert out.getvalue() == '0.0077683\n'
 
 
+
+
+def test_pack_unpack(tmpdir):
+    fingerprintsdb = str(tmpdir.join('fingerprints.sqlite'))
+    with FingerprintsDb(fingerprintsdb) as db:
+        bitsets = db.as_dict(100)
+        bitsets.update([('a', BitMap([1, 2, 3])), ('b', BitMap([1, 64, 99]))])
+    packeddir = str(tmpdir.join('fingerprints.packed'))
+    unpackeddb = str(tmpdir.join('unpacked.sqlite'))
+
+    kripodb.script.fingerprints.pack_run(fingerprintsdb, packeddir)
+    kripodb.script.fingerprints.unpack_run(packeddir, unpackeddb)
+
+    with FingerprintsDb(unpackeddb) as db:
+        result = db.as_dict()
+        assert result.number_of_bits == 100
+        assert dict(result.items()) == {'a': BitMap([1, 2, 3]), 'b': BitMap([1, 64, 99])}
+
+
+def test_similarity2queries_run_gzipped(tmpdir):
+    fingerprintsdb = str(tmpdir.join('fingerprints.sqlite'))
+    with FingerprintsDb(fingerprintsdb) as db:
+        bitsets = db.as_dict(100)
+        bitsets.update([('a', BitMap([1, 2, 3])), ('b', BitMap([1, 2, 4]))])
+    out_file = str(tmpdir.join('similarities.tsv.gz'))
+
+    kripodb.script.fingerprints.similarity2queries_run(fingerprintsdb, StringIO('a\n'), out_file, 'tsv', None,
+                                                       0.01, 0.45)
+
+    with gzip.open(out_file, 'rt') as f:
+        assert f.read() == 'a\tb\t0.66146\n'
+
+
+def test_makebits2fingerprintsdb_parallel(tmpdir):
+    makebitsfn = str(tmpdir.join('fingerprints.fp'))
+    with open(makebitsfn, 'w') as f:
+        f.write('MAKEBITS 1.0 100 BigGrid\n')
+        for i in range(10):
+            f.write('frag{0} 1 2 {1} 0 3\n'.format(i, i + 10))
+    serialdb = str(tmpdir.join('serial.sqlite'))
+    paralleldb = str(tmpdir.join('parallel.sqlite'))
+
+    with open(makebitsfn) as infile:
+        kripodb.script.fingerprints.makebits2fingerprintsdb([infile], serialdb, block_size=3)
+    with open(makebitsfn) as infile:
+        kripodb.script.fingerprints.makebits2fingerprintsdb([infile], paralleldb, workers=2, block_size=3)
+
+    with open(serialdb, 'rb') as serial, open(paralleldb, 'rb') as parallel:
+        assert serial.read() == parallel.read()
+    with FingerprintsDb(paralleldb) as db:
+        bitsets = db.as_dict()
+        assert bitsets.number_of_bits == 100
+        assert len(bitsets) == 10
+        assert bitsets['frag3'] == BitMap([1, 2, 13])
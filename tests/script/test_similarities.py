@@ -19,7 +19,9 @@ import pytest
 from six import StringIO
 
 from kripodb.db import FragmentsDb
+from kripodb.frozen import FrozenSparseSimilarityMatrix
 from kripodb.hdf5 import SimilarityMatrix
+from kripodb import pairs
 import kripodb.script.similarities as script
 from ..utils import tmpname
 
@@ -110,6 +112,99 @@ def test_simmatrix_export_run_frozen():
     assert '2mlm_2W7_frag2\t3wvm_STE_frag1\t0.4634\n' in output
 
 
+@pytest.mark.parametrize('kwargs', (
+    {},
+    {'threads': 2},
+    {'external': True, 'threads': 2},
+))
+def test_similarity_freeze_run(kwargs):
+    output_fn = tmpname()
+    try:
+        script.similarity_freeze_run('data/similarities.h5', output_fn, 10**8, 1, None, False, **kwargs)
+
+        outputfile = StringIO()
+        script.simmatrix_export_run(output_fn, outputfile, False, False, None)
+        output = outputfile.getvalue()
+        assert output.count('\n') == 11951
+        # order of fragments in pair depends on id of fragment in frozen matrix
+        assert '3wvm_STE_frag1\t2mlm_2W7_frag2\t0.4634\n' in output
+    finally:
+        if os.path.exists(output_fn):
+            os.remove(output_fn)
+
+
+@pytest.mark.parametrize('kwargs', (
+    {'sparse': True, 'external': True},
+    {'append': True, 'limit': 10},
+    {'append': True, 'single_sided': True},
+    {'append': True, 'external': True},
+    {'append': True, 'score_codec': 'uint8'},
+    {'append': True, 'score_min': 0.5},
+    {'sparse': True, 'score_codec': 'uint8'},
+    {'sparse': True, 'score_codec': 'uint16'},
+    {'sparse': True, 'score_min': 0.5},
+    {'score_codec': 'uint16', 'score_min': 0.5},
+))
+def test_similarity_freeze_run_invalid_combination(kwargs):
+    output_fn = tmpname()
+    args = {'limit': None, 'single_sided': False}
+    args.update(kwargs)
+    with pytest.raises(Exception):
+        script.similarity_freeze_run('data/similarities.h5', output_fn, 10**8, 1, **args)
+    assert not os.path.exists(output_fn)
+
+
+def test_similarity_freeze_run_append_to_sparse():
+    output_fn = tmpname()
+    try:
+        script.similarity_freeze_run('data/similarities.h5', output_fn, 10**8, 1, None, False, sparse=True)
+
+        with pytest.raises(Exception) as excinfo:
+            script.similarity_freeze_run('data/similarities.h5', output_fn, 10**8, 1, None, False, append=True)
+
+        assert 'dense' in str(excinfo.value)
+        with FrozenSparseSimilarityMatrix(output_fn) as matrix:
+            assert len(matrix.find('2mlm_2W7_frag1', 0.55)) == 1
+    finally:
+        if os.path.exists(output_fn):
+            os.remove(output_fn)
+
+
+def test_similarity_freeze_run_append():
+    output_fn = tmpname()
+    update_fn = tmpname()
+    try:
+        script.similarity_freeze_run('data/similarities.h5', output_fn, 10**8, 1, None, False)
+        update = SimilarityMatrix(update_fn, 'w')
+        update.update([('2mlm_2W7_frag1', 'newfrag', 0.9)], {'2mlm_2W7_frag1': 1, 'newfrag': 2})
+        update.close()
+
+        script.similarity_freeze_run(update_fn, output_fn, 10**8, 1, None, False, append=True)
+
+        outputfile = StringIO()
+        pairs.similar_run('newfrag', output_fn, 0.55, outputfile)
+        assert outputfile.getvalue() == 'newfrag\t2mlm_2W7_frag1\t0.9\n'
+    finally:
+        for fn in (output_fn, update_fn):
+            if os.path.exists(fn):
+                os.remove(fn)
+
+
+def test_similarity_index_run_frozen():
+    output_fn = tmpname()
+    try:
+        script.similarity_freeze_run('data/similarities.h5', output_fn, 10**8, 1, None, False)
+
+        script.similarity_index_run(output_fn, 10**8, 0.55, 10)
+
+        outputfile = StringIO()
+        pairs.similar_run('2mlm_2W7_frag1', output_fn, 0.55, outputfile)
+        assert outputfile.getvalue() == '2mlm_2W7_frag1\t2mlm_2W7_frag2\t0.5878\n'
+    finally:
+        if os.path.exists(output_fn):
+            os.remove(output_fn)
+
+
 def test_simmatrix_export_run_noheader():
     outputfile = StringIO()
     script.simmatrix_export_run('data/similarities.h5', outputfile, True, False, None)
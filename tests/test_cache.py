@@ -0,0 +1,116 @@
+# Copyright 2016 Netherlands eScience Center
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+import threading
+
+import pytest
+
+from kripodb.cache import RowCache
+
+
+@pytest.fixture
+def cache():
+    return RowCache(10)
+
+
+class TestRowCache(object):
+    def test_get_miss(self, cache):
+        assert cache.get('a') is None
+        assert cache.misses == 1
+        assert cache.hits == 0
+
+    def test_put_get_hit(self, cache):
+        cache.put('a', 1, 4)
+
+        assert cache.get('a') == 1
+        assert cache.hits == 1
+        assert cache.nbytes == 4
+
+    def test_put_evicts_least_recently_used(self, cache):
+        cache.put('a', 1, 4)
+        cache.put('b', 2, 4)
+        cache.get('a')
+
+        cache.put('c', 3, 4)
+
+        assert 'a' in cache
+        assert 'b' not in cache
+        assert 'c' in cache
+        assert cache.evictions == 1
+        assert cache.nbytes == 8
+
+    def test_put_replaces(self, cache):
+        cache.put('a', 1, 4)
+        cache.put('a', 2, 6)
+
+        assert cache.get('a') == 2
+        assert cache.nbytes == 6
+        assert len(cache) == 1
+
+    def test_put_larger_than_budget(self, cache):
+        cache.put('a', 1, 11)
+
+        assert len(cache) == 0
+        assert cache.nbytes == 0
+
+    def test_disabled(self):
+        cache = RowCache()
+        cache.put('a', 1, 1)
+
+        assert cache.get('a') is None
+
+    def test_clear(self, cache):
+        cache.put('a', 1, 4)
+        cache.get('a')
+
+        cache.clear()
+
+        assert len(cache) == 0
+        assert cache.nbytes == 0
+        assert cache.hits == 1
+
+    def test_stats(self, cache):
+        cache.put('a', 1, 4)
+        cache.put('b', 2, 4)
+        cache.put('c', 3, 4)
+        cache.get('c')
+        cache.get('a')
+
+        expected = {
+            'hits': 1,
+            'misses': 1,
+            'evictions': 1,
+            'entries': 2,
+            'nbytes': 8,
+            'max_bytes': 10,
+        }
+        assert cache.stats() == expected
+
+    def test_threads(self):
+        cache = RowCache(100)
+
+        def worker(offset):
+            for i in range(1000):
+                key = (offset + i) % 50
+                if cache.get(key) is None:
+                    cache.put(key, key, 4)
+
+        threads = [threading.Thread(target=worker, args=(offset,)) for offset in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert cache.hits + cache.misses == 4000
+        assert cache.nbytes == 4 * len(cache) <= 100
@@ -24,6 +24,7 @@ from rdkit.Chem import MolFromSmiles, MolToSmiles
 import six
 
 import kripodb.db as db
+from kripodb import modifiedtanimoto
 
 
 @pytest.mark.skipif(version_info < (3,),
@@ -326,6 +327,32 @@ class TestBitMapDictEmpty(object):
         result = {k: v for k, v in six.iteritems(bitsets)}
         assert result == other
 
+    def test_update_kwargs(self, bitsets):
+        bs = BitMap([1, 3, 5, 8])
+
+        bitsets.update([('id1', bs)], id2=bs)
+
+        result = {k: v for k, v in six.iteritems(bitsets)}
+        assert result == {'id1': bs, 'id2': bs}
+
+    @pytest.mark.parametrize('batch_size', (None, 1, 2, 100))
+    def test_update_batches(self, bitsets, batch_size):
+        bitsets.batch_size = batch_size
+        other = {'id{0}'.format(i): BitMap([i, i + 1]) for i in range(5)}
+
+        bitsets.update(other)
+
+        result = {k: v for k, v in six.iteritems(bitsets)}
+        assert result == other
+
+    def test_update_serialized(self, bitsets):
+        bs = BitMap([1, 3, 5, 8])
+
+        bitsets.update_serialized([('id1', bytes(db.adapt_BitMap(bs)))])
+
+        result = {k: v for k, v in six.iteritems(bitsets)}
+        assert result == {'id1': bs}
+
     def test_getitem_keyerror(self, bitsets):
         with pytest.raises(KeyError) as e:
             bitsets['id1']
@@ -394,3 +421,66 @@ class TestBitMapDictFilled(object):
 
         expected = {'id1': sample_BitMap}
         assert result == expected
+
+
+@pytest.fixture
+def indexed_fingerprintsdb(fingerprintsdb):
+    bitsets = fingerprintsdb.as_dict(100)
+    bitsets.update({
+        'a': BitMap([1, 2, 3]),
+        'b': BitMap([1, 2, 4, 5, 8]),
+        'c': BitMap([1, 2, 4, 8]),
+        'd': BitMap([50, 60]),
+    })
+    fingerprintsdb.build_index()
+    return fingerprintsdb
+
+
+class TestFingerprintsIndex(object):
+    def test_noindex_lookuperror(self, fingerprintsdb):
+        with pytest.raises(LookupError):
+            fingerprintsdb.index()
+
+    def test_labels(self, indexed_fingerprintsdb):
+        index = indexed_fingerprintsdb.index()
+
+        assert index.labels == ['a', 'b', 'c', 'd']
+        assert list(index.popcounts) == [3, 5, 4, 2]
+
+    def test_intersection_cardinalities(self, indexed_fingerprintsdb):
+        index = indexed_fingerprintsdb.index()
+
+        result = index.intersection_cardinalities(BitMap([1, 4, 60]))
+
+        assert list(result) == [1, 2, 2, 1]
+
+    @pytest.mark.parametrize('ignore_upper_triangle,cutoff', (
+        (True, 0.55),
+        (False, 0.55),
+        (False, 0.3),
+    ))
+    def test_similarities(self, indexed_fingerprintsdb, ignore_upper_triangle, cutoff):
+        index = indexed_fingerprintsdb.index()
+        bitsets = indexed_fingerprintsdb.as_dict().materialize()
+        corr_st, corr_sto = modifiedtanimoto.corrections(0.01)
+
+        result = list(index.similarities(bitsets, 100, corr_st, corr_sto, cutoff, ignore_upper_triangle))
+
+        expected = list(modifiedtanimoto.similarities(bitsets, bitsets, 100, corr_st, corr_sto, cutoff,
+                                                      ignore_upper_triangle))
+        assert result == expected
+
+    @pytest.mark.parametrize('top', (0, -1))
+    def test_similarities_top_below1(self, indexed_fingerprintsdb, top):
+        index = indexed_fingerprintsdb.index()
+        bitsets = indexed_fingerprintsdb.as_dict().materialize()
+        corr_st, corr_sto = modifiedtanimoto.corrections(0.01)
+
+        with pytest.raises(ValueError):
+            list(index.similarities(bitsets, 100, corr_st, corr_sto, 0.55, top=top))
+
+    def test_update_drops_index(self, indexed_fingerprintsdb):
+        indexed_fingerprintsdb.as_dict().update({'e': BitMap([1])})
+
+        with pytest.raises(LookupError):
+            indexed_fingerprintsdb.index()
@@ -14,13 +14,16 @@
 from __future__ import absolute_import
 
 import json
+import os
+
 import numpy as np
 from six import StringIO, BytesIO
 import pytest
 from mock import patch
 
 import kripodb.dive as dive
-from .utils import FrozenSimilarityMatrixInMemory
+from kripodb.frozen import FrozenSimilarityMatrix
+from .utils import FrozenSimilarityMatrixInMemory, tmpname
 
 
 @pytest.fixture
@@ -93,6 +96,38 @@ def test_dense_dump_frag1only():
         assert result == expected
 
 
+def test_dense_dump_extended():
+    with FrozenSimilarityMatrixInMemory() as matrix:
+        labels = ['a', 'b']
+        data = [
+            [0.0, 0.9],
+            [0.9, 0.0],
+        ]
+        matrix.from_array(np.array(data), labels)
+        matrix.extend(['c'], [('c', 'a', 0.5)])
+
+        result = list(dive.dense_dump_iter(matrix, frag1only=False))
+        expected = [
+            (u'a', u'b', 0.9),
+            (u'a', u'c', 0.5),
+        ]
+        assert result == expected
+
+
+def test_dense_dump():
+    fn = tmpname()
+    try:
+        with FrozenSimilarityMatrix(fn, 'w') as matrix:
+            matrix.from_array(np.array([[0.0, 0.9], [0.9, 0.0]]), ['a', 'b'])
+        outputfile = StringIO()
+
+        dive.dense_dump(fn, outputfile, False)
+
+        assert outputfile.getvalue() == 'frag_id1\tfrag_id2\tscore\na\tb\t0.9\n'
+    finally:
+        os.remove(fn)
+
+
 def test_dive_sphere():
     inputfile = 'data/fragments.sqlite'
     outputfile = StringIO()
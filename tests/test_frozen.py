@@ -13,13 +13,20 @@
 # limitations under the License.
 from __future__ import absolute_import
 
+import os
+
 import pytest
 import numpy as np
 from numpy.testing import assert_array_almost_equal
 import pandas as pd
 import pandas.util.testing as pdt
+import tables
 
-from .utils import FrozenSimilarityMatrixInMemory, SimilarityMatrixInMemory
+from kripodb.cache import RowCache
+from kripodb.frozen import FrozenSimilarityMatrix, FrozenSparseSimilarityMatrix, Uint16ScoreCodec, Uint8ScoreCodec
+from kripodb.hdf5 import SimilarityMatrix
+from kripodb.pairs import open_similarity_matrix
+from .utils import FrozenSimilarityMatrixInMemory, FrozenSparseSimilarityMatrixInMemory, SimilarityMatrixInMemory, tmpname
 
 
 @pytest.fixture
@@ -46,6 +53,25 @@ def frozen_similarity_matrix():
     matrix_inmem.close()
 
 
+@pytest.fixture
+def frozen_sparse_similarity_matrix():
+    matrix_inmem = FrozenSparseSimilarityMatrixInMemory()
+    matrix = matrix_inmem.matrix
+    yield matrix
+    matrix_inmem.close()
+
+
+@pytest.fixture
+def raw_frozen_similarity_matrix_fn(similarity_matrix):
+    fn = tmpname()
+    with FrozenSimilarityMatrix(fn, 'w', raw=True) as matrix:
+        matrix.from_pairs(similarity_matrix, 10)
+        raw_fn = matrix.raw_scores_filename()
+    yield fn
+    os.remove(fn)
+    os.remove(raw_fn)
+
+
 def fillit(frozen_similarity_matrix):
     labels = ['a', 'b', 'c', 'd']
     data = [
@@ -111,6 +137,51 @@ class TestFrozenSimilarityMatrix(object):
         ], index=labels, columns=labels)
         pdt.assert_almost_equal(result, expected)
 
+    @pytest.mark.parametrize('memory', (1, 100, 10**6))
+    @pytest.mark.parametrize('single_sided', (False, True))
+    def test_from_pairs_external(self, similarity_matrix, frozen_similarity_matrix, memory, single_sided):
+        frozen_similarity_matrix.from_pairs_external(similarity_matrix, memory, single_sided=single_sided)
+
+        with FrozenSimilarityMatrixInMemory() as expected:
+            expected.from_pairs(similarity_matrix, 10, single_sided=single_sided)
+            np.testing.assert_array_equal(frozen_similarity_matrix.scores[:], expected.scores[:])
+        assert frozen_similarity_matrix.cache_i2l == expected.cache_i2l
+
+    @pytest.mark.parametrize('memory', (1, 10**6))
+    def test_from_pairs_external_duplicate_pairs(self, frozen_similarity_matrix, memory):
+        with SimilarityMatrixInMemory() as pairs:
+            pairs.update([('a', 'b', 0.2), ('b', 'c', 0.6), ('a', 'b', 0.3)], {'a': 0, 'b': 1, 'c': 2})
+
+            frozen_similarity_matrix.from_pairs_external(pairs, memory)
+
+            with FrozenSimilarityMatrixInMemory() as expected:
+                expected.from_pairs(pairs, 10)
+                np.testing.assert_array_equal(frozen_similarity_matrix.scores[:], expected.scores[:])
+        assert frozen_similarity_matrix.find('a', 0.1) == [('b', 0.5)]
+
+    @pytest.mark.parametrize('external', (False, True))
+    def test_from_pairs_threads(self, similarity_matrix, frozen_similarity_matrix, external):
+        previous = tables.set_blosc_max_threads(3)
+        try:
+            if external:
+                frozen_similarity_matrix.from_pairs_external(similarity_matrix, 100, threads=2)
+            else:
+                frozen_similarity_matrix.from_pairs(similarity_matrix, 10, threads=2)
+
+            # blosc thread setting is restored
+            assert tables.set_blosc_max_threads(3) == 3
+        finally:
+            tables.set_blosc_max_threads(previous)
+        hits = frozen_similarity_matrix.find('c', 0.55)
+        assert hits == [('d', 0.7), ('b', 0.6)]
+
+    def test_from_pairs_external_limited(self, similarity_matrix, frozen_similarity_matrix):
+        frozen_similarity_matrix.from_pairs_external(similarity_matrix, 100, 2)
+
+        hits = frozen_similarity_matrix.find('c', 0.0)
+        expected = [('a', 0.5)]
+        assert hits == expected
+
     def test_find_defaults(self, similarity_matrix, frozen_similarity_matrix):
         frozen_similarity_matrix.from_pairs(similarity_matrix, 10)
 
@@ -125,6 +196,20 @@ class TestFrozenSimilarityMatrix(object):
         expected = [('d', 0.7)]
         assert hits == expected
 
+    @pytest.mark.parametrize('limit,expected', (
+        (None, [('b', 0.6), ('d', 0.6), ('e', 0.6), ('a', 0.5)]),
+        (2, [('b', 0.6), ('d', 0.6)]),
+        (0, []),
+    ))
+    def test_find_ties_ordered_on_id(self, frozen_similarity_matrix, limit, expected):
+        labels = ['a', 'b', 'c', 'd', 'e']
+        data = np.zeros((5, 5))
+        data[2] = [0.5, 0.6, 0.0, 0.6, 0.6]
+        frozen_similarity_matrix.from_array(data, labels)
+
+        hits = frozen_similarity_matrix.find('c', 0.45, limit)
+        assert hits == expected
+
     def test_find_cutoffhigh_nohits(self, similarity_matrix, frozen_similarity_matrix):
         frozen_similarity_matrix.from_pairs(similarity_matrix, 10)
 
@@ -208,6 +293,37 @@ class TestFrozenSimilarityMatrix(object):
 
         assert result == expected
 
+    def test_iter_frames_masked(self, frozen_similarity_matrix):
+        fillit(frozen_similarity_matrix)
+        mask = np.array([True, False, True, True])
+
+        frames = list(frozen_similarity_matrix.iter_frames(mask=mask))
+
+        result = [pair for frame in frames for pair in zip(*[v.tolist() for v in frame])]
+        assert result == [('a', 'c', 0.5), ('c', 'd', 0.7)]
+
+    @pytest.mark.parametrize('read_size', (2**27, 1))
+    def test_iter_pair_blocks(self, frozen_similarity_matrix, read_size):
+        fillit(frozen_similarity_matrix)
+
+        blocks = list(frozen_similarity_matrix.iter_pair_blocks(read_size=read_size))
+        result = [np.concatenate(v).tolist() for v in zip(*blocks)]
+
+        # ordered on row then column
+        expected = [[1, 2, 2, 3], [0, 0, 1, 2], [58981, 32767, 39321, 45874]]
+        assert result == expected
+
+    @pytest.mark.parametrize('read_size', (2**27, 1))
+    def test_iter_pair_blocks_upper_triangle_masked(self, frozen_similarity_matrix, read_size):
+        fillit(frozen_similarity_matrix)
+        mask = np.array([True, False, True, True])
+
+        blocks = frozen_similarity_matrix.iter_pair_blocks(upper_triangle=True, mask=mask, read_size=read_size)
+        result = [np.concatenate(v).tolist() for v in zip(*blocks)]
+
+        expected = [[0, 2], [2, 3], [32767, 45874]]
+        assert result == expected
+
     def test_getitem_row_unknownfrag_keyerror(self, frozen_similarity_matrix):
         fillit(frozen_similarity_matrix)
 
@@ -269,3 +385,551 @@ class TestFrozenSimilarityMatrix(object):
                     (45874, 1),
                     (58981, 1)]
         assert_array_almost_equal(counts, expected, 6)
+
+    @pytest.mark.parametrize('cutoff,limit,expected,stored', (
+        (0.45, None, [('d', 0.7), ('b', 0.6), ('a', 0.5)], False),
+        (0.55, None, [('d', 0.7), ('b', 0.6)], False),
+        (0.45, 2, [('d', 0.7), ('b', 0.6)], True),
+        (0.65, 1, [('d', 0.7)], True),
+        (0.65, None, [('d', 0.7)], True),
+        (0.8, None, [], True),
+    ))
+    def test_find_top_neighbors(self, similarity_matrix, frozen_similarity_matrix, cutoff, limit, expected, stored):
+        frozen_similarity_matrix.from_pairs(similarity_matrix, 10)
+        frozen_similarity_matrix.build_top_neighbors(0.45, 2)
+
+        hits = frozen_similarity_matrix.find('c', cutoff, limit)
+
+        assert hits == expected
+        scutoff = frozen_similarity_matrix.score_codec.raw_cutoff(cutoff)
+        from_top_neighbors = frozen_similarity_matrix.top_neighbors.find(2, scutoff, limit)
+        assert (from_top_neighbors is not None) == stored
+
+    def test_build_top_neighbors(self, similarity_matrix, frozen_similarity_matrix):
+        frozen_similarity_matrix.from_pairs(similarity_matrix, 10)
+
+        frozen_similarity_matrix.build_top_neighbors(0.55, 2)
+
+        top_neighbors = frozen_similarity_matrix.top_neighbors
+        assert top_neighbors.indptr.tolist() == [0, 1, 3, 5, 6]
+        assert top_neighbors.ids.read().tolist() == [1, 0, 2, 3, 1, 2]
+
+    def test_find_top_neighbors_cutoff_below_build_cutoff(self, similarity_matrix, frozen_similarity_matrix):
+        frozen_similarity_matrix.from_pairs(similarity_matrix, 10)
+        frozen_similarity_matrix.build_top_neighbors(0.55, None)
+
+        hits = frozen_similarity_matrix.find('c', 0.45)
+
+        expected = [('d', 0.7), ('b', 0.6), ('a', 0.5)]
+        assert hits == expected
+
+    def test_extend_drops_top_neighbors(self, similarity_matrix, frozen_similarity_matrix):
+        frozen_similarity_matrix.from_pairs(similarity_matrix, 10)
+        frozen_similarity_matrix.build_top_neighbors(0.45, None)
+
+        frozen_similarity_matrix.extend(['e'], [('e', 'c', 0.8)])
+
+        assert frozen_similarity_matrix.top_neighbors is None
+        assert frozen_similarity_matrix.find('c', 0.75) == [('e', 0.8)]
+
+    def test_extend(self, similarity_matrix, frozen_similarity_matrix):
+        frozen_similarity_matrix.from_pairs(similarity_matrix, 10)
+
+        frozen_similarity_matrix.extend(['e', 'a'], [('e', 'a', 0.8), ('c', 'e', 0.4)])
+
+        assert frozen_similarity_matrix.find('a', 0.45) == [('b', 0.9), ('e', 0.8), ('c', 0.5)]
+        assert frozen_similarity_matrix.find('e', 0.0) == [('a', 0.8), ('c', 0.4)]
+        assert frozen_similarity_matrix['e', 'c'] == 0.4
+        assert frozen_similarity_matrix['e'] == [('a', 0.8), ('b', 0.0), ('c', 0.4), ('d', 0.0)]
+        expected = {
+            ('a', 'b', 0.9),
+            ('a', 'c', 0.5),
+            ('b', 'c', 0.6),
+            ('c', 'd', 0.7),
+            ('a', 'e', 0.8),
+            ('c', 'e', 0.4),
+        }
+        assert set(frozen_similarity_matrix) == expected
+        assert len(list(frozen_similarity_matrix.count(raw_score=True))) == 6
+
+    @pytest.mark.parametrize('limit', (None, 1))
+    def test_find_many(self, similarity_matrix, frozen_similarity_matrix, limit):
+        frozen_similarity_matrix.from_pairs(similarity_matrix, 10)
+        queries = ['c', 'a', 'd', 'c']
+
+        result = frozen_similarity_matrix.find_many(queries, 0.55, limit)
+
+        expected = [frozen_similarity_matrix.find(query, 0.55, limit) for query in queries]
+        assert result == expected
+
+    def test_find_many_extended(self, similarity_matrix, frozen_similarity_matrix):
+        frozen_similarity_matrix.from_pairs(similarity_matrix, 10)
+        frozen_similarity_matrix.extend(['e'], [('e', 'a', 0.8), ('c', 'e', 0.4)])
+
+        result = frozen_similarity_matrix.find_many(['e', 'a'], 0.45)
+
+        expected = [[('a', 0.8)], [('b', 0.9), ('e', 0.8), ('c', 0.5)]]
+        assert result == expected
+
+    def test_find_many_badid(self, similarity_matrix, frozen_similarity_matrix):
+        frozen_similarity_matrix.from_pairs(similarity_matrix, 10)
+
+        with pytest.raises(KeyError):
+            frozen_similarity_matrix.find_many(['a', 'foo-bar'], 0.55)
+
+    def test_extend_twice(self, similarity_matrix, frozen_similarity_matrix):
+        frozen_similarity_matrix.from_pairs(similarity_matrix, 10)
+
+        frozen_similarity_matrix.extend(['e'], [('e', 'a', 0.8)])
+        frozen_similarity_matrix.extend(['f'], [('f', 'e', 0.6), ('f', 'b', 0.7)])
+
+        labels = ['a', 'b', 'c', 'd', 'e', 'f']
+        expected = pd.DataFrame([
+            [0.0, 0.9, 0.5, 0.0, 0.8, 0.0],
+            [0.9, 0.0, 0.6, 0.0, 0.0, 0.7],
+            [0.5, 0.6, 0.0, 0.7, 0.0, 0.0],
+            [0.0, 0.0, 0.7, 0.0, 0.0, 0.0],
+            [0.8, 0.0, 0.0, 0.0, 0.0, 0.6],
+            [0.0, 0.7, 0.0, 0.0, 0.6, 0.0],
+        ], index=labels, columns=labels)
+        pdt.assert_almost_equal(frozen_similarity_matrix.to_pandas(), expected)
+
+    def test_extend_overlapping_frozen_pair_replaces_score(self, similarity_matrix, frozen_similarity_matrix):
+        frozen_similarity_matrix.from_pairs(similarity_matrix, 10)
+
+        frozen_similarity_matrix.extend(['e'], [('a', 'b', 0.9), ('c', 'a', 0.3), ('e', 'a', 0.8)])
+
+        assert frozen_similarity_matrix.find('a', 0.0) == [('b', 0.9), ('e', 0.8), ('c', 0.3)]
+        assert frozen_similarity_matrix['b', 'a'] == 0.9
+        assert frozen_similarity_matrix['c', 'a'] == 0.3
+        blocks = list(frozen_similarity_matrix.iter_pair_blocks())
+        pairs = set(zip(*[np.concatenate(v).tolist() for v in zip(*blocks)]))
+        assert (1, 0, frozen_similarity_matrix.score_codec.encode(0.9)) in pairs
+        assert (2, 0, frozen_similarity_matrix.score_codec.encode(0.3)) in pairs
+
+    def test_extend_same_pair_twice_keeps_last_score(self, similarity_matrix, frozen_similarity_matrix):
+        frozen_similarity_matrix.from_pairs(similarity_matrix, 10)
+
+        frozen_similarity_matrix.extend(['e'], [('e', 'a', 0.5), ('a', 'e', 0.6)])
+        frozen_similarity_matrix.extend([], [('e', 'a', 0.5)])
+
+        assert frozen_similarity_matrix['a', 'e'] == 0.5
+        assert frozen_similarity_matrix['e', 'a'] == 0.5
+
+    def test_extend_from_pairs_file(self, similarity_matrix, frozen_similarity_matrix):
+        frozen_similarity_matrix.from_pairs(similarity_matrix, 10)
+        with SimilarityMatrixInMemory() as pairs:
+            pairs.update([('e', 'a', 0.8), ('a', 'b', 0.4), ('c', 'e', 0.45)], {'a': 1, 'b': 2, 'c': 3, 'e': 4})
+
+            frozen_similarity_matrix.extend(['e'], pairs, frame_size=2)
+
+            expected_raw_score = pairs.pairs.table[2]['score']
+        assert frozen_similarity_matrix.find('a', 0.0) == [('e', 0.8), ('c', 0.5), ('b', 0.4)]
+        assert frozen_similarity_matrix._read_row(4)[2] == expected_raw_score
+
+    def test_extend_persisted(self, similarity_matrix):
+        fn = tmpname()
+        try:
+            with FrozenSimilarityMatrix(fn, 'w') as matrix:
+                matrix.from_pairs(similarity_matrix, 10)
+            with FrozenSimilarityMatrix(fn, 'a') as matrix:
+                matrix.extend(['e'], [('e', 'a', 0.8)])
+
+            with FrozenSimilarityMatrix(fn) as matrix:
+                assert matrix.find('e', 0.45) == [('a', 0.8)]
+        finally:
+            os.remove(fn)
+
+
+def test_find_row_cache(frozen_similarity_matrix):
+    fillit(frozen_similarity_matrix)
+    frozen_similarity_matrix.row_cache = RowCache(1024)
+    expected = frozen_similarity_matrix.find('c', 0.55)
+
+    result = frozen_similarity_matrix.find('c', 0.55)
+
+    assert result == expected
+    assert frozen_similarity_matrix['c'] == [('a', 0.5), ('b', 0.6), ('d', 0.7)]
+    stats = frozen_similarity_matrix.row_cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (2, 1, 1)
+
+
+def test_find_many_row_cache(frozen_similarity_matrix):
+    fillit(frozen_similarity_matrix)
+    frozen_similarity_matrix.row_cache = RowCache(1024)
+    frozen_similarity_matrix.find('c', 0.55)
+
+    result = frozen_similarity_matrix.find_many(['a', 'c'], 0.55)
+
+    assert result == [[('b', 0.9)], [('d', 0.7), ('b', 0.6)]]
+    stats = frozen_similarity_matrix.row_cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (1, 2, 2)
+
+
+def test_extend_clears_row_cache(frozen_similarity_matrix):
+    fillit(frozen_similarity_matrix)
+    frozen_similarity_matrix.row_cache = RowCache(1024)
+    frozen_similarity_matrix.find('c', 0.55)
+
+    frozen_similarity_matrix.extend(['e'], [('c', 'e', 0.8)])
+
+    assert frozen_similarity_matrix.find('c', 0.55) == [('e', 0.8), ('d', 0.7), ('b', 0.6)]
+
+
+class TestUint8ScoreCodec(object):
+    @pytest.mark.parametrize('score,raw_score', (
+        (0.0, 0),
+        (0.4499, 0),
+        (0.45, 1),
+        (0.452, 1),
+        (0.7, 116),
+        (1.0, 255),
+    ))
+    def test_encode(self, score, raw_score):
+        codec = Uint8ScoreCodec(0.45)
+
+        assert codec.encode([score]).tolist() == [raw_score]
+
+    def test_decode_within_step(self):
+        codec = Uint8ScoreCodec(0.45)
+        scores = np.linspace(0.45, 1.0, 1001)
+
+        decoded = codec.decode(codec.encode(scores))
+
+        assert np.all(decoded <= scores + 0.00005)
+        assert np.all(scores - decoded < codec.step + 0.00005)
+
+    @pytest.mark.parametrize('cutoff', (0.0, 0.45, 0.5, 0.55, 0.7, 0.95))
+    def test_raw_cutoff(self, cutoff):
+        codec = Uint8ScoreCodec(0.45)
+        raw_scores = np.arange(1, 256)
+
+        above = raw_scores >= codec.raw_cutoff(cutoff)
+
+        np.testing.assert_array_equal(above, codec.fractions(raw_scores) >= cutoff - 1e-9)
+
+    def test_decode_raw_into_pairs_precision(self):
+        codec = Uint8ScoreCodec(0.45)
+
+        assert codec.decode_raw(np.array([0, 1, 255]), Uint16ScoreCodec.precision).tolist() == [0, 29490, 65535]
+
+    def test_add(self):
+        codec = Uint8ScoreCodec(0.45)
+
+        raw_scores = codec.add(codec.encode([0.5, 0.0, 0.6]), codec.encode([0.46, 0.0, 0.6]))
+
+        assert codec.decode(raw_scores).tolist() == [0.9567, 0.0, 1.0]
+
+
+class TestFrozenSimilarityMatrixUint8(object):
+    @pytest.fixture
+    def matrix(self, similarity_matrix):
+        matrix_inmem = FrozenSimilarityMatrixInMemory()
+        matrix_inmem.matrix.h5file.close()
+        matrix = FrozenSimilarityMatrix(matrix_inmem.matrix_fn, 'a', score_codec=Uint8ScoreCodec(0.45),
+                                        driver='H5FD_CORE', driver_core_backing_store=0)
+        matrix_inmem.matrix = matrix
+        matrix.from_pairs(similarity_matrix, 10)
+        yield matrix
+        matrix_inmem.close()
+
+    def test_scores_8bit(self, matrix):
+        assert matrix.scores.dtype == np.uint8
+        assert matrix.h5file.root._v_attrs.score_codec == 'uint8'
+
+    def test_find(self, matrix):
+        hits = matrix.find('c', 0.55)
+
+        expected = [('d', 0.699), ('b', 0.5994)]
+        assert hits == expected
+
+    def test_count(self, matrix):
+        counts = list(matrix.count())
+
+        expected = [(0.4998, 1), (0.59941, 1), (0.69902, 1), (0.89823, 1)]
+        assert_array_almost_equal(counts, expected, 5)
+
+    def test_to_pairs(self, similarity_matrix, matrix):
+        with SimilarityMatrixInMemory() as thawed_matrix:
+            matrix.to_pairs(thawed_matrix)
+
+            assert_array_almost_equal(
+                [d[2] for d in thawed_matrix],
+                [d[2] for d in similarity_matrix],
+                2
+            )
+
+    @pytest.mark.parametrize('frame_size,external', ((10, False), (1, False), (10, True)))
+    def test_from_pairs_duplicate_pairs(self, frame_size, external):
+        with SimilarityMatrixInMemory() as pairs, FrozenSimilarityMatrixInMemory() as matrix:
+            pairs.update([('a', 'b', 0.5), ('b', 'c', 0.6), ('a', 'b', 0.46)], {'a': 0, 'b': 1, 'c': 2})
+            matrix.score_codec = Uint8ScoreCodec(0.45)
+
+            if external:
+                matrix.from_pairs_external(pairs, 100)
+            else:
+                matrix.from_pairs(pairs, frame_size)
+
+            # scores are added up, not their raw scores
+            hits = matrix.find('a', 0.0)
+            assert hits[0][0] == 'b'
+            assert abs(hits[0][1] - 0.96) < 2 * matrix.score_codec.step
+
+    def test_codec_read_from_file(self, similarity_matrix):
+        fn = tmpname()
+        try:
+            with FrozenSimilarityMatrix(fn, 'w', score_codec=Uint8ScoreCodec(0.5)) as matrix:
+                matrix.from_pairs(similarity_matrix, 10)
+
+            with FrozenSimilarityMatrix(fn) as matrix:
+                assert isinstance(matrix.score_codec, Uint8ScoreCodec)
+                assert matrix.score_codec.min_score == 0.5
+                # a-c has score of 0.49999 in pairs file, so is below min score
+                assert matrix.find('a', 0.0) == [('b', 0.8996)]
+        finally:
+            os.remove(fn)
+
+
+class TestFrozenSimilarityMatrixRaw(object):
+    def test_scores_memory_mapped(self, raw_frozen_similarity_matrix_fn):
+        with FrozenSimilarityMatrix(raw_frozen_similarity_matrix_fn) as matrix:
+            assert isinstance(matrix.scores, np.memmap)
+            assert 'scores' not in matrix.h5file.root
+
+    def test_find(self, raw_frozen_similarity_matrix_fn):
+        with FrozenSimilarityMatrix(raw_frozen_similarity_matrix_fn) as matrix:
+            hits = matrix.find('c', 0.55)
+
+        expected = [('d', 0.7), ('b', 0.6)]
+        assert hits == expected
+
+    def test_same_as_compressed(self, raw_frozen_similarity_matrix_fn, similarity_matrix, frozen_similarity_matrix):
+        frozen_similarity_matrix.from_pairs(similarity_matrix, 10)
+
+        with FrozenSimilarityMatrix(raw_frozen_similarity_matrix_fn) as matrix:
+            pdt.assert_almost_equal(matrix.to_pandas(), frozen_similarity_matrix.to_pandas())
+            assert list(matrix) == list(frozen_similarity_matrix)
+            assert matrix['c'] == frozen_similarity_matrix['c']
+            assert matrix['a', 'b'] == frozen_similarity_matrix['a', 'b']
+            assert list(matrix.count()) == list(frozen_similarity_matrix.count())
+
+    def test_open_similarity_matrix(self, raw_frozen_similarity_matrix_fn):
+        matrix = open_similarity_matrix(raw_frozen_similarity_matrix_fn)
+
+        assert isinstance(matrix, FrozenSimilarityMatrix)
+        assert isinstance(matrix.scores, np.memmap)
+        matrix.close()
+
+
+class TestFrozenSparseSimilarityMatrix(object):
+    def test_from_pairs_defaults(self, similarity_matrix, frozen_sparse_similarity_matrix):
+        frozen_sparse_similarity_matrix.from_pairs(similarity_matrix, 10)
+
+        assert frozen_sparse_similarity_matrix.indptr.read().tolist() == [0, 2, 4, 7, 8]
+        # rows sorted on score
+        assert frozen_sparse_similarity_matrix.indices.read().tolist() == [1, 2, 0, 2, 3, 1, 0, 2]
+        expected_scores = [58981, 32767, 58981, 39321, 45874, 39321, 32767, 45874]
+        assert frozen_sparse_similarity_matrix.scores.read().tolist() == expected_scores
+
+    def test_from_pairs_multiframe(self, similarity_matrix, frozen_sparse_similarity_matrix):
+        frozen_sparse_similarity_matrix.from_pairs(similarity_matrix, 1)
+
+        assert frozen_sparse_similarity_matrix.indptr.read().tolist() == [0, 2, 4, 7, 8]
+        assert frozen_sparse_similarity_matrix.indices.read().tolist() == [1, 2, 0, 2, 3, 1, 0, 2]
+
+    def test_from_pairs_singlesided(self, similarity_matrix, frozen_sparse_similarity_matrix):
+        frozen_sparse_similarity_matrix.from_pairs(similarity_matrix, 10, None, True)
+
+        assert frozen_sparse_similarity_matrix.indptr.read().tolist() == [0, 2, 3, 3, 4]
+        assert frozen_sparse_similarity_matrix.indices.read().tolist() == [1, 2, 2, 2]
+
+    def test_from_pairs_singlesided_same_orientation_as_dense(self, similarity_matrix, frozen_similarity_matrix,
+                                                              frozen_sparse_similarity_matrix):
+        frozen_similarity_matrix.from_pairs(similarity_matrix, 10, None, True)
+        frozen_sparse_similarity_matrix.from_pairs(similarity_matrix, 10, None, True)
+
+        for label in ['a', 'b', 'c', 'd']:
+            expected = frozen_similarity_matrix.find(label, 0.45)
+            assert frozen_sparse_similarity_matrix.find(label, 0.45) == expected
+        assert frozen_sparse_similarity_matrix['a', 'b'] == frozen_similarity_matrix['a', 'b'] == 0.9
+        assert frozen_sparse_similarity_matrix['b', 'a'] == frozen_similarity_matrix['b', 'a'] == 0.0
+
+    def test_from_pairs_duplicate_pairs_summed(self, frozen_sparse_similarity_matrix):
+        with SimilarityMatrixInMemory() as pairs:
+            pairs.update([('a', 'b', 0.2), ('a', 'b', 0.3), ('b', 'c', 0.0)], {'a': 0, 'b': 1, 'c': 2})
+
+            frozen_sparse_similarity_matrix.from_pairs(pairs, 1)
+
+        assert frozen_sparse_similarity_matrix.indptr.read().tolist() == [0, 1, 2, 2]
+        assert frozen_sparse_similarity_matrix.find('a', 0.1) == [('b', 0.5)]
+
+    def test_from_pairs_threads(self, similarity_matrix, frozen_sparse_similarity_matrix):
+        previous = tables.set_blosc_max_threads(3)
+        try:
+            frozen_sparse_similarity_matrix.from_pairs(similarity_matrix, 10, threads=2)
+
+            assert tables.set_blosc_max_threads(3) == 3
+        finally:
+            tables.set_blosc_max_threads(previous)
+        assert frozen_sparse_similarity_matrix.find('c', 0.55) == [('d', 0.7), ('b', 0.6)]
+
+    def test_find_defaults(self, similarity_matrix, frozen_sparse_similarity_matrix):
+        frozen_sparse_similarity_matrix.from_pairs(similarity_matrix, 10)
+
+        hits = frozen_sparse_similarity_matrix.find('c', 0.55)
+        expected = [('d', 0.7), ('b', 0.6)]
+        assert hits == expected
+
+    def test_iter_frames_masked(self, similarity_matrix, frozen_sparse_similarity_matrix):
+        frozen_sparse_similarity_matrix.from_pairs(similarity_matrix, 10)
+        mask = np.array([True, False, True, True])
+
+        frames = list(frozen_sparse_similarity_matrix.iter_frames(mask=mask))
+
+        result = [pair for frame in frames for pair in zip(*[v.tolist() for v in frame])]
+        assert result == [('a', 'c', 0.5), ('c', 'd', 0.7)]
+
+    @pytest.mark.parametrize('limit', (None, 1))
+    def test_find_many(self, similarity_matrix, frozen_sparse_similarity_matrix, limit):
+        frozen_sparse_similarity_matrix.from_pairs(similarity_matrix, 10)
+        queries = ['c', 'a', 'd', 'c']
+
+        result = frozen_sparse_similarity_matrix.find_many(queries, 0.55, limit)
+
+        expected = [frozen_sparse_similarity_matrix.find(query, 0.55, limit) for query in queries]
+        assert result == expected
+
+    def test_find_row_cache(self, similarity_matrix, frozen_sparse_similarity_matrix):
+        frozen_sparse_similarity_matrix.from_pairs(similarity_matrix, 10)
+        frozen_sparse_similarity_matrix.row_cache = RowCache(1024)
+        expected = frozen_sparse_similarity_matrix.find('c', 0.55)
+
+        result = frozen_sparse_similarity_matrix.find('c', 0.55)
+
+        assert result == expected
+        stats = frozen_sparse_similarity_matrix.row_cache.stats()
+        assert (stats['hits'], stats['misses'], stats['entries']) == (1, 1, 1)
+
+    def test_find_many_row_cache(self, similarity_matrix, frozen_sparse_similarity_matrix):
+        frozen_sparse_similarity_matrix.from_pairs(similarity_matrix, 10)
+        frozen_sparse_similarity_matrix.row_cache = RowCache(1024)
+        frozen_sparse_similarity_matrix.find('c', 0.55)
+
+        result = frozen_sparse_similarity_matrix.find_many(['a', 'c'], 0.55)
+
+        assert result == [[('b', 0.9)], [('d', 0.7), ('b', 0.6)]]
+        assert frozen_sparse_similarity_matrix.find('a', 0.55) == [('b', 0.9)]
+        stats = frozen_sparse_similarity_matrix.row_cache.stats()
+        assert (stats['hits'], stats['misses'], stats['entries']) == (2, 2, 2)
+
+    def test_open_similarity_matrix_row_cache(self, similarity_matrix):
+        fn = tmpname()
+        try:
+            with FrozenSparseSimilarityMatrix(fn, 'w') as matrix:
+                matrix.from_pairs(similarity_matrix, 10)
+
+            matrix = open_similarity_matrix(fn, row_cache_size=1024)
+
+            assert isinstance(matrix, FrozenSparseSimilarityMatrix)
+            assert matrix.row_cache.max_bytes == 1024
+            matrix.close()
+        finally:
+            os.remove(fn)
+
+    def test_find_limit(self, similarity_matrix, frozen_sparse_similarity_matrix):
+        frozen_sparse_similarity_matrix.from_pairs(similarity_matrix, 10)
+
+        hits = frozen_sparse_similarity_matrix.find('c', 0.55, 1)
+        expected = [('d', 0.7)]
+        assert hits == expected
+
+    def test_find_cutoffhigh_nohits(self, similarity_matrix, frozen_sparse_similarity_matrix):
+        frozen_sparse_similarity_matrix.from_pairs(similarity_matrix, 10)
+
+        hits = frozen_sparse_similarity_matrix.find('c', 0.9)
+        expected = []
+        assert hits == expected
+
+    def test_find_badkey_keyerror(self, similarity_matrix, frozen_sparse_similarity_matrix):
+        frozen_sparse_similarity_matrix.from_pairs(similarity_matrix, 10)
+
+        with pytest.raises(KeyError):
+            frozen_sparse_similarity_matrix.find('f', 0.45)
+
+    def test_getitem_row(self, frozen_sparse_similarity_matrix):
+        fillit(frozen_sparse_similarity_matrix)
+
+        result = [frozen_sparse_similarity_matrix[label] for label in ['a', 'b', 'c', 'd']]
+        expected = [
+            [(u'b', 0.9), (u'c', 0.5), (u'd', 0.0)],
+            [(u'a', 0.9), (u'c', 0.6), (u'd', 0.0)],
+            [(u'a', 0.5), (u'b', 0.6), (u'd', 0.7)],
+            [(u'a', 0.0), (u'b', 0.0), (u'c', 0.7)],
+        ]
+        assert result == expected
+
+    @pytest.mark.parametrize('frag1,frag2,expected', (
+        ('a', 'a', 1.0),
+        ('a', 'b', 0.9),
+        ('a', 'c', 0.5),
+        ('a', 'd', 0.0),
+        ('b', 'c', 0.6),
+        ('d', 'c', 0.7),
+    ))
+    def test_getitem_cell(self, frozen_sparse_similarity_matrix, frag1, frag2, expected):
+        fillit(frozen_sparse_similarity_matrix)
+
+        score = frozen_sparse_similarity_matrix[frag1, frag2]
+
+        assert score == expected
+
+    def test__iter__(self, frozen_sparse_similarity_matrix):
+        fillit(frozen_sparse_similarity_matrix)
+
+        result = list(frozen_sparse_similarity_matrix)
+
+        expected = [
+            ('a', 'b', 0.9),
+            ('a', 'c', 0.5),
+            ('b', 'c', 0.6),
+            ('c', 'd', 0.7),
+        ]
+        assert result == expected
+
+    def test_to_pairs(self, similarity_matrix, frozen_sparse_similarity_matrix):
+        frozen_sparse_similarity_matrix.from_pairs(similarity_matrix, 10)
+        with SimilarityMatrixInMemory() as thawed_matrix:
+
+            frozen_sparse_similarity_matrix.to_pairs(thawed_matrix)
+
+            assert_array_almost_equal(
+                [d[2] for d in thawed_matrix],
+                [d[2] for d in similarity_matrix],
+                5
+            )
+
+    @pytest.mark.parametrize('lower_triangle', (False, True))
+    def test_count_raw_score(self, similarity_matrix, frozen_sparse_similarity_matrix, lower_triangle):
+        frozen_sparse_similarity_matrix.from_pairs(similarity_matrix, 10)
+
+        counts = list(frozen_sparse_similarity_matrix.count(raw_score=True, lower_triangle=lower_triangle))
+        expected = [(32767, 1),
+                    (39321, 1),
+                    (45874, 1),
+                    (58981, 1)]
+        assert_array_almost_equal(counts, expected, 6)
+
+    def test_same_as_dense(self, frozen_similarity_matrix, frozen_sparse_similarity_matrix):
+        pairs = SimilarityMatrix('data/similarities.h5')
+        frozen_similarity_matrix.from_pairs(pairs, 1000)
+        frozen_sparse_similarity_matrix.from_pairs(pairs, 1000)
+        pairs.close()
+
+        labels = list(frozen_similarity_matrix.cache_l2i.keys())[::20]
+        for label in labels:
+            for limit in (None, 3):
+                expected = frozen_similarity_matrix.find(label, 0.45, limit)
+                assert frozen_sparse_similarity_matrix.find(label, 0.45, limit) == expected
+        assert list(frozen_sparse_similarity_matrix) == list(frozen_similarity_matrix)
+        expected = list(frozen_similarity_matrix.count())
+        assert list(frozen_sparse_similarity_matrix.count()) == expected
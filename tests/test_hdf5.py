@@ -13,12 +13,16 @@
 # limitations under the License.
 
 from __future__ import absolute_import
+import os
+import shutil
 
+import numpy as np
 import pytest
 from numpy.testing import assert_array_almost_equal, assert_almost_equal
 
+from kripodb.cache import RowCache
 from kripodb.hdf5 import SimilarityMatrix
-from .utils import SimilarityMatrixInMemory
+from .utils import SimilarityMatrixInMemory, tmpname
 
 
 @pytest.fixture
@@ -76,6 +80,15 @@ class TestSimilarityMatrix(object):
         assert_almost_equal(result[2], expected[2], 5)
         assert result[:2] == expected[:2]
 
+    def test_iter_frames(self, example_matrix):
+        mask = np.array([True, True, True, False])
+
+        frames = list(example_matrix.iter_frames(mask=mask, frame_size=2))
+
+        result = [list(zip(*[v.tolist() for v in frame])) for frame in frames]
+        expected = [[('a', 'b', 0.9), ('a', 'c', 0.6)], [('b', 'c', 0.6)]]
+        assert result == expected
+
     def test_keep(self, example_matrix, empty_matrix):
         in_matrix = example_matrix
         out_matrix = empty_matrix
@@ -91,6 +104,37 @@ class TestSimilarityMatrix(object):
         }
         assert set(out_matrix) == expected_similarities
 
+    def test_keep_reverse_direction(self, example_matrix, empty_matrix):
+        in_matrix = example_matrix
+        out_matrix = empty_matrix
+        frags2keep = {'c'}
+        in_matrix.keep(out_matrix, frags2keep)
+
+        expected_labels = {'a', 'b', 'c', 'd'}
+        assert set(out_matrix.labels.label2ids().keys()) == expected_labels
+        expected_similarities = {
+            ('a', 'c', 0.6),
+            ('b', 'c', 0.6),
+            ('d', 'c', 0.7)
+        }
+        assert set(out_matrix) == expected_similarities
+
+    def test_keep_multiframe(self, example_matrix, empty_matrix):
+        example_matrix.pairs.append_chunk_size = 1
+        example_matrix.labels.append_chunk_size = 1
+        example_matrix.keep(empty_matrix, {'a', 'b'})
+
+        assert set(empty_matrix.labels.label2ids().keys()) == {'a', 'b', 'c'}
+        assert len(empty_matrix.pairs) == 3
+
+    def test_skip_multiframe(self, example_matrix, empty_matrix):
+        example_matrix.pairs.append_chunk_size = 1
+        example_matrix.labels.append_chunk_size = 1
+        example_matrix.skip(empty_matrix, {'b'})
+
+        assert set(empty_matrix.labels.label2ids().keys()) == {'a', 'c', 'd'}
+        assert set(empty_matrix) == {('a', 'c', 0.6), ('d', 'c', 0.7)}
+
     def test_skip(self, example_matrix, empty_matrix):
         in_matrix = example_matrix
         out_matrix = empty_matrix
@@ -106,7 +150,146 @@ class TestSimilarityMatrix(object):
         assert set(out_matrix) == expected_similarities
 
 
+    @pytest.mark.parametrize('limit', (None, 1))
+    def test_find_indexed(self, example_matrix, limit):
+        expected = list(example_matrix.find('c', 0.55, limit))
+
+        example_matrix.build_index(frame_size=3)
+        result = list(example_matrix.find('c', 0.55, limit))
+
+        assert result == expected
+
+    @pytest.mark.parametrize('indexed', (False, True))
+    @pytest.mark.parametrize('limit', (None, 1))
+    def test_find_many(self, example_matrix, indexed, limit):
+        queries = ['c', 'a', 'd', 'c']
+        expected = [list(example_matrix.find(query, 0.55, limit)) for query in queries]
+        if indexed:
+            example_matrix.build_index()
+
+        result = example_matrix.find_many(queries, 0.55, limit)
+
+        assert result == expected
+
+    def test_find_many_badid(self, example_matrix):
+        with pytest.raises(KeyError):
+            example_matrix.find_many(['a', 'foo-bar'], 0.55)
+
+    def test_find_indexed_nohits(self, example_matrix):
+        example_matrix.build_index()
+
+        assert list(example_matrix.find('a', 0.95)) == []
+
+    def test_update_drops_index(self, example_matrix):
+        example_matrix.build_index()
+
+        example_matrix.pairs.update([('a', 'd', 0.8)], {'a': 0, 'd': 3})
+
+        assert example_matrix.pairs.neighbors is None
+        assert list(example_matrix.find('d', 0.55)) == [('a', 0.8), ('c', 0.7)]
+
+    def test_find_row_cache(self, example_matrix):
+        example_matrix.row_cache = RowCache(1024)
+        expected = list(example_matrix.find('c', 0.55))
+
+        result = list(example_matrix.find('c', 0.55))
+
+        assert result == expected
+        assert example_matrix.row_cache.hits == 1
+        assert example_matrix.row_cache.misses == 1
+
+    def test_update_clears_row_cache(self, example_matrix):
+        example_matrix.row_cache = RowCache(1024)
+        list(example_matrix.find('d', 0.55))
+
+        example_matrix.update([('a', 'd', 0.8)], {'a': 0, 'd': 3})
+
+        assert list(example_matrix.find('d', 0.55)) == [('a', 0.8), ('c', 0.7)]
+
+
+@pytest.fixture
+def indexed_matrix():
+    fn = tmpname()
+    shutil.copyfile('data/similarities.h5', fn)
+    sim_matrix = SimilarityMatrix(fn, 'a')
+    yield sim_matrix
+    sim_matrix.close()
+    os.remove(fn)
+
+
+def test_find_indexed_all(indexed_matrix):
+    labels = sorted(indexed_matrix.labels.label2ids().keys())[::20]
+    expected = [list(indexed_matrix.find(label, 0.45)) for label in labels]
+
+    indexed_matrix.build_index(frame_size=1000)
+    result = [list(indexed_matrix.find(label, 0.45)) for label in labels]
+
+    assert result == expected
+
+
 class TestPairsTable(object):
+    @pytest.mark.parametrize('buffer_size', (1, 3, 2**16))
+    def test_update(self, empty_matrix, buffer_size):
+        similarities = [
+            ('a', 'b', 0.9),
+            ('a', 'c', 0.6),
+            ('b', 'c', 0.6),
+            ('d', 'c', 0.7)
+        ]
+
+        empty_matrix.pairs.update(similarities, {'a': 0, 'b': 1, 'c': 2, 'd': 3}, buffer_size)
+
+        result = empty_matrix.pairs.table.read().tolist()
+        expected = [(0, 1, 58981), (0, 2, 39321), (1, 2, 39321), (3, 2, 45874)]
+        assert result == expected
+
+    def test_writer_arrays(self, empty_matrix):
+        with empty_matrix.pairs.writer(buffer_size=2) as writer:
+            writer.write(np.array([0, 0, 1]), np.array([1, 2, 2]), np.array([0.9, 0.6, 0.6]))
+            writer.write_labels([])
+
+        result = empty_matrix.pairs.table.read().tolist()
+        expected = [(0, 1, 58981), (0, 2, 39321), (1, 2, 39321)]
+        assert result == expected
+
+    def test_writer_drops_index(self, example_matrix):
+        example_matrix.build_index()
+
+        with example_matrix.pairs.writer({'a': 0, 'd': 3}) as writer:
+            writer.write_labels([('a', 'd', 0.8)])
+
+        assert example_matrix.pairs.neighbors is None
+        assert list(example_matrix.find('d', 0.55)) == [('a', 0.8), ('c', 0.7)]
+
+    @pytest.mark.parametrize('frame_size', (1, 3, 10**8))
+    def test_build_index(self, example_matrix, frame_size, tmpdir):
+        example_matrix.pairs.build_index(frame_size, str(tmpdir))
+
+        neighbors = example_matrix.pairs.neighbors
+        assert neighbors.indptr.read().tolist() == [0, 2, 4, 7, 8]
+        assert neighbors.ids.read().tolist() == [1, 2, 2, 0, 0, 1, 3, 2]
+        expected_scores = [58981, 39321, 39321, 58981, 39321, 39321, 45874, 45874]
+        assert neighbors.scores.read().tolist() == expected_scores
+        # temporary files are removed
+        assert tmpdir.listdir() == []
+
+    def test_build_index_empty(self, empty_matrix):
+        empty_matrix.build_index()
+
+        assert empty_matrix.pairs.neighbors.indptr.read().tolist() == [0]
+        assert len(empty_matrix.pairs.neighbors.ids) == 0
+
+    def test_iter(self, example_matrix):
+        result = list(example_matrix.pairs)
+
+        expected = [
+            {'a': 0, 'b': 1, 'score': 0.9},
+            {'a': 0, 'b': 2, 'score': 0.6},
+            {'a': 1, 'b': 2, 'score': 0.6},
+            {'a': 3, 'b': 2, 'score': 0.7},
+        ]
+        assert result == expected
+
     def test_count(self, example_matrix):
         counts = list(example_matrix.count(100000))
 
@@ -129,3 +312,14 @@ class TestPairsTable(object):
                         (0.7,  1),
                         (0.9,  1)]
             assert_array_almost_equal(counts, expected, 6)
+
+
+def test_find_many_indexed_all(indexed_matrix):
+    labels = sorted(indexed_matrix.labels.label2ids().keys())[::7]
+    expected = [list(indexed_matrix.find(label, 0.45)) for label in labels]
+    assert indexed_matrix.find_many(labels, 0.45) == expected
+
+    indexed_matrix.build_index(frame_size=1000)
+    result = indexed_matrix.find_many(labels, 0.45)
+
+    assert result == expected
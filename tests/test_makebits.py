@@ -15,6 +15,7 @@
 from __future__ import absolute_import
 
 from six import StringIO
+from numpy.testing import assert_array_equal
 from pyroaring import BitMap
 import pytest
 
@@ -86,6 +87,37 @@ def test_iter_file():
     assert next(iterator, is_exhausted) == is_exhausted
 
 
+def test_read_bitsets_block():
+    lines = ['3frb_TOP_frag24 1 2 3 4 6 10 11 12 15 0 9\n', '3frb_TOP_frag25 0 0\n', '3frb_TOP_frag26 5 0 1\n']
+
+    (fids, positions, offsets) = makebits.read_bitsets_block(lines)
+
+    assert fids == ['3frb_TOP_frag24', '3frb_TOP_frag25', '3frb_TOP_frag26']
+    assert_array_equal(positions, [1, 2, 3, 4, 6, 10, 11, 12, 15, 5])
+    assert_array_equal(offsets, [0, 9, 9, 10])
+
+
+def test_read_bitsets_block_toolong():
+    lines = ['3frb_TOP_frag24 1 2 3 0 3\n', '3frb_TOP_frag25 1 2 3 4 6 10 11 12 15 0 5\n']
+    with pytest.raises(Exception) as e:
+        makebits.read_bitsets_block(lines)
+    expected = ('On bit checksum incorrect for 3frb_TOP_frag25',)
+    assert e.value.args == expected
+
+
+def test_iter_file_bulk():
+    input = '''MAKEBITS 1.0 574331 BigGrid
+3frb_TOP_frag24 1 2 3 4 6 10 11 12 15 0 9
+3frb_TOP_frag25 1 2 0 2
+3frb_TOP_frag26 5 0 1
+'''
+
+    result = list(makebits.iter_file_bulk(StringIO(input), block_size=2))
+
+    expected = list(makebits.iter_file(StringIO(input)))
+    assert result == expected
+
+
 def test_write_file():
     bitsets = {'3frb_TOP_frag24': BitMap([1, 2, 3, 4, 6, 10, 11, 12, 15])}
     outfile = StringIO()
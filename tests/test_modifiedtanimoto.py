@@ -14,6 +14,8 @@
 
 from __future__ import absolute_import
 
+import numpy as np
+from numpy.testing import assert_array_equal
 import pytest
 from pyroaring import BitMap
 
@@ -109,6 +111,322 @@ class TestAlgorithm(object):
         # pair a-c is below cutoff with similarity of 0.53
         assert_similarities(result, expected)
 
+    def test_pack_bitsets(self):
+        bitsets = [
+            ('a', BitMap([1, 2, 3])),
+            ('b', BitMap([0, 64, 99])),
+        ]
+
+        labels, matrix, popcounts = modifiedtanimoto.pack_bitsets(bitsets, self.number_of_bits)
+
+        assert labels == ['a', 'b']
+        expected_matrix = np.array([[14, 0], [1, 2**35 + 1]], dtype=np.uint64)
+        assert_array_equal(matrix, expected_matrix)
+        assert_array_equal(popcounts, [3, 3])
+
+    def test_pack_positions(self):
+        positions = np.array([1, 2, 3, 0, 64, 99], dtype=np.uint32)
+        offsets = np.array([0, 3, 3, 6])
+
+        matrix, popcounts = modifiedtanimoto.pack_positions(positions, offsets, self.number_of_bits)
+
+        expected_matrix = np.array([[14, 0], [0, 0], [1, 2**35 + 1]], dtype=np.uint64)
+        assert_array_equal(matrix, expected_matrix)
+        assert_array_equal(popcounts, [3, 0, 3])
+
+    def test_packedbitsets_items(self):
+        bitsets = [
+            ('a', BitMap([1, 2, 3])),
+            ('b', BitMap([0, 64, 99])),
+            ('c', BitMap()),
+        ]
+        packed = modifiedtanimoto.PackedBitsets(bitsets, self.number_of_bits)
+
+        result = list(packed.items(block_size=2))
+
+        assert result == bitsets
+
+    def test_packedbitsets_save_load(self, tmpdir):
+        bitsets = [
+            ('a', BitMap([1, 2, 3])),
+            ('b', BitMap([0, 64, 99])),
+        ]
+        packed = modifiedtanimoto.PackedBitsets(bitsets, self.number_of_bits)
+        directory = str(tmpdir.join('fingerprints.packed'))
+
+        packed.save(directory)
+        result = modifiedtanimoto.PackedBitsets.load(directory)
+
+        assert result.labels == ['a', 'b']
+        assert result.number_of_bits == self.number_of_bits
+        assert isinstance(result.matrix, np.memmap)
+        assert_array_equal(result.matrix, packed.matrix)
+        assert_array_equal(result.popcounts, packed.popcounts)
+
+    def test_packedbitsets_pack(self, tmpdir):
+        bitsets = [
+            ('a', BitMap([1, 2, 3])),
+            ('b', BitMap([0, 64, 99])),
+            ('c', BitMap()),
+        ]
+        directory = str(tmpdir.join('fingerprints.packed'))
+
+        result = modifiedtanimoto.PackedBitsets.pack(bitsets, self.number_of_bits, directory, 3, block_size=2)
+
+        expected = modifiedtanimoto.PackedBitsets(bitsets, self.number_of_bits)
+        assert result.labels == ['a', 'b', 'c']
+        assert isinstance(result.matrix, np.memmap)
+        assert_array_equal(result.matrix, expected.matrix)
+        assert_array_equal(result.popcounts, expected.popcounts)
+        assert list(result.items()) == bitsets
+
+    def test_packedbitsets_pack_wrong_count(self, tmpdir):
+        bitsets = [
+            ('a', BitMap([1, 2, 3])),
+        ]
+        directory = str(tmpdir.join('fingerprints.packed'))
+
+        with pytest.raises(ValueError):
+            modifiedtanimoto.PackedBitsets.pack(bitsets, self.number_of_bits, directory, 2)
+
+    def test_intersection_cardinalities(self):
+        bitsets = [
+            ('a', BitMap([1, 2, 3])),
+            ('b', BitMap([1, 2, 4, 5, 8, 70])),
+            ('c', BitMap([1, 2, 4, 8, 70, 99])),
+        ]
+        labels, matrix, popcounts = modifiedtanimoto.pack_bitsets(bitsets, self.number_of_bits)
+
+        # tiny buffer to force multiple chunks
+        result = modifiedtanimoto.intersection_cardinalities(matrix[:2], matrix, buffer_size=1)
+
+        expected = [[3, 2, 2], [2, 6, 5]]
+        assert_array_equal(result, expected)
+
+    @pytest.mark.parametrize('ignore_upper_triangle', (True, False))
+    def test_packed_similarities(self, ignore_upper_triangle):
+        bitsets = {
+            'a': BitMap([1, 2, 3]),
+            'b': BitMap([1, 2, 4, 5, 8]),
+            'c': BitMap([1, 2, 4, 8])
+        }
+
+        iterator = modifiedtanimoto.packed_similarities(bitsets, bitsets,
+                                                        self.number_of_bits,
+                                                        self.corr_st, self.corr_sto,
+                                                        0.55, ignore_upper_triangle, block_size=2)
+        result = list(iterator)
+
+        expected = list(modifiedtanimoto.similarities(bitsets, bitsets,
+                                                      self.number_of_bits,
+                                                      self.corr_st, self.corr_sto,
+                                                      0.55, ignore_upper_triangle))
+        assert result == expected
+
+    @pytest.mark.parametrize('prune', (True, False))
+    def test_packed_similarities_packed_queries(self, prune):
+        bitsets = {
+            'a': BitMap([1, 2, 3]),
+            'b': BitMap([1, 2, 4, 5, 8]),
+            'c': BitMap([1, 2, 4, 8])
+        }
+        packed = modifiedtanimoto.PackedBitsets(bitsets.items(), self.number_of_bits)
+
+        iterator = modifiedtanimoto.packed_similarities(packed, packed,
+                                                        self.number_of_bits,
+                                                        self.corr_st, self.corr_sto,
+                                                        0.55, block_size=2, prune=prune)
+        result = list(iterator)
+
+        expected = list(modifiedtanimoto.similarities(bitsets, bitsets,
+                                                      self.number_of_bits,
+                                                      self.corr_st, self.corr_sto,
+                                                      0.55))
+        assert result == expected
+
+    @pytest.mark.parametrize('ignore_upper_triangle', (True, False))
+    def test_similarities_prune(self, ignore_upper_triangle):
+        bitsets = {
+            'a': BitMap([1, 2, 3]),
+            'b': BitMap([1, 2, 4, 5, 8]),
+            'c': BitMap([1, 2, 4, 8]),
+            'd': BitMap(range(20, 60)),
+        }
+
+        result = list(modifiedtanimoto.similarities(bitsets, bitsets,
+                                                    self.number_of_bits,
+                                                    self.corr_st, self.corr_sto,
+                                                    0.55, ignore_upper_triangle, prune=True))
+
+        expected = list(modifiedtanimoto.similarities(bitsets, bitsets,
+                                                      self.number_of_bits,
+                                                      self.corr_st, self.corr_sto,
+                                                      0.55, ignore_upper_triangle))
+        assert result == expected
+
+    @pytest.mark.parametrize('ignore_upper_triangle', (True, False))
+    @pytest.mark.parametrize('top', (1, 2, 10))
+    def test_top_similarities(self, ignore_upper_triangle, top):
+        bitsets = {
+            'a': BitMap([1, 2, 3]),
+            'b': BitMap([1, 2, 4, 5, 8]),
+            'c': BitMap([1, 2, 4, 8]),
+            'd': BitMap(range(20, 60)),
+        }
+
+        result = list(modifiedtanimoto.top_similarities(bitsets, bitsets,
+                                                        self.number_of_bits,
+                                                        self.corr_st, self.corr_sto,
+                                                        0.3, top, ignore_upper_triangle))
+
+        all_hits = list(modifiedtanimoto.similarities(bitsets, bitsets,
+                                                 self.number_of_bits,
+                                                 self.corr_st, self.corr_sto,
+                                                 0.3, ignore_upper_triangle))
+        expected = []
+        for label1 in bitsets.keys():
+            hits = [hit for hit in all_hits if hit[0] == label1]
+            hits.sort(key=lambda hit: (hit[2], hit[1]), reverse=True)
+            expected.extend(hits[:top])
+        assert result == expected
+
+    def test_top_similarities_top0(self):
+        bitsets = {
+            'a': BitMap([1, 2, 3]),
+            'b': BitMap([1, 2, 4, 5, 8]),
+        }
+
+        with pytest.raises(ValueError):
+            list(modifiedtanimoto.top_similarities(bitsets, bitsets,
+                                                   self.number_of_bits,
+                                                   self.corr_st, self.corr_sto,
+                                                   0.3, 0))
+
+    @pytest.mark.parametrize('ignore_upper_triangle', (True, False))
+    def test_packed_similarities_prune(self, ignore_upper_triangle):
+        bitsets = {
+            'a': BitMap([1, 2, 3]),
+            'b': BitMap([1, 2, 4, 5, 8]),
+            'c': BitMap([1, 2, 4, 8]),
+            'd': BitMap(range(20, 60)),
+        }
+
+        result = list(modifiedtanimoto.packed_similarities(bitsets, bitsets,
+                                                           self.number_of_bits,
+                                                           self.corr_st, self.corr_sto,
+                                                           0.55, ignore_upper_triangle, prune=True))
+
+        expected = list(modifiedtanimoto.similarities(bitsets, bitsets,
+                                                      self.number_of_bits,
+                                                      self.corr_st, self.corr_sto,
+                                                      0.55, ignore_upper_triangle))
+        assert result == expected
+
+    def test_similarity_upper_bound(self):
+        bitset1 = BitMap([1, 2, 3])
+        bitset2 = BitMap([1, 2, 4, 8])
+        score = modifiedtanimoto.similarity(bitset1, bitset2,
+                                            self.number_of_bits,
+                                            self.corr_st, self.corr_sto)
+
+        bound = modifiedtanimoto.similarity_upper_bound(3, 4,
+                                                        self.number_of_bits,
+                                                        self.corr_st, self.corr_sto)
+
+        assert bound >= score
+        assert bound == pytest.approx(modifiedtanimoto.similarity(bitset1, BitMap([1, 2, 3, 4]),
+                                                                  self.number_of_bits,
+                                                                  self.corr_st, self.corr_sto))
+
+
+@pytest.mark.parametrize('packed1', (False, True))
+@pytest.mark.parametrize('similarities_func,prune', (
+    (modifiedtanimoto.similarities, False),
+    (modifiedtanimoto.similarities, True),
+    (modifiedtanimoto.packed_similarities, False),
+    (modifiedtanimoto.packed_similarities, True),
+))
+def test_parallel_similarities(similarities_func, prune, packed1):
+    bitsets = {
+        'a': BitMap([1, 2, 3]),
+        'b': BitMap([1, 2, 4, 5, 8]),
+        'c': BitMap([1, 2, 4, 8]),
+        'd': BitMap([1, 2, 3, 4, 8]),
+        'e': BitMap([1, 2, 4]),
+    }
+    corr_st, corr_sto = modifiedtanimoto.corrections(0.01)
+
+    bitsets1 = bitsets
+    if packed1:
+        bitsets1 = modifiedtanimoto.PackedBitsets(sorted(bitsets.items()), 100)
+
+    iterator = modifiedtanimoto.parallel_similarities(similarities_func, bitsets1, bitsets,
+                                                      100, corr_st, corr_sto, 0.55,
+                                                      prune=prune, workers=2, tile_size=2)
+    result = list(iterator)
+
+    expected = list(modifiedtanimoto.similarities(bitsets, bitsets, 100, corr_st, corr_sto, 0.55))
+    assert result == expected
+
+
+def test_prunable_bitsets():
+    bitsets = {
+        'a': BitMap([1, 2, 3]),
+        'b': BitMap([1, 2, 4, 5, 8]),
+        'c': BitMap([1, 2, 4, 8]),
+    }
+    corr_st, corr_sto = modifiedtanimoto.corrections(0.01)
+    prunable = modifiedtanimoto.PrunableBitsets(sorted(bitsets.items()))
+    pruner = prunable.pruner(100, corr_st, corr_sto, 0.55)
+
+    result = list(modifiedtanimoto.similarities(bitsets, prunable, 100, corr_st, corr_sto, 0.55, prune=True))
+
+    expected = list(modifiedtanimoto.similarities(bitsets, bitsets, 100, corr_st, corr_sto, 0.55, prune=True))
+    assert result == expected
+    assert prunable.pruner(100, corr_st, corr_sto, 0.55) is pruner
+
+
+class TestPopcountPruner(object):
+    def test_range(self):
+        popcounts = np.array([40, 3, 5, 4, 1])
+        corr_st, corr_sto = modifiedtanimoto.corrections(0.01)
+        pruner = modifiedtanimoto.PopcountPruner(popcounts, 100, corr_st, corr_sto, 0.7)
+
+        result = pruner.range(4)
+
+        assert_array_equal(pruner.sorted_popcounts, [1, 3, 4, 5, 40])
+        assert result == (1, 4)
+
+    def test_candidates(self):
+        popcounts = np.array([40, 3, 5, 4, 1])
+        corr_st, corr_sto = modifiedtanimoto.corrections(0.01)
+        pruner = modifiedtanimoto.PopcountPruner(popcounts, 100, corr_st, corr_sto, 0.7)
+
+        result = pruner.candidates(4)
+
+        assert_array_equal(result, [1, 2, 3])
+
+    def test_ranked_ranges(self):
+        popcounts = np.array([40, 3, 5, 4, 1])
+        corr_st, corr_sto = modifiedtanimoto.corrections(0.01)
+        pruner = modifiedtanimoto.PopcountPruner(popcounts, 100, corr_st, corr_sto, 0.7)
+
+        result = list(pruner.ranked_ranges(4))
+
+        assert [(start, stop) for _, start, stop in result] == [(2, 3), (3, 4), (1, 2)]
+        bounds = [bound for bound, _, _ in result]
+        assert bounds == sorted(bounds, reverse=True)
+        assert bounds[0] == pytest.approx(1.0)
+
+    def test_candidates_none(self):
+        popcounts = np.array([40, 3, 5, 4, 1])
+        corr_st, corr_sto = modifiedtanimoto.corrections(0.01)
+        pruner = modifiedtanimoto.PopcountPruner(popcounts, 100, corr_st, corr_sto, 1.1)
+
+        result = pruner.candidates(4)
+
+        assert len(result) == 0
+
 
 @pytest.mark.parametrize("bitset2,expected_score", (
     (BitMap((1, 2, 3, 4)), 1.0),
@@ -16,11 +16,13 @@ from __future__ import absolute_import
 from collections import Mapping
 import os
 
+import numpy as np
 import tables
 from six import StringIO
 from pyroaring import BitMap
 import pytest
 
+from kripodb.db import FingerprintsDb
 import kripodb.hdf5
 import kripodb.pairs as pairs
 from kripodb.hdf5 import SimilarityMatrix
@@ -222,6 +224,67 @@ class Testpairs(object):
         expected = {'a\tc\t0.44667', 'a\tb\t0.33333','b\tc\t0.77667'}
         assert set(result.rstrip().split('\n')) == expected
 
+    def test_dump_pairs_astsv_packed(self, bitsets, number_of_bits, label2id):
+        out = StringIO()
+
+        pairs.dump_pairs(bitsets,
+                         bitsets,
+                         'tsv',
+                         'StringIO',
+                         out,
+                         number_of_bits,
+                         0.4,
+                         0.05,
+                         label2id,
+                         False,
+                         True,
+                         'packed',
+                         )
+        result = out.getvalue()
+
+        expected = {'a\tc\t0.44667', 'a\tb\t0.33333','b\tc\t0.77667'}
+        assert set(result.rstrip().split('\n')) == expected
+
+    @pytest.mark.parametrize('engine', ('roaring', 'packed'))
+    def test_dump_pairs_astsv_workers(self, bitsets, number_of_bits, label2id, engine):
+        out = StringIO()
+
+        pairs.dump_pairs(bitsets,
+                         bitsets,
+                         'tsv',
+                         'StringIO',
+                         out,
+                         number_of_bits,
+                         0.4,
+                         0.05,
+                         label2id,
+                         True,
+                         True,
+                         engine,
+                         workers=2,
+                         )
+        result = out.getvalue()
+
+        expected = {'a\tc\t0.44667', 'a\tb\t0.33333','b\tc\t0.77667'}
+        assert set(result.rstrip().split('\n')) == expected
+
+    def test_dump_pairs_badengine(self, bitsets, number_of_bits, label2id):
+        with pytest.raises(LookupError) as cm:
+            pairs.dump_pairs(bitsets,
+                             bitsets,
+                             'tsv',
+                             'StringIO',
+                             None,
+                             number_of_bits,
+                             0.4,
+                             0.05,
+                             label2id,
+                             True,
+                             engine='bikes'
+                             )
+
+        assert cm.value.args == ('Invalid engine',)
+
     def test_similarity2query(self, bitsets):
         out = StringIO()
 
@@ -237,6 +300,109 @@ class Testpairs(object):
         expected = 'a\tc\t0.44667\na\tb\t0.33333\n'
         assert result == expected
 
+    def test_similarity2query_prune(self, bitsets):
+        out = StringIO()
+
+        pairs.similarity2query(bitsets,
+                               'a',
+                               out,
+                               0.4,
+                               0.4,
+                               True,
+                               True
+                               )
+        result = out.getvalue()
+
+        expected = 'a\tc\t0.44667\n'
+        assert result == expected
+
+    def test_similarity2query_top(self, bitsets):
+        out = StringIO()
+
+        pairs.similarity2query(bitsets,
+                               'a',
+                               out,
+                               0.4,
+                               0.05,
+                               True,
+                               top=1
+                               )
+        result = out.getvalue()
+
+        expected = 'a\tc\t0.44667\n'
+        assert result == expected
+
+    def test_similarity2query_index(self, bitsets):
+        fingerprintsdb = FingerprintsDb(':memory:')
+        fingerprints = fingerprintsdb.as_dict(bitsets.number_of_bits)
+        fingerprints.update(bitsets.dict)
+        fingerprintsdb.build_index()
+        out = StringIO()
+
+        pairs.similarity2query(fingerprints,
+                               'a',
+                               out,
+                               0.4,
+                               0.05,
+                               False,
+                               index=True
+                               )
+        result = out.getvalue()
+        fingerprintsdb.close()
+
+        expected = 'a\tc\t0.44667\na\tb\t0.33333\n'
+        assert result == expected
+
+    def test_similarity2query_index_top(self, bitsets):
+        fingerprintsdb = FingerprintsDb(':memory:')
+        fingerprints = fingerprintsdb.as_dict(bitsets.number_of_bits)
+        fingerprints.update(bitsets.dict)
+        fingerprintsdb.build_index()
+        out = StringIO()
+
+        pairs.similarity2query(fingerprints,
+                               'a',
+                               out,
+                               0.4,
+                               0.05,
+                               False,
+                               index=True,
+                               top=1
+                               )
+        result = out.getvalue()
+        fingerprintsdb.close()
+
+        expected = 'a\tc\t0.44667\n'
+        assert result == expected
+
+    @pytest.mark.parametrize('prune', (True, False))
+    def test_similarity2queries_astsv(self, bitsets, prune):
+        out = StringIO()
+
+        pairs.similarity2queries(bitsets, ['a', 'b'], 'tsv', 'StringIO', out, 0.4, 0.05, prune=prune)
+        result = out.getvalue()
+
+        expected = 'a\tc\t0.44667\na\tb\t0.33333\nb\tc\t0.77667\n'
+        assert result == expected
+
+    def test_similarity2queries_top(self, bitsets):
+        out = StringIO()
+
+        pairs.similarity2queries(bitsets, ['a', 'b'], 'tsv', 'StringIO', out, 0.4, 0.05, top=1)
+        result = out.getvalue()
+
+        expected = 'a\tc\t0.44667\nb\tc\t0.77667\n'
+        assert result == expected
+
+    def test_similarity2queries_ashdf5(self, bitsets, label2id, h5filename):
+        pairs.similarity2queries(bitsets, ['a', 'b'], 'hdf5', h5filename, None, 0.4, 0.05, label2id)
+
+        matrix = SimilarityMatrix(h5filename)
+        result = [(a, b, round(score, 3)) for a, b, score in matrix]
+        matrix.close()
+        expected = [('a', 'c', 0.447), ('a', 'b', 0.333), ('b', 'c', 0.777)]
+        assert result == expected
+
     def test_total_number_of_pairs(self, sample_pairs, label2id, h5filename):
         self.fill_matrix(sample_pairs, label2id, h5filename)
 
@@ -279,3 +445,31 @@ def test_merge():
                 os.remove(infile)
         if os.path.isfile(outfile):
             os.remove(outfile)
+
+
+def test_label_mask():
+    labels = np.array(['2mlm_2W7_frag1', '2mlm_2W7_frag2', None, '3wvm_STE_frag1'], dtype=object)
+
+    result = pairs.label_mask(labels, frag1=True, pdbs={'2mlm'})
+
+    assert result.tolist() == [True, False, False, False]
+
+
+@pytest.mark.parametrize('frag1,pdbs,expected', (
+    (False, None, 11950),
+    (True, None, 695),
+    (False, {'2mlm'}, 2),
+))
+def test_export_pairs_tsv(frag1, pdbs, expected):
+    matrix = SimilarityMatrix('data/similarities.h5')
+    out = StringIO()
+
+    pairs.export_pairs_tsv(matrix, out, frag1, pdbs)
+
+    matrix.close()
+    rows = [line.split('\t') for line in out.getvalue().splitlines()]
+    assert len(rows) == expected
+    if frag1:
+        assert all(row[0].endswith('frag1') and row[1].endswith('frag1') for row in rows)
+    if pdbs:
+        assert all(row[0][:4] == '2mlm' and row[1][:4] == '2mlm' for row in rows)
@@ -2,7 +2,7 @@ import os
 import tempfile
 
 from kripodb.hdf5 import SimilarityMatrix
-from kripodb.frozen import FrozenSimilarityMatrix
+from kripodb.frozen import FrozenSimilarityMatrix, FrozenSparseSimilarityMatrix
 
 
 def tmpname():
@@ -44,3 +44,10 @@ class FrozenSimilarityMatrixInMemory(object):
         self.matrix.close()
         if os.path.isfile(self.matrix_fn):
             os.remove(self.matrix_fn)
+
+
+class FrozenSparseSimilarityMatrixInMemory(FrozenSimilarityMatrixInMemory):
+    def __init__(self):
+        self.matrix_fn = tmpname()
+        self.matrix = FrozenSparseSimilarityMatrix(self.matrix_fn, 'a',
+                                                   driver='H5FD_CORE', driver_core_backing_store=0)
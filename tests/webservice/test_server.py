@@ -169,6 +169,21 @@ def test_get_version():
     assert result == expected
 
 
+def test_get_cache_stats(fragsdb_filename, pharmacophores_db):
+    matrix = open_similarity_matrix('data/similarities.frozen.h5', row_cache_size=2**20)
+    try:
+        app = server.wsgi_app(matrix, fragsdb_filename, pharmacophores_db)
+        matrix.find('3j7u_NDP_frag24', 0.85)
+        matrix.find('3j7u_NDP_frag24', 0.85)
+
+        with app.app.test_request_context():
+            result = server.get_cache_stats()
+    finally:
+        matrix.close()
+
+    assert (result['hits'], result['misses'], result['entries'], result['max_bytes']) == (1, 1, 1, 2**20)
+
+
 def test_wsgi_app(similarity_matrix, fragsdb_filename, pharmacophores_db, app):
     assert app.app.config['similarities'] == similarity_matrix
     assert app.app.config['fragments'] == fragsdb_filename